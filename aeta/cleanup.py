@@ -0,0 +1,210 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deletes old test batches, their results and their blobs.
+
+Test batches are kept until they have not made progress for
+batch_retention_secs (see aeta.yaml), so that clients can get their results.
+To delete them after that, route a cron job to aeta in app.yaml:
+
+  handlers:
+  - url: /_aeta/cleanup
+    script: aeta.cleanup.APP
+    login: admin
+
+or, if you are using Python 2.5, "script: aeta/cleanup.py", and add it to
+cron.yaml:
+
+  cron:
+  - description: delete old aeta test batches
+    url: /_aeta/cleanup
+    schedule: every 1 hours
+
+Applications that already have a cron job can call delete_old_batches() from
+it instead.
+"""
+
+__author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
+
+import datetime
+import logging
+import types
+
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+from aeta import config
+from aeta import models
+from aeta import task_deferred as deferred
+from aeta import utils
+
+
+__all__ = ['delete_old_batches', 'CleanupRequestHandler']
+
+# How many old batches, and how many left over blobs, are looked at in one
+# request.  If there are more, the rest is deferred to a task, so that a backlog
+# is worked off without running into the request deadline.
+_MAX_BATCHES_PER_RUN = 50
+
+
+def _delete(keys, blob_keys):
+  """Deletes entities and the blobs they refer to.
+
+  Args:
+    keys: A list of the ndb.Keys of the entities.
+    blob_keys: A list of the keys of the blobs.
+  """
+  # Delete the blobs first, so that none is left behind if this fails.
+  if blob_keys:
+    blobstore.delete(blob_keys)
+  ndb.delete_multi(keys)
+
+
+def _get_batch_key(key):
+  """Gets the key of the TestBatch an entity belongs to.
+
+  Args:
+    key: The ndb.Key of an entity stored under a TestBatch or one of its
+        RunTestUnitTasks.
+
+  Returns:
+    The ndb.Key of the TestBatch.
+  """
+  root = key.root()
+  if root.kind() == models.RunTestUnitTask.__name__:
+    return models.RunTestUnitTask.get_batch_key(root)
+  return root
+
+
+def _delete_old_blobs(cutoff, conf, deleted_batch_keys=(), cursor=None):
+  """Deletes the blobs of batches that were not stored in the datastore.
+
+  Such batches (e.g. with memcache storage) have no BatchProgress in the
+  datastore, so their blobs are found by age instead.  At most
+  _MAX_BATCHES_PER_RUN StoredBlobs are looked at, and the rest in a deferred
+  task.
+
+  Args:
+    cutoff: The UTC datetime before which the blobs were written.
+    conf: The configuration to use.
+    deleted_batch_keys: The keys of batches that were just deleted, whose
+        blobs are gone already.
+    cursor: The urlsafe cursor to continue the query from, or None.
+
+  Returns:
+    The number of deleted blobs.
+  """
+  query = models.StoredBlob.query(models.StoredBlob.created < cutoff)
+  start_cursor = cursor and ndb.Cursor(urlsafe=cursor)
+  stored_keys, next_cursor, more = query.fetch_page(
+      _MAX_BATCHES_PER_RUN, start_cursor=start_cursor, keys_only=True)
+  stored_keys = [key for key in stored_keys
+                 if _get_batch_key(key) not in deleted_batch_keys]
+  progress_keys = [models.BatchProgress.get_key(_get_batch_key(key))
+                   for key in stored_keys]
+  stored_keys = [key for (key, progress)
+                 in zip(stored_keys, ndb.get_multi(progress_keys))
+                 if progress is None]
+  _delete(stored_keys, [key.id() for key in stored_keys])
+  if more and next_cursor:
+    deferred.defer(_delete_old_blobs, cutoff, conf,
+                   cursor=next_cursor.urlsafe(), _queue=conf.test_queue)
+  return len(stored_keys)
+
+
+def delete_old_batches(conf=None):
+  """Deletes the test batches that have not made progress for a while.
+
+  All entities of a batch are deleted, along with the blobs holding their
+  data.  Batches are found by their BatchProgress, and apart from their small
+  ProgressShards only keys are read, so no test results are loaded.  Blobs of
+  batches that were not stored in the datastore (e.g. with memcache storage)
+  are deleted once they are older than conf.batch_retention_secs.
+
+  At most _MAX_BATCHES_PER_RUN batches are deleted.  If there may be more,
+  the rest is deleted by another call in a deferred task, and the blobs are
+  only looked for once all old batches are gone.
+
+  Args:
+    conf: The configuration to use, or None to load it.
+
+  Returns:
+    A dictionary with the number of deleted batches ('num_batches'), entities
+    ('num_entities') and blobs ('num_blobs').
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(conf, 'conf', (types.NoneType, config.Config))
+  if conf is None:
+    conf = config.get_config()
+  # Properties with auto_now are in UTC.
+  cutoff = (datetime.datetime.utcnow() -
+            datetime.timedelta(seconds=conf.batch_retention_secs))
+  query = models.BatchProgress.query(
+      models.BatchProgress.last_progress < cutoff)
+  progress_keys = query.fetch(_MAX_BATCHES_PER_RUN, keys_only=True)
+  batch_keys = [models.BatchProgress.get_batch_key(key)
+                for key in progress_keys]
+  # BatchProgresses are root entities, so they are not found by the queries
+  # below.
+  keys = list(progress_keys)
+  blob_keys = []
+  shard_keys = []
+  for batch_key in batch_keys:
+    # The first query also returns the key of the batch itself.  Test units
+    # are root entities, so they are found by the second one.
+    for query in [ndb.Query(ancestor=batch_key),
+                  models.RunTestUnitTask.query_unit_keys(batch_key)]:
+      for key in query.iter(keys_only=True):
+        keys.append(key)
+        if key.kind() == models.StoredBlob.__name__:
+          blob_keys.append(key.id())
+    shard_keys.extend(models.ProgressShard.get_keys(batch_key))
+  # Neither are the ProgressShards.
+  keys.extend(shard.key for shard in ndb.get_multi(shard_keys) if shard)
+  _delete(keys, blob_keys)
+  num_entities = len(keys)
+  num_blobs = len(blob_keys)
+  if len(batch_keys) == _MAX_BATCHES_PER_RUN:
+    deferred.defer(delete_old_batches, conf, _queue=conf.test_queue)
+  else:
+    num_old_blobs = _delete_old_blobs(cutoff, conf, set(batch_keys))
+    num_entities += num_old_blobs
+    num_blobs += num_old_blobs
+  stats = {'num_batches': len(batch_keys),
+           'num_entities': num_entities,
+           'num_blobs': num_blobs}
+  logging.info('[aeta] Deleted %s old test batches with %s entities and %s '
+               'blobs.', stats['num_batches'], stats['num_entities'],
+               stats['num_blobs'])
+  return stats
+
+
+class CleanupRequestHandler(webapp.RequestHandler):
+  """Request handler for the cron job that deletes old test batches."""
+
+  def get(self):
+    stats = delete_old_batches()
+    self.response.out.write('Deleted %s test batches.' % stats['num_batches'])
+
+
+# The app object is used in a Python 2.7 runtime.
+APP = webapp.WSGIApplication([('.*', CleanupRequestHandler)])
+
+# In a Python 2.5 environment, run this as a CGI script.
+if __name__ == '__main__':
+  util.run_wsgi_app(APP)
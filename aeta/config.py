@@ -59,6 +59,21 @@ class Config(object):
                  'protected',
                  'permitted_emails',
                  'include_test_functions',
+                 'static_discovery',
+                 'discovery_threads',
+                 'unit_target_secs',
+                 'record_durations',
+                 'profile_imports',
+                 'reload_changed_modules',
+                 'task_target_secs',
+                 'warmup_budget_secs',
+                 'stream_results_methods',
+                 'stream_results_secs',
+                 'task_deadline_secs',
+                 'batch_retention_secs',
+                 'max_workers',
+                 'max_output_bytes',
+                 'max_method_output_bytes',
                  ]
 
   # Options which are computed based on url_path.
@@ -0,0 +1,287 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how much time and memory importing each module costs.
+
+While an ImportProfiler is running, the built-in __import__ function is
+replaced by a wrapper that times every import that actually loads a module.
+For each module, the inclusive cost (including the modules it imports) and the
+exclusive cost (only the module's own code) are recorded.  This shows which
+test modules, or which of their dependencies, make cold starts slow.
+
+Memory is measured as the growth of the process's peak resident set size, so
+it shows how much an import raised the peak, not how much it allocated: an
+import that only reuses memory freed earlier counts as 0.  It is only available
+where the resource module is (e.g. the development server).  Elsewhere, memory
+is reported as None.
+"""
+
+__author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
+
+import __builtin__
+import sys
+import threading
+import time
+
+try:
+  import resource
+except ImportError:
+  # The resource module is not available on App Engine.
+  resource = None
+
+from aeta import utils
+
+
+__all__ = ['ImportProfiler',
+           'merge_profiles',
+          ]
+
+# How many modules to include in a profile by default.
+_DEFAULT_MAX_MODULES = 50
+
+# The size in bytes of the unit of ru_maxrss, which is kilobytes on Linux but
+# bytes on Mac OS X.
+if sys.platform == 'darwin':
+  _MAXRSS_UNIT_BYTES = 1
+else:
+  _MAXRSS_UNIT_BYTES = 1024
+
+
+def _get_memory_kb():
+  """Gets the peak resident set size of the process.
+
+  Returns:
+    The peak resident set size in kilobytes, or None if it is not available.
+  """
+  if resource is None:
+    return None
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return maxrss * _MAXRSS_UNIT_BYTES // 1024
+
+
+def _get_imported_name(name, globals_):
+  """Gets the name of the module an import statement loaded.
+
+  Args:
+    name: The name passed to __import__.
+    globals_: The globals passed to __import__, or None.
+
+  Returns:
+    The full name of the imported module.
+  """
+  if globals_ and '__name__' in globals_:
+    # Python 2 tries imports relative to the importing package first.
+    if '__path__' in globals_:
+      package = globals_['__name__']
+    else:
+      package = globals_['__name__'].rpartition('.')[0]
+    if package:
+      relative_name = '%s.%s' % (package, name)
+      if sys.modules.get(relative_name) is not None:
+        return relative_name
+  return name
+
+
+class _ModuleCost(object):
+  """The recorded cost of importing a module.
+
+  Attributes:
+    inclusive_secs: Time spent importing the module, including its imports.
+    exclusive_secs: Time spent only in the module's own code.
+    inclusive_kb: Growth of the peak resident set size in kilobytes while
+        importing the module, including its imports, or None if unknown.
+    exclusive_kb: Growth of the peak resident set size in kilobytes only due
+        to the module's own code, or None if unknown.
+  """
+
+  def __init__(self):
+    self.inclusive_secs = 0.0
+    self.exclusive_secs = 0.0
+    self.inclusive_kb = None
+    self.exclusive_kb = None
+
+  def add(self, inclusive_secs, exclusive_secs, inclusive_kb, exclusive_kb):
+    self.inclusive_secs += inclusive_secs
+    self.exclusive_secs += exclusive_secs
+    if inclusive_kb is not None:
+      self.inclusive_kb = (self.inclusive_kb or 0) + inclusive_kb
+      self.exclusive_kb = (self.exclusive_kb or 0) + exclusive_kb
+
+
+class ImportProfiler(object):
+  """Records the cost of imports between calls to start() and stop().
+
+  Only one profiler can be running at a time.  Imports made by other threads
+  while the profiler is running are recorded as well.
+
+  Attributes:
+    total_secs: The total time spent in profiled imports.
+  """
+
+  # The profiler that is currently running, if any.
+  _running = None
+  _running_lock = threading.Lock()
+
+  def __init__(self):
+    self.total_secs = 0.0
+    self._costs = {}
+    self._lock = threading.Lock()
+    # Each thread has a stack of [children secs, children kb] lists, one for
+    # every import in progress.
+    self._local = threading.local()
+    self._orig_import = None
+
+  def start(self):
+    """Starts recording imports.
+
+    Returns:
+      Whether the profiler was started.  It is not started if another profiler
+      is already running, e.g. in a concurrent request.
+    """
+    ImportProfiler._running_lock.acquire()
+    try:
+      if ImportProfiler._running is not None:
+        return False
+      ImportProfiler._running = self
+      self._orig_import = __builtin__.__import__
+      __builtin__.__import__ = self._import
+      return True
+    finally:
+      ImportProfiler._running_lock.release()
+
+  def stop(self):
+    """Stops recording imports."""
+    ImportProfiler._running_lock.acquire()
+    try:
+      if ImportProfiler._running is self:
+        __builtin__.__import__ = self._orig_import
+        ImportProfiler._running = None
+    finally:
+      ImportProfiler._running_lock.release()
+
+  def _import(self, name, globals_=None, locals_=None, fromlist=None,
+              level=-1):
+    """A replacement for __import__ that records the cost of the import."""
+    num_modules = len(sys.modules)
+    stack = getattr(self._local, 'stack', None)
+    if stack is None:
+      stack = self._local.stack = []
+    stack.append([0.0, 0])
+    start_kb = _get_memory_kb()
+    start = time.time()
+    try:
+      return self._orig_import(name, globals_, locals_, fromlist, level)
+    finally:
+      secs = time.time() - start
+      kb = None
+      if start_kb is not None:
+        kb = _get_memory_kb() - start_kb
+      children_secs, children_kb = stack.pop()
+      # Imports of modules that were already loaded are not interesting.
+      if len(sys.modules) != num_modules:
+        if stack:
+          stack[-1][0] += secs
+          stack[-1][1] += kb or 0
+        else:
+          self._lock.acquire()
+          self.total_secs += secs
+          self._lock.release()
+        fullname = _get_imported_name(name, globals_)
+        exclusive_kb = None
+        if kb is not None:
+          exclusive_kb = kb - children_kb
+        self._lock.acquire()
+        try:
+          cost = self._costs.get(fullname)
+          if cost is None:
+            cost = self._costs[fullname] = _ModuleCost()
+          cost.add(secs, secs - children_secs, kb, exclusive_kb)
+        finally:
+          self._lock.release()
+
+  def get_profile_json(self, max_modules=_DEFAULT_MAX_MODULES):
+    """Gets the most expensive imports as a JSON-convertible object.
+
+    Args:
+      max_modules: The maximum number of modules to include.
+
+    Returns:
+      A dictionary of the form
+      {'total_secs': the total time spent importing,
+       'modules': a list of {'module': module name,
+                             'inclusive_secs': ..., 'exclusive_secs': ...,
+                             'inclusive_kb': ..., 'exclusive_kb': ...}
+           dictionaries, sorted by exclusive time, most expensive first, with
+           memory as described for _ModuleCost
+      }
+
+    Raises:
+      TypeError: Wrong input arguments.
+    """
+    utils.check_type(max_modules, 'max_modules', int)
+    return _get_profile_json(self.total_secs, self._costs, max_modules)
+
+
+def _get_profile_json(total_secs, costs, max_modules):
+  """Gets the most expensive imports as a JSON-convertible object.
+
+  Args:
+    total_secs: The total time spent importing.
+    costs: A dictionary mapping module names to their _ModuleCosts.
+    max_modules: The maximum number of modules to include.
+
+  Returns:
+    A profile, see ImportProfiler.get_profile_json().
+  """
+  modules = []
+  for fullname, cost in costs.items():
+    modules.append({'module': fullname,
+                    'inclusive_secs': cost.inclusive_secs,
+                    'exclusive_secs': cost.exclusive_secs,
+                    'inclusive_kb': cost.inclusive_kb,
+                    'exclusive_kb': cost.exclusive_kb,
+                   })
+  modules.sort(key=lambda module: module['exclusive_secs'], reverse=True)
+  return {'total_secs': total_secs, 'modules': modules[:max_modules]}
+
+
+def merge_profiles(profiles, max_modules=_DEFAULT_MAX_MODULES):
+  """Merges several profiles returned by ImportProfiler.get_profile_json().
+
+  Costs of the same module in different profiles (e.g. imported by different
+  tasks on different instances) are added up.
+
+  Args:
+    profiles: A list of profiles.
+    max_modules: The maximum number of modules to include.
+
+  Returns:
+    A profile of the same form as ImportProfiler.get_profile_json() returns.
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(profiles, 'profiles', list)
+  utils.check_type(max_modules, 'max_modules', int)
+  total_secs = 0.0
+  costs = {}
+  for profile in profiles:
+    total_secs += profile['total_secs']
+    for module in profile['modules']:
+      cost = costs.get(module['module'])
+      if cost is None:
+        cost = costs[module['module']] = _ModuleCost()
+      cost.add(module['inclusive_secs'], module['exclusive_secs'],
+               module['inclusive_kb'], module['exclusive_kb'])
+  return _get_profile_json(total_secs, costs, max_modules)
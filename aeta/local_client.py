@@ -112,6 +112,12 @@ _REST_START_BATCH_PATH = 'start_batch'
 _REST_BATCH_INFO_PATH = 'batch_info'
 # Path in REST interface to poll for test results.
 _REST_BATCH_RESULTS_PATH = 'batch_results'
+# Path in REST interface to cancel a test batch.
+_REST_CANCEL_BATCH_PATH = 'cancel_batch'
+
+# Outcomes of test methods in partial results of running test units.
+_OUTCOME_ERROR = 'error'
+_OUTCOME_FAIL = 'fail'
 
 # How long to wait between polling REST calls in seconds.  The actual wait time
 # will be incremented by this number each call.
@@ -437,18 +443,38 @@ class AetaCommunicator(object):
       msg = 'Could not decode message: %s"""%s"""' % (os.linesep, response)
       raise RestApiError(msg)
 
-  def start_batch(self, testname):
+  def start_batch(self, testname, shard_index=0, shard_count=1,
+                  changed_paths=None, fail_fast=False, max_reruns=0):
     """Starts a batch with the given name.
 
     Args:
       testname: The full name of the test to run.
+      shard_index: The index of the shard of the tests to run.
+      shard_count: How many shards the tests are split into.  By default, all
+          tests are run.
+      changed_paths: A list of paths of changed source files, relative to the
+          application's root directory, to only run the tests affected by
+          them, or None to run all tests.
+      fail_fast: Whether to abort the batch after the first test unit with an
+          error or failure.
+      max_reruns: How many times to run failed test methods again to find
+          out if they are flaky.
 
     Returns:
       A JSON dictionary of data about the batch.  See rest.py for details about
           the format.
     """
     url_suffix = '%s/%s' % (_REST_START_BATCH_PATH, testname)
-    return self._get_rest_json_data(url_suffix, '')
+    if shard_count != 1:
+      url_suffix += '?' + urllib.urlencode([('shard_index', shard_index),
+                                            ('shard_count', shard_count)])
+    params = [('changed_path', path) for path in changed_paths or []]
+    if fail_fast:
+      params.append(('fail_fast', 1))
+    if max_reruns:
+      params.append(('max_reruns', max_reruns))
+    data = urllib.urlencode(params)
+    return self._get_rest_json_data(url_suffix, data)
 
   def batch_info(self, batch_id):
     """Gets information about a batch.
@@ -463,7 +489,7 @@ class AetaCommunicator(object):
     url_suffix = '%s/%s' % (_REST_BATCH_INFO_PATH, batch_id)
     return self._get_rest_json_data(url_suffix)
 
-  def batch_results(self, batch_id, start):
+  def batch_results(self, batch_id, start, partial=False):
     """Gets results for tests that have completed.
 
     See rest.py for details about usage.
@@ -471,31 +497,69 @@ class AetaCommunicator(object):
     Args:
       batch_id: The string id of the batch to get tests in.
       start: The minimum integer index to return test results for.
+      partial: Whether to also get the outcomes of test methods in units that
+          are still running.
 
     Returns:
-      A JSON list of dictionaries for test results.  See rest.py for details.
+      A JSON list of dictionaries for test results, or if partial is True, a
+      dictionary with this list as 'results' and the outcomes of running
+      units as 'partial_results'.  See rest.py for details.
     """
     url_suffix = '%s/%s?start=%s' % (_REST_BATCH_RESULTS_PATH, batch_id, start)
+    if partial:
+      url_suffix += '&partial=1'
     return self._get_rest_json_data(url_suffix)
 
+  def cancel_batch(self, batch_id):
+    """Cancels a batch that is still running.
+
+    Args:
+      batch_id: The string id of the batch to cancel.
+
+    Returns:
+      A JSON dictionary with the number of queued tasks that were deleted.
+          See rest.py for details about the format.
+    """
+    url_suffix = '%s/%s' % (_REST_CANCEL_BATCH_PATH, batch_id)
+    return self._get_rest_json_data(url_suffix, '')
+
 
 class _TestResultUpdater(object):
   """Manages the current state of a test batch and returned results."""
 
-  def __init__(self, comm, testname_prefix):
+  def __init__(self, comm, testname_prefix, shard_index=0, shard_count=1,
+               changed_paths=None, fail_fast=False, max_reruns=0):
     """Initializes the _TestResultUpdater.
 
     Args:
       comm: An AetaCommunicator used to make REST calls.
       testname_prefix: The full name of the test object to run tests for.
+      shard_index: The index of the shard of the tests to run.
+      shard_count: How many shards the tests are split into.
+      changed_paths: A list of paths of changed source files to only run the
+          tests affected by them, or None to run all tests.
+      fail_fast: Whether to abort the batch after the first test unit with an
+          error or failure.
+      max_reruns: How many times to run failed test methods again to find
+          out if they are flaky.
 
     Raises:
       TypeError: Wrong input arguments.
     """
     check_type(comm, 'comm', AetaCommunicator)
     check_type(testname_prefix, 'testname_prefix', basestring)
+    check_type(shard_index, 'shard_index', int)
+    check_type(shard_count, 'shard_count', int)
+    check_type(changed_paths, 'changed_paths', (types.NoneType, list))
+    check_type(fail_fast, 'fail_fast', bool)
+    check_type(max_reruns, 'max_reruns', int)
     self.comm = comm
     self.testname_prefix = testname_prefix
+    self.shard_index = shard_index
+    self.shard_count = shard_count
+    self.changed_paths = changed_paths
+    self.fail_fast = fail_fast
+    self.max_reruns = max_reruns
     # ID number of the batch that will be created for these tests.
     self.batch_id = None
     # How many test units are part of the batch.
@@ -513,6 +577,9 @@ class _TestResultUpdater(object):
     # A dictionary mapping test method name to printed test output for that
     # method.
     self.test_outputs = {}
+    # A dictionary mapping test method name to the reason it was skipped for
+    # test methods that were not run because the batch was aborted.
+    self.test_skips = {}
     # A set of test method names that have finished, successfully or not.
     self.test_methods_finished = set()
     # The number of test units that have completed and whose results have been
@@ -541,16 +608,62 @@ class _TestResultUpdater(object):
       self.test_failures.update(result['failures'])
       self.load_errors.update(result['load_errors'])
       test_methods = self.test_unit_methods[unit_name]
-      # All test methods in this unit are now finished whether or not they
-      # passed.
-      self.test_methods_finished.update(test_methods)
       if result['output']:
         # Printing test results is a little awkward because we don't know which
         # test method(s) produced which output.  The best we can do is to
-        # attach the output from the entire unit to the first method.
-        self.test_outputs[test_methods[0]] = result['output']
+        # attach the output from the entire unit to the first method that was
+        # not reported by partial results yet.
+        unreported = [name for name in test_methods
+                      if name not in self.test_methods_finished]
+        self.test_outputs[(unreported or test_methods)[0]] = result['output']
+      if result.get('skipped'):
+        # The batch was aborted, so methods that did not report an outcome
+        # were never run.
+        timings = result.get('timings') or {}
+        ran = set(method[0] for method in timings.get('methods', []))
+        ran.update(self.test_errors)
+        ran.update(self.test_failures)
+        for name in test_methods:
+          if name not in ran:
+            self.test_skips[name] = ('Not run because the batch was aborted '
+                                     'after a failure.')
+      reruns = result.get('reruns')
+      if reruns:
+        # Flaky methods count as passed.
+        for name in reruns['flaky']:
+          self.test_errors.pop(name, None)
+          self.test_failures.pop(name, None)
+          outcomes = reruns['attempts'][name]
+          note = ('Flaky: passed after %s failed attempts.' %
+                  (len(outcomes) - 1))
+          if name in self.test_outputs:
+            note = self.test_outputs[name] + '\n' + note
+          self.test_outputs[name] = note
+      # All test methods in this unit are now finished whether or not they
+      # passed.
+      self.test_methods_finished.update(test_methods)
     self.num_units_finished += len(results)
 
+  def _update_partial_results(self, partial_results):
+    """Updates this object with outcomes of methods in running test units.
+
+    If failed test methods are run again, their errors and failures are only
+    reported with the unit's final result, which tells whether they are flaky.
+
+    Args:
+      partial_results: A list of JSON objects from the server representing the
+          outcomes of test methods in units that have not finished yet.
+    """
+    for partial_result in partial_results:
+      for (method_name, outcome, traceback) in partial_result['methods']:
+        if self.max_reruns and outcome in (_OUTCOME_ERROR, _OUTCOME_FAIL):
+          continue
+        if outcome == _OUTCOME_ERROR:
+          self.test_errors[method_name] = traceback
+        elif outcome == _OUTCOME_FAIL:
+          self.test_failures[method_name] = traceback
+        self.test_methods_finished.add(method_name)
+
   def initialize(self):
     """Starts the batch and gets information about it.
 
@@ -561,7 +674,9 @@ class _TestResultUpdater(object):
     This should be called before calling any other methods.
     """
     if self.batch_id is not None: return
-    started = self.comm.start_batch(self.testname_prefix)
+    started = self.comm.start_batch(self.testname_prefix, self.shard_index,
+                                    self.shard_count, self.changed_paths,
+                                    self.fail_fast, self.max_reruns)
     if 'batch_id' not in started:
       self._initialize_batch_info(started['batch_info'])
       self._update_results(started['results'])
@@ -575,12 +690,26 @@ class _TestResultUpdater(object):
       time.sleep(sleep_time)
     self._initialize_batch_info(batch_info)
 
+  def cancel(self):
+    """Cancels the batch if it is still running on the server.
+
+    Afterwards, the batch's results can no longer be polled.
+    """
+    if self.batch_id is None:
+      return
+    if (self.num_units is not None and
+        self.num_units_finished >= self.num_units):
+      return
+    self.comm.cancel_batch(self.batch_id)
+
   def poll_results(self):
     """Updates test results by polling the REST server."""
     if self.batch_id is None:
       raise ValueError('Need to call initialize() first')
-    results = self.comm.batch_results(self.batch_id, self.num_units_finished)
-    self._update_results(results)
+    response = self.comm.batch_results(self.batch_id, self.num_units_finished,
+                                       partial=True)
+    self._update_results(response['results'])
+    self._update_partial_results(response['partial_results'])
 
   def create_test_method(self, method_name):
     """Gets a test method that gets its result from the server.
@@ -620,6 +749,8 @@ class _TestResultUpdater(object):
             raise TestError(self.test_errors[method_name])
           if method_name in self.test_failures:
             test_case_self.fail(self.test_failures[method_name])
+          if method_name in self.test_skips:
+            raise unittest.SkipTest(self.test_skips[method_name])
           break
         sleep_time += _POLL_BATCH_WAIT_SECS_INC
         time.sleep(sleep_time)
@@ -691,7 +822,9 @@ def _insert_test_method(classes, base_class, fullname, method):
 
 
 def create_test_cases(aeta_url, base_class, testname_prefix='', email=None,
-                      passin=False, save_auth=True):
+                      passin=False, save_auth=True, shard_index=0,
+                      shard_count=1, changed_paths=None, fail_fast=False,
+                      max_reruns=0, updaters_out=None):
   """Create local test cases for an aeta-enabled application.
 
   Args:
@@ -703,12 +836,28 @@ def create_test_cases(aeta_url, base_class, testname_prefix='', email=None,
     passin: Whether to read the password from stdin rather than echo-free
         input.
     save_auth: Whether to store authentication cookies in a file.
+    shard_index: The index of the shard of the tests to create.
+    shard_count: How many shards the tests are split into (by a hash of
+        their names), e.g. to run them from several machines.  By default, all
+        tests are created.
+    changed_paths: A list of paths of changed source files, relative to the
+        application's root directory.  If given, only tests that import one of
+        them (directly or indirectly) are created.
+    fail_fast: Whether to abort the batch after the first test unit with an
+        error or failure.  Tests that were not run by then are skipped.
+    max_reruns: How many times to run failed test methods again.  Tests that
+        pass when run again are reported as passed, but print that they are
+        flaky.
+    updaters_out: If given, the object that gets the results of the test
+        cases from the server is appended to this list.  Its cancel() method
+        cancels the batch, e.g. if the test cases will not be run to the end.
 
   Returns:
     A list of test cases derived from base_class.
 
   Raises:
     TypeError: Wrong input arguments.
+    ValueError: If shard_index is not in [0, shard_count).
     RestApiError: If prefix does not specify a valid test object or there was
         some other problem communicating with the aeta REST server.
     AuthError: If there was a problem with authentication.
@@ -719,10 +868,23 @@ def create_test_cases(aeta_url, base_class, testname_prefix='', email=None,
   check_type(email, 'email', (types.NoneType, basestring))
   check_type(passin, 'passin', bool)
   check_type(save_auth, 'save_auth', bool)
+  check_type(shard_index, 'shard_index', int)
+  check_type(shard_count, 'shard_count', int)
+  check_type(changed_paths, 'changed_paths', (types.NoneType, list))
+  check_type(fail_fast, 'fail_fast', bool)
+  check_type(max_reruns, 'max_reruns', int)
+  check_type(updaters_out, 'updaters_out', (types.NoneType, list))
+  if not 0 <= shard_index < shard_count:
+    raise ValueError('shard_index must be at least 0 and under shard_count '
+                     '(%s) but is %s.' % (shard_count, shard_index))
   authenticator = ClientLoginAuth(aeta_url, email=email, passin=passin,
                                   save_auth=save_auth)
   comm = AetaCommunicator(authenticator, aeta_url)
-  updater = _TestResultUpdater(comm, testname_prefix)
+  updater = _TestResultUpdater(comm, testname_prefix, shard_index,
+                               shard_count, changed_paths, fail_fast,
+                               max_reruns)
+  if updaters_out is not None:
+    updaters_out.append(updater)
   updater.initialize()
   classes = {}
   for (module_name, traceback) in updater.load_errors.items():
@@ -779,7 +941,8 @@ def _print_test_output(start_time, suite):
 
 
 def main(aeta_url, testname_prefix='', email=None, passin=False,
-         save_auth=True):
+         save_auth=True, shard_index=0, shard_count=1, changed_paths=None,
+         fail_fast=False, max_reruns=0):
   """Main function invoked if module is run from commandline.
 
   Args:
@@ -790,19 +953,36 @@ def main(aeta_url, testname_prefix='', email=None, passin=False,
     passin: Whether to read the password from stdin rather than echo-free
         input.
     save_auth: Whether to store authentication cookies in a file.
+    shard_index: The index of the shard of the tests to run.
+    shard_count: How many shards the tests are split into.
+    changed_paths: A list of paths of changed source files to only run the
+        tests affected by them, or None to run all tests.
+    fail_fast: Whether to skip the remaining tests after the first test unit
+        with an error or failure.
+    max_reruns: How many times to run failed test methods again to find out
+        if they are flaky.
   """
+  updaters = []
   try:
     start_time = time.time()
     this_module = inspect.getmodule(main)
     testcases = create_test_cases(aeta_url, unittest.TestCase, testname_prefix,
                                   email=email, passin=passin,
-                                  save_auth=save_auth)
+                                  save_auth=save_auth, shard_index=shard_index,
+                                  shard_count=shard_count,
+                                  changed_paths=changed_paths,
+                                  fail_fast=fail_fast, max_reruns=max_reruns,
+                                  updaters_out=updaters)
     add_test_cases_to_module(testcases, this_module)
     suite = unittest.TestLoader().loadTestsFromModule(this_module)
     if not suite.countTestCases():
       error_msg = 'No tests '
       if testname_prefix:
         error_msg += 'with the prefix "%s" ' % testname_prefix
+      if shard_count != 1:
+        error_msg += 'in shard %s of %s ' % (shard_index, shard_count)
+      if changed_paths is not None:
+        error_msg += 'affected by the changed files '
       error_msg += 'found at "%s"' % aeta_url
       print >> sys.stderr, error_msg
       sys.exit(1)
@@ -811,6 +991,12 @@ def main(aeta_url, testname_prefix='', email=None, passin=False,
       delattr(this_module, testcase.__name__)
   except AuthError, e:
     print >> sys.stderr, str(e)
+  except KeyboardInterrupt:
+    # Don't leave the remaining tests running on the server.
+    for updater in updaters:
+      updater.cancel()
+    print >> sys.stderr, 'Interrupted, cancelled the tests on the server.'
+    sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -824,13 +1010,45 @@ if __name__ == '__main__':
   PARSER.add_option('--no_save_auth', action='store_false', dest='save_auth',
                     default=True,
                     help='Do not save authentication cookies to a local file.')
+  PARSER.add_option('--shard_index', action='store', type='int',
+                    dest='shard_index', default=0,
+                    help='The index of the shard of the tests to run, from 0 '
+                         'to shard_count - 1.')
+  PARSER.add_option('--shard_count', action='store', type='int',
+                    dest='shard_count', default=1,
+                    help='Split the tests into this many disjoint shards, '
+                         'e.g. to run them from several machines, and only '
+                         'run the one given by --shard_index.  Tests are '
+                         'assigned to shards by a hash of their names.')
+  PARSER.add_option('--changed_path', action='append', dest='changed_paths',
+                    default=None, metavar='PATH',
+                    help='Only run tests affected by a change of this source '
+                         'file, relative to the application root.  Can be '
+                         'given several times, e.g. once for every file '
+                         'changed by a commit.')
+  PARSER.add_option('--fail_fast', action='store_true', dest='fail_fast',
+                    default=False,
+                    help='Stop running tests after the first test unit with '
+                         'an error or failure, and skip the rest.')
+  PARSER.add_option('--max_reruns', action='store', type='int',
+                    dest='max_reruns', default=0,
+                    help='Run tests that fail or cause an error again up to '
+                         'this many times, and report the ones that pass in '
+                         'the end as flaky.')
   (OPTIONS, ARGS) = PARSER.parse_args()
   if not ARGS or len(ARGS) > 2:
     print USAGE
     sys.exit(1)
+  if not 0 <= OPTIONS.shard_index < OPTIONS.shard_count:
+    PARSER.error('--shard_index must be at least 0 and under --shard_count.')
+  if OPTIONS.max_reruns < 0:
+    PARSER.error('--max_reruns must not be negative.')
   INPUT_AETA_URL = ARGS[0]
   INPUT_TESTNAME_PREFIX = ''
   if len(ARGS) == 2:
     INPUT_TESTNAME_PREFIX = ARGS[1]
   main(INPUT_AETA_URL, INPUT_TESTNAME_PREFIX, email=OPTIONS.email,
-       passin=OPTIONS.passin, save_auth=OPTIONS.save_auth)
+       passin=OPTIONS.passin, save_auth=OPTIONS.save_auth,
+       shard_index=OPTIONS.shard_index, shard_count=OPTIONS.shard_count,
+       changed_paths=OPTIONS.changed_paths, fail_fast=OPTIONS.fail_fast,
+       max_reruns=OPTIONS.max_reruns)
@@ -49,15 +49,19 @@ package.
 __author__ = 'schuppe@google.com (Robert Schuppenies)'
 
 import functools
+import hashlib
 import inspect
+import logging
 import os
 import re
 import sys
+import threading
 import traceback
 import types
 import unittest
 
 from aeta import config
+from aeta import static_discovery
 from aeta import utils
 
 
@@ -70,9 +74,56 @@ __all__ = ['get_abs_path_from_package_name',
            'create_module_data',
            'get_test_suite_from_name',
            'get_test_unit_names',
+           'get_estimated_secs',
+           'partition_units',
+           'get_shard',
+           'get_affected_unit_methods',
+           'reload_changed_test_modules',
           ]
 
 
+# Index of test modules in packages.  It maps (package name, package path,
+# module pattern, depth) to a (dir_mtimes, module_names) tuple as returned by
+# _find_module_names_in_path().  Adding, removing, or renaming a file changes
+# the modification time of its directory, so an entry is valid as long as none
+# of its directories were modified.
+_MODULE_NAMES_CACHE = {}
+
+# A mapping from regular expression string to compiled regular expression.
+_COMPILED_PATTERNS = {}
+
+# Indexes of the test objects found so far, see _NameIndex.  Which objects
+# exist depends on whether test functions are wrapped, so there is one index
+# per value of Config.include_test_functions.
+_NAME_INDEXES = {}
+
+# The estimated duration in seconds of a test method that has never been run.
+_DEFAULT_METHOD_SECS = 1.0
+
+# The sources of loaded test modules, see reload_changed_test_modules().  It
+# maps module name to a (source path, mtime, md5 digest) tuple describing the
+# source the module was loaded from.
+_MODULE_SOURCES = {}
+
+# A mapping from the name of a module imported by
+# load_module_from_module_name() to the names of all modules that were first
+# loaded by that import.  This complements the imports found in the module's
+# source for get_affected_unit_methods(), e.g. for dynamic imports.
+_IMPORTED_MODULE_NAMES = {}
+
+# The direct dependencies found in the source of modules.  It maps source path
+# to a (module name, mtime, dependency names) tuple, see
+# _get_direct_dependencies().
+_DEPENDENCIES_CACHE = {}
+
+# Held while changed test modules are reloaded.
+_RELOAD_LOCK = threading.Lock()
+
+# Module attributes that are kept when a module is reloaded.
+_KEPT_MODULE_ATTRIBUTES = frozenset(['__builtins__', '__file__', '__loader__',
+                                     '__name__', '__package__', '__path__'])
+
+
 class TestObject(object):
   """A object representing a collection of tests.
 
@@ -130,6 +181,26 @@ class TestObject(object):
     """
     raise NotImplementedError('get_methods')
 
+  def get_unit_methods(self, conf, errors_out=None):
+    """Gets all test units in this object together with their methods.
+
+    This is equivalent to calling get_methods() on every unit returned by
+    get_units(), but only traverses the object once.  Errors encountered while
+    getting the methods of a unit are not reported, because they will be
+    reported when the unit is run.
+
+    Args:
+      conf: The Config that specifies how to load tests.
+      errors_out: A list to which import error tracebacks are appended, or None
+          to ignore errors.
+
+    Returns:
+      A list of (unit, methods) tuples, where unit is a TestObject as returned
+      by get_units() and methods is a list of the unit's Method instances.
+    """
+    return [(unit, unit.get_methods(conf))
+            for unit in self.get_units(conf, errors_out)]
+
   def get_suite(self, conf, errors_out=None):
     """Gets a TestSuite containing all tests in this object.
 
@@ -146,7 +217,17 @@ class TestObject(object):
 
 
 class TestContainer(TestObject):
-  """A test object that contains other test objects."""
+  """A test object that contains other test objects.
+
+  Children are only loaded once per Config for the lifetime of the container,
+  so walking the same tree repeatedly (e.g. to get units and then the methods
+  of each unit) does not import or inspect anything twice.
+  """
+
+  def __init__(self, fullname):
+    super(TestContainer, self).__init__(fullname)
+    # A mapping from Config to a (children, load errors) tuple.
+    self._children_cache = {}
 
   def get_children(self, conf, errors_out):
     """Gets a list of test objects contained in this container.
@@ -159,7 +240,27 @@ class TestContainer(TestObject):
     Returns:
       A list of TestObject instances contained in this object.
     """
-    raise NotImplementedError('get_children')
+    cached = self._children_cache.get(conf)
+    if cached is None:
+      errors = []
+      cached = (self._load_children(conf, errors), errors)
+      self._children_cache[conf] = cached
+    children, errors = cached
+    if errors_out is not None:
+      errors_out.extend(errors)
+    return list(children)
+
+  def _load_children(self, conf, errors_out):
+    """Loads the test objects contained in this container.
+
+    Args:
+      conf: A Config object for determining where tests are.
+      errors_out: A list to which import error tracebacks are appended.
+
+    Returns:
+      A list of TestObject instances contained in this object.
+    """
+    raise NotImplementedError('_load_children')
 
   def is_parallel(self, conf):
     """Determines whether tests in this object should be parallelized.
@@ -173,12 +274,31 @@ class TestContainer(TestObject):
     """
     raise NotImplementedError('is_parallel')
 
+  def can_split(self):
+    """Determines whether this object may be split into its children.
+
+    Objects with setUpModule/tearDownModule or setUpClass/tearDownClass
+    fixtures must run in a single unit, see get_units.
+
+    Returns:
+      Whether the children of this object may be run in different units.
+    """
+    return True
+
   def get_methods(self, conf, errors_out=None):
     methods = []
     for child in self.get_children(conf, errors_out):
       methods.extend(child.get_methods(conf, errors_out))
     return methods
 
+  def get_suite(self, conf, errors_out=None):
+    # Children might have been found without importing them, so let each of
+    # them create its own part of the suite.
+    cases = []
+    for child in self.get_children(conf, errors_out):
+      cases.extend(child.get_suite(conf, errors_out))
+    return unittest.TestSuite(cases)
+
   def get_units(self, conf, errors_out=None):
     if self.is_parallel(conf):
       units = []
@@ -187,6 +307,14 @@ class TestContainer(TestObject):
       return units
     return [self]
 
+  def get_unit_methods(self, conf, errors_out=None):
+    if self.is_parallel(conf):
+      unit_methods = []
+      for child in self.get_children(conf, errors_out):
+        unit_methods.extend(child.get_unit_methods(conf, errors_out))
+      return unit_methods
+    return [(self, self.get_methods(conf))]
+
 
 class Root(TestContainer):
   """Represents the root (named '').
@@ -200,7 +328,7 @@ class Root(TestContainer):
   def is_parallel(self, conf):
     return conf.parallelize_modules
 
-  def get_children(self, conf, errors_out):
+  def _load_children(self, conf, errors_out):
     return [get_requested_object(p, conf) for p in conf.test_package_names]
 
 
@@ -216,16 +344,32 @@ class Package(TestContainer):
   def is_parallel(self, conf):
     return conf.parallelize_modules
 
-  def get_children(self, conf, errors_out):
+  def _load_children(self, conf, errors_out):
     modules = get_module_names_in_package(self.fullname,
                                           conf.test_module_pattern)
+    if conf.static_discovery:
+      # Finding the tests of a module statically only reads files, so it can be
+      # done concurrently.  Modules that have to be imported are imported one
+      # at a time below, in order, since the import lock serializes imports
+      # anyway and errors should be reported in a deterministic order.
+      infos = utils.map_in_threads(
+          lambda module_name: _get_static_module_info(module_name, conf),
+          modules, conf.discovery_threads)
+    else:
+      infos = [None] * len(modules)
+    index = _get_name_index(conf)
     children = []
-    for module_name in modules:
-      module = load_module_from_module_name(
-          module_name, errors_out, include_import_error=True,
-          include_test_functions=conf.include_test_functions)
-      if module:
+    for module_name, info in zip(modules, infos):
+      if info:
+        children.append(StaticModule(module_name, info))
+      else:
+        module = load_module_from_module_name(
+            module_name, errors_out, include_import_error=True,
+            include_test_functions=conf.include_test_functions)
+        if not module:
+          continue
         children.append(Module(module_name, module))
+      index.add(module_name, _IndexEntry('module', module_name))
     return children
 
 
@@ -244,16 +388,21 @@ class Module(TestContainer):
     self.module = module
 
   def is_parallel(self, conf):
-    return conf.parallelize_classes and not (
-        hasattr(self.module, 'setUpModule') or
-        hasattr(self.module, 'tearDownModule'))
+    return conf.parallelize_classes and self.can_split()
 
-  def get_children(self, conf, errors_out):
+  def can_split(self):
+    return not (hasattr(self.module, 'setUpModule') or
+                hasattr(self.module, 'tearDownModule'))
+
+  def _load_children(self, conf, errors_out):
+    index = _get_name_index(conf)
     classes = []
     for cls_name in dir(self.module):
       cls = getattr(self.module, cls_name)
       if isinstance(cls, type) and issubclass(cls, unittest.TestCase):
-        classes.append(Class('%s.%s' % (self.fullname, cls_name), cls))
+        fullname = '%s.%s' % (self.fullname, cls_name)
+        classes.append(Class(fullname, cls))
+        index.add(fullname, _IndexEntry('class', self.fullname, cls_name))
     return classes
 
 
@@ -273,8 +422,9 @@ class Class(TestContainer):
     self.class_ = class_
 
   def is_parallel(self, conf):
-    if not conf.parallelize_methods:
-      return False
+    return conf.parallelize_methods and self.can_split()
+
+  def can_split(self):
     for name in ['setUpClass', 'tearDownClass']:
       # Check if self.class_ overrode the method by comparing its
       # implementation to unittest.TestCase's.
@@ -286,11 +436,14 @@ class Class(TestContainer):
         return False
     return True
 
-  def get_children(self, conf, errors_out):
+  def _load_children(self, conf, errors_out):
+    index = _get_name_index(conf)
+    module_name, class_name = self.fullname.rsplit('.', 1)
     methods = []
     for method_name in unittest.TestLoader().getTestCaseNames(self.class_):
-      methods.append(Method('%s.%s' % (self.fullname, method_name),
-                            self.class_, method_name))
+      fullname = '%s.%s' % (self.fullname, method_name)
+      methods.append(Method(fullname, self.class_, method_name))
+      index.add(fullname, _IndexEntry('method', module_name, class_name))
     return methods
 
 
@@ -327,6 +480,86 @@ class Method(TestObject):
     return case
 
 
+class _StaticTestObject(TestObject):
+  """A test object that was found without importing its module.
+
+  Only test names are known for such objects.  To actually run the tests, the
+  module is imported when the test suite is created.
+  """
+
+  def get_suite(self, conf, errors_out=None):
+    test = _import_requested_object(self.fullname, conf)
+    return test.get_suite(conf, errors_out)
+
+
+class StaticModule(_StaticTestObject, TestContainer):
+  """Represents a module containing tests, found by parsing its source.
+
+  Attributes:
+    info: The static_discovery.ModuleInfo for the module.
+  """
+
+  def __init__(self, fullname, info):
+    utils.check_type(info, 'info', static_discovery.ModuleInfo)
+    super(StaticModule, self).__init__(fullname)
+    self.info = info
+
+  def is_parallel(self, conf):
+    return conf.parallelize_classes and self.can_split()
+
+  def can_split(self):
+    return not self.info.has_module_fixture
+
+  def _load_children(self, conf, errors_out):
+    index = _get_name_index(conf)
+    classes = self.info.classes
+    children = []
+    for name in sorted(classes):
+      fullname = '%s.%s' % (self.fullname, name)
+      children.append(StaticClass(fullname, classes[name]))
+      index.add(fullname, _IndexEntry('class', self.fullname, name))
+    return children
+
+
+class StaticClass(_StaticTestObject, TestContainer):
+  """Represents a test class, found by parsing its module's source.
+
+  Attributes:
+    info: The static_discovery.ClassInfo for the class.
+  """
+
+  def __init__(self, fullname, info):
+    utils.check_type(info, 'info', static_discovery.ClassInfo)
+    super(StaticClass, self).__init__(fullname)
+    self.info = info
+
+  def is_parallel(self, conf):
+    return conf.parallelize_methods and self.can_split()
+
+  def can_split(self):
+    return not self.info.has_class_fixture
+
+  def _load_children(self, conf, errors_out):
+    index = _get_name_index(conf)
+    module_name, class_name = self.fullname.rsplit('.', 1)
+    children = []
+    for method_name in self.info.method_names:
+      fullname = '%s.%s' % (self.fullname, method_name)
+      children.append(StaticMethod(fullname))
+      index.add(fullname, _IndexEntry('method', module_name, class_name))
+    return children
+
+
+class StaticMethod(_StaticTestObject):
+  """Represents a test method, found by parsing its module's source."""
+
+  def get_units(self, conf, errors_out=None):
+    return [self]
+
+  def get_methods(self, conf, errors_out=None):
+    return [self]
+
+
 class BadTest(TestObject):
   """Represents a test object that does not exist or could not be loaded.
 
@@ -355,6 +588,138 @@ class BadTest(TestObject):
     return []
 
 
+class _IndexEntry(object):
+  """Describes what a full name refers to.
+
+  Attributes:
+    kind: One of 'package', 'module', 'class', or 'method'.
+    module_name: The full name of the module containing the object, or None
+        for packages.
+    class_name: The name of the class (within its module) containing the
+        object, or None for packages and modules.
+  """
+
+  def __init__(self, kind, module_name=None, class_name=None):
+    self.kind = kind
+    self.module_name = module_name
+    self.class_name = class_name
+
+
+class _NameIndex(object):
+  """An index from full names of test objects to _IndexEntry objects.
+
+  The index is a trie over the dotted segments of names, so that everything
+  inside a package or module can be removed at once when it changes.  Each node
+  is a dictionary mapping segments to child nodes, and the entry for the node's
+  name (if any) is stored under the key None.
+
+  Names that refer to no test object are remembered separately, along with the
+  modification times of the directories of their test package.  They are
+  forgotten when one of the directories changes (e.g. because a module was
+  added) or when test modules are reloaded.
+  """
+
+  def __init__(self):
+    self._root = {}
+    self._missing = {}
+
+  def add(self, fullname, entry):
+    """Adds or replaces the entry for a name.
+
+    Args:
+      fullname: The full name of the object.
+      entry: The _IndexEntry describing the object.
+    """
+    node = self._root
+    for segment in fullname.split('.'):
+      node = node.setdefault(segment, {})
+    node[None] = entry
+    self._missing.pop(fullname, None)
+
+  def add_missing(self, fullname, dir_mtimes):
+    """Notes that there is no test object with the name.
+
+    Args:
+      fullname: The full name that does not refer to a test object.
+      dir_mtimes: A dictionary mapping the directories of the name's test
+          package to their modification times, see _get_package_dir_mtimes.
+    """
+    self._missing[fullname] = dir_mtimes
+
+  def is_missing(self, fullname):
+    """Determines whether a name is known to refer to no test object.
+
+    Args:
+      fullname: The full name.
+
+    Returns:
+      True if the name was added with add_missing and none of the directories
+      changed since, False otherwise.
+    """
+    dir_mtimes = self._missing.get(fullname)
+    if dir_mtimes is None:
+      return False
+    if _is_module_index_valid(dir_mtimes):
+      return True
+    del self._missing[fullname]
+    return False
+
+  def clear_missing(self):
+    """Forgets all names that were added with add_missing."""
+    self._missing.clear()
+
+  def get(self, fullname):
+    """Gets the entry for a name.
+
+    Args:
+      fullname: The full name of the object.
+
+    Returns:
+      The _IndexEntry for the name, or None if the name is not indexed.
+    """
+    node = self._root
+    for segment in fullname.split('.'):
+      node = node.get(segment)
+      if node is None:
+        return None
+    return node.get(None)
+
+  def remove_prefix(self, fullname):
+    """Removes the entries for a name and all names inside it.
+
+    Args:
+      fullname: The full name of a package, module, class, or method.
+    """
+    segments = fullname.split('.')
+    node = self._root
+    for segment in segments[:-1]:
+      node = node.get(segment)
+      if node is None:
+        return
+    node.pop(segments[-1], None)
+
+
+def _get_name_index(conf):
+  """Gets the index of test object names to use with a configuration.
+
+  Args:
+    conf: The configuration to use.
+
+  Returns:
+    A _NameIndex.
+  """
+  key = conf.include_test_functions
+  index = _NAME_INDEXES.get(key)
+  if index is None:
+    index = _NAME_INDEXES.setdefault(key, _NameIndex())
+  return index
+
+
+def _clear_name_indexes():
+  """Forgets everything known about test object names."""
+  _NAME_INDEXES.clear()
+
+
 def get_abs_path_from_package_name(packagename):
   """Get absolute file path of the package.
 
@@ -439,10 +804,7 @@ def wrap_test_functions(module):
   Args:
     module: A module to search for test functions to wrap.
   """
-  _, _, submodule_name = module.__name__.rpartition('.')
-  test_case_name = ''.join(
-      s[:1].upper() + s[1:] for s in submodule_name.split('_'))
-  test_case_name += 'WrappedTestFunctions'  # Prevent name collision.
+  test_case_name = static_discovery.get_wrapped_class_name(module.__name__)
   if hasattr(module, test_case_name):
     return
   test_functions = {}
@@ -490,11 +852,16 @@ def load_module_from_module_name(fullname, errors_out=None, reload_mod=False,
   try:
     loaded_by_import = False
     if fullname not in sys.modules:
+      loaded_names = set(sys.modules)
       __import__(fullname)
       loaded_by_import = True
+      new_names = [name for name in sys.modules if name not in loaded_names]
+      _IMPORTED_MODULE_NAMES[fullname] = new_names
+      _track_new_module_sources(fullname, new_names)
     module = sys.modules[fullname]
     if reload_mod and not loaded_by_import:
       module = reload(module)
+      _track_module_source(module)
     if include_test_functions:
       wrap_test_functions(module)
   # pylint: disable-msg=W0703
@@ -517,49 +884,304 @@ def load_module_from_module_name(fullname, errors_out=None, reload_mod=False,
   return module
 
 
-# TODO(schuppe): too many local variables - pylint: disable-msg=R0914,R0912
-def get_module_names_in_package(packagename, module_pattern, depth=0):
-  """Get names of all modules in the package that match module_pattern.
+def _get_module_source_path(module):
+  """Gets the path of the file a module was loaded from.
 
-  Since all modules found at the location of package and below are
-  considered, a traversal of the entire directory structure is
-  needed. This can be an expansive operation if your path will contain
-  many subdirectories and/or files.
+  Args:
+    module: A module.
+
+  Returns:
+    The path of the module's source file if it has one, otherwise the path of
+    its compiled file, or None for built-in modules.
+  """
+  path = getattr(module, '__file__', None)
+  if not isinstance(path, basestring):
+    return None
+  if path.endswith('.pyc') or path.endswith('.pyo'):
+    if os.path.exists(path[:-1]):
+      return path[:-1]
+  return path
 
-  You can limit the depth of the traveral with the depth argument. 1
-  means only the first level is considered, 2, the first and the
-  second level is considered, and so on. A value of 0 indicates that
-  the entire directory tree should be traversed.
+
+def _get_file_digest(path):
+  """Gets the MD5 digest of a file's content.
 
   Args:
-    packagename: The name of the package, e.g., package.subpackage.
-    module_pattern: The pattern of modules to look at.
-    depth: Maximum depth of directory traversal.
+    path: The path of the file.
 
   Returns:
-    A list of full names of modules in this package that match the pattern.
+    The hex digest, or None if the file cannot be read.
+  """
+  try:
+    f = open(path, 'rb')
+    try:
+      return hashlib.md5(f.read()).hexdigest()
+    finally:
+      f.close()
+  except IOError:
+    return None
+
+
+def _track_module_source(module):
+  """Remembers which source a module was loaded from.
+
+  Args:
+    module: The module that was just loaded.
+  """
+  path = _get_module_source_path(module)
+  if path:
+    _MODULE_SOURCES[module.__name__] = (path, _get_mtime(path),
+                                        _get_file_digest(path))
+
+
+def _track_new_module_sources(fullname, new_names):
+  """Remembers the sources of modules that were loaded by an import.
+
+  Only modules in the same top-level package as the imported module are
+  tracked, which includes helper modules of tests but not the libraries they
+  use.
+
+  Args:
+    fullname: The full name of the module that was imported.
+    new_names: The names of the modules that the import added to sys.modules.
+  """
+  top_level_name = fullname.split('.')[0]
+  for module_name in new_names:
+    module = sys.modules.get(module_name)
+    if module is not None and _is_prefix(top_level_name, module_name):
+      _track_module_source(module)
+
+
+def _is_module_source_changed(module_name):
+  """Determines whether a tracked module's source changed since it was loaded.
+
+  Touching a file without changing its content does not count as a change.
+
+  Args:
+    module_name: The full name of a module in _MODULE_SOURCES.
+
+  Returns:
+    True if the source was modified or removed, False otherwise.
+  """
+  path, mtime, digest = _MODULE_SOURCES[module_name]
+  current_mtime = _get_mtime(path)
+  if current_mtime == mtime:
+    return False
+  current_digest = _get_file_digest(path)
+  if current_digest is not None and current_digest == digest:
+    _MODULE_SOURCES[module_name] = (path, current_mtime, digest)
+    return False
+  return True
+
+
+def _get_referenced_module_names(module):
+  """Gets the names of modules that a module depends on.
+
+  These are the modules it refers to in its namespace (the modules it imported
+  plus the modules of the classes and functions it imported from other
+  modules), and, if the source can be parsed, the modules its source imports.
+
+  Args:
+    module: A module.
+
+  Returns:
+    A set of full module names.
+  """
+  names = set()
+  submodule_prefix = module.__name__ + '.'
+  for value in module.__dict__.values():
+    if isinstance(value, types.ModuleType):
+      # Packages refer to their submodules without depending on them.
+      if not value.__name__.startswith(submodule_prefix):
+        names.add(value.__name__)
+      continue
+    try:
+      name = getattr(value, '__module__', None)
+    # Arbitrary objects might raise anything - pylint: disable-msg=W0703
+    except Exception:
+      continue
+    if isinstance(name, basestring):
+      names.add(name)
+  source = _MODULE_SOURCES.get(module.__name__)
+  if source and source[0].endswith('.py'):
+    names.update(static_discovery.get_imported_module_names(module.__name__,
+                                                            source[0]))
+  names.discard(module.__name__)
+  return names
+
+
+def _reload_module(module_name):
+  """Reloads a test module from scratch.
+
+  Unlike reload(), this removes everything the old source defined first, so
+  tests that were deleted from the source disappear.  The module object itself
+  is kept, so code that still refers to the old module keeps working.
+
+  Args:
+    module_name: The full name of a loaded module.
+  """
+  module = sys.modules[module_name]
+  namespace = module.__dict__
+  for name in namespace.keys():
+    if name not in _KEPT_MODULE_ATTRIBUTES:
+      del namespace[name]
+  try:
+    reload(module)
+    _track_module_source(module)
+  # pylint: disable-msg=W0703
+  except:
+    # Import the module again when it is needed, so the error is reported by
+    # load_module_from_module_name().
+    sys.modules.pop(module_name, None)
+    _MODULE_SOURCES.pop(module_name, None)
+
+
+def reload_changed_test_modules(conf):
+  """Reloads loaded test modules whose source changed since they were loaded.
+
+  Modules in the configured test packages which refer to a changed module
+  (e.g. by importing it or something from it) are reloaded as well, after the
+  modules they depend on.  Modules whose source was removed are unloaded.
+  Everything the name index knows about the reloaded modules is forgotten, so
+  later lookups see the new tests.
+
+  Only modules that changed are imported again, which is much faster than
+  restarting the instance to pick up changes.
+
+  Args:
+    conf: The configuration to use.
+
+  Returns:
+    A list of the full names of the modules that were reloaded or unloaded, in
+    the order they were reloaded.
 
   Raises:
     TypeError: Wrong input arguments.
-    ValueError: If depth is smaller than 0.
   """
-  utils.check_type(packagename, 'packagename', str)
-  utils.check_type(module_pattern, 'module_pattern', str)
-  utils.check_type(depth, 'depth', int)
-  if depth < 0:
-    raise ValueError('"depth" must be at least 0.')
-  path = get_abs_path_from_package_name(packagename)
-  if not path:
-    return []
+  utils.check_type(conf, 'conf', config.Config)
+  _RELOAD_LOCK.acquire()
+  try:
+    modules = {}
+    for module_name, module in sys.modules.items():
+      if module is not None and _is_in_test_package(module_name, conf):
+        modules[module_name] = module
+        if module_name not in _MODULE_SOURCES:
+          _track_module_source(module)
+    changed = [module_name for module_name in sorted(modules)
+               if module_name in _MODULE_SOURCES and
+               _is_module_source_changed(module_name)]
+    # Find dependents one level at a time, so that every module is reloaded
+    # after the modules it refers to.
+    affected = set(changed)
+    ordered = list(changed)
+    level = changed
+    while level:
+      level_names = set(level)
+      level = [module_name for module_name in sorted(modules)
+               if module_name not in affected and
+               _get_referenced_module_names(modules[module_name]) &
+               level_names]
+      affected.update(level)
+      ordered.extend(level)
+    for module_name in ordered:
+      source = _MODULE_SOURCES.get(module_name)
+      if source and _get_mtime(source[0]) is None:
+        # The module's source was removed.
+        sys.modules.pop(module_name, None)
+        _MODULE_SOURCES.pop(module_name, None)
+      else:
+        _reload_module(module_name)
+      for index in _NAME_INDEXES.values():
+        index.remove_prefix(module_name)
+    if ordered:
+      # The reloaded modules may define objects that were missing before.
+      for index in _NAME_INDEXES.values():
+        index.clear_missing()
+      logging.info('[aeta] Reloaded changed test modules: %s',
+                   ', '.join(ordered))
+    return ordered
+  finally:
+    _RELOAD_LOCK.release()
+
+
+def _get_compiled_pattern(pattern):
+  """Gets a compiled regular expression, compiling it only once.
+
+  Args:
+    pattern: The regular expression string.
+
+  Returns:
+    The compiled regular expression object.
+  """
+  compiled = _COMPILED_PATTERNS.get(pattern)
+  if compiled is None:
+    compiled = re.compile(pattern)
+    _COMPILED_PATTERNS[pattern] = compiled
+  return compiled
+
+
+def _get_mtime(path):
+  """Gets the modification time of a file or directory.
+
+  Args:
+    path: The path of the file or directory.
+
+  Returns:
+    The modification time, or None if the path does not exist.
+  """
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+
+def _is_module_index_valid(dir_mtimes):
+  """Determines whether a cached module index is still up to date.
+
+  Args:
+    dir_mtimes: A dictionary mapping every directory that was traversed to
+        build the index to its modification time at that point.
+
+  Returns:
+    True if no directory was modified since the index was built, False
+    otherwise.
+  """
+  for dir_path, mtime in dir_mtimes.iteritems():
+    if _get_mtime(dir_path) != mtime:
+      return False
+  return True
+
+
+# TODO(schuppe): too many local variables - pylint: disable-msg=R0914,R0912
+def _find_module_names_in_path(packagename, path, module_pattern, depth):
+  """Walks the directory of a package to find matching modules.
+
+  Args:
+    packagename: The name of the package, e.g., package.subpackage.
+    path: The absolute path of the package directory.
+    module_pattern: The pattern of modules to look at.
+    depth: Maximum depth of directory traversal, or 0 for no limit.
+
+  Returns:
+    A (dir_mtimes, module_names) tuple.  'dir_mtimes' maps every directory
+    which was traversed to its modification time, 'module_names' is a sorted
+    list of full names of modules in this package that match the pattern.
+  """
+  compiled_pattern = _get_compiled_pattern(module_pattern)
   path_default_depth = len([x for x in path.split(os.sep) if x])
   res = []
+  dir_mtimes = {}
   packagename_split = packagename.split('.')
   path_split = path.split(os.sep)
-  for root, _, files in os.walk(path):
+  for root, dirs, files in os.walk(path):
     if depth != 0:
       current_depth = len([x for x in root.split(os.sep) if x])
       if current_depth >= path_default_depth + depth:
+        # Nothing below this directory is considered either.
+        del dirs[:]
         continue
+    dir_mtimes[root] = _get_mtime(root)
+    files = set(files)
     for file_ in files:
       short_modulename, ext = os.path.splitext(file_)
       # Only Python modules should be considered and they should be
@@ -571,14 +1193,14 @@ def get_module_names_in_package(packagename, module_pattern, depth=0):
         if ext != '.pyc':
           # If it is not a source file nor a compiled file, we ignore it.
           continue
-        if ext == '.pyc' and os.path.isfile(os.path.join(root, file_[:-1])):
+        if file_[:-1] in files:
           # If it is a compiled file and there is a source file, too,
           # we ignore this file, because we are using the source file
           # already.
           continue
       # In addition, only modules matching a certain pattern will be
       # loaded.
-      if re.match(module_pattern, short_modulename):
+      if compiled_pattern.match(short_modulename):
         # The module name = packagename + diff between path and root
         # (=subpackage name) + current file's name.
         root_split = root.split(os.sep)
@@ -590,7 +1212,92 @@ def get_module_names_in_package(packagename, module_pattern, depth=0):
         modulename = '.'.join(module_split + [short_modulename])
         res.append(modulename)
   res.sort()
-  return res
+  return dir_mtimes, res
+
+
+def get_module_names_in_package(packagename, module_pattern, depth=0):
+  """Get names of all modules in the package that match module_pattern.
+
+  Since all modules found at the location of package and below are
+  considered, a traversal of the entire directory structure is
+  needed. This can be an expansive operation if your path will contain
+  many subdirectories and/or files.
+
+  To avoid repeating this traversal, the result is kept in an index for the
+  lifetime of the instance.  The index is invalidated as soon as any of the
+  traversed directories is modified, so later calls only need to stat the
+  directories rather than list and match all the files in them.
+
+  You can limit the depth of the traveral with the depth argument. 1
+  means only the first level is considered, 2, the first and the
+  second level is considered, and so on. A value of 0 indicates that
+  the entire directory tree should be traversed.
+
+  Args:
+    packagename: The name of the package, e.g., package.subpackage.
+    module_pattern: The pattern of modules to look at.
+    depth: Maximum depth of directory traversal.
+
+  Returns:
+    A list of full names of modules in this package that match the pattern.
+
+  Raises:
+    TypeError: Wrong input arguments.
+    ValueError: If depth is smaller than 0.
+  """
+  utils.check_type(packagename, 'packagename', str)
+  utils.check_type(module_pattern, 'module_pattern', str)
+  utils.check_type(depth, 'depth', int)
+  if depth < 0:
+    raise ValueError('"depth" must be at least 0.')
+  path = get_abs_path_from_package_name(packagename)
+  if not path:
+    return []
+  return list(_get_module_index(packagename, path, module_pattern, depth)[1])
+
+
+def _get_module_index(packagename, path, module_pattern, depth):
+  """Gets the modules of a package, reusing the cached index if it is valid.
+
+  Args:
+    packagename: The name of the package, e.g., package.subpackage.
+    path: The absolute path of the package directory.
+    module_pattern: The pattern of modules to look at.
+    depth: Maximum depth of directory traversal, or 0 for no limit.
+
+  Returns:
+    A (dir_mtimes, module_names) tuple as returned by
+    _find_module_names_in_path.  Do not modify it.
+  """
+  index_key = (packagename, path, module_pattern, depth)
+  cached = _MODULE_NAMES_CACHE.get(index_key)
+  if not (cached and _is_module_index_valid(cached[0])):
+    cached = _find_module_names_in_path(packagename, path, module_pattern,
+                                        depth)
+    _MODULE_NAMES_CACHE[index_key] = cached
+  return cached
+
+
+def _get_package_dir_mtimes(fullname, conf):
+  """Gets the modification times of the directories of a name's test package.
+
+  Args:
+    fullname: The name of a test object.
+    conf: The configuration to use.
+
+  Returns:
+    A dictionary mapping the directories of the configured test packages that
+    contain fullname to their modification times.
+  """
+  dir_mtimes = {}
+  for package_name in conf.test_package_names:
+    if not _is_prefix(package_name, fullname):
+      continue
+    path = get_abs_path_from_package_name(package_name)
+    if path:
+      dir_mtimes.update(_get_module_index(package_name, path,
+                                          conf.test_module_pattern, 0)[0])
+  return dir_mtimes
 
 
 def _is_prefix(prefix, name):
@@ -623,9 +1330,75 @@ def _is_in_test_package(fullname, conf):
   return any(_is_prefix(p, fullname) for p in conf.test_package_names)
 
 
+def _get_static_module_info(module_name, conf):
+  """Gets statically determined test information about a module.
+
+  Args:
+    module_name: The full name of the module.
+    conf: The configuration to use.
+
+  Returns:
+    A static_discovery.ModuleInfo, or None if the module has to be imported
+    to find its tests.
+  """
+  if not static_discovery.is_available():
+    return None
+  location = static_discovery.locate_module(module_name)
+  if not location:
+    return None
+  found_name, path, is_package, _ = location
+  if found_name != module_name or is_package or not path:
+    return None
+  info = static_discovery.get_module_info(
+      module_name, path, include_test_functions=conf.include_test_functions)
+  if info.is_dynamic:
+    return None
+  return info
+
+
+def _get_static_requested_object(fullname, conf):
+  """Gets a TestObject without importing test modules, if possible.
+
+  Args:
+    fullname: Name of the object, e.g. package.module.class.method.
+    conf: The configuration to use.
+
+  Returns:
+    A Package, StaticModule, StaticClass, or StaticMethod, or None if the
+    object has to be found by importing its module.
+  """
+  if not static_discovery.is_available():
+    return None
+  location = static_discovery.locate_module(fullname)
+  if not location:
+    return None
+  module_name, _, is_package, rest = location
+  if is_package:
+    if rest:
+      return None
+    return Package(fullname)
+  info = _get_static_module_info(module_name, conf)
+  if not info:
+    return None
+  if not rest:
+    return StaticModule(fullname, info)
+  class_info = info.classes.get(rest[0])
+  if not class_info:
+    return None
+  if len(rest) == 1:
+    return StaticClass(fullname, class_info)
+  if len(rest) == 2 and rest[1] in class_info.method_names:
+    return StaticMethod(fullname)
+  return None
+
+
 def get_requested_object(fullname, conf):
   """Gets the TestObject with the particular name.
 
+  If conf.static_discovery is set, test modules are parsed rather than
+  imported where possible.  If conf.reload_changed_modules is set, test modules
+  that changed since they were loaded are reloaded first.
+
   Args:
     fullname: Name of the object, e.g. package.module.class.method.
     conf: The configuration to use.
@@ -639,12 +1412,114 @@ def get_requested_object(fullname, conf):
   """
   utils.check_type(fullname, 'fullname', str)
   utils.check_type(conf, 'conf', config.Config)
+  if conf.reload_changed_modules:
+    reload_changed_test_modules(conf)
   if not fullname:
     return Root()
   if not _is_in_test_package(fullname, conf):
     msg = ('Test object %s is not contained in one of the configured '
            'test_package_names in aeta.yaml.' % fullname)
     return BadTest(fullname, False, [(fullname, msg)])
+  if conf.static_discovery:
+    obj = _get_static_requested_object(fullname, conf)
+    if obj:
+      return obj
+  return _import_requested_object(fullname, conf)
+
+
+def _import_requested_object(fullname, conf):
+  """Gets the TestObject with the particular name by importing its module.
+
+  Names that have been seen before, either while finding tests or by an earlier
+  call, are looked up in the name index so that only the module that contains
+  the object has to be loaded, or nothing if the name was not found before.
+  Other names are resolved by trying to import them (see
+  _guess_requested_object) and the result is added to the index.
+
+  Args:
+    fullname: Name of the object, e.g. package.module.class.method.
+    conf: The configuration to use.
+
+  Returns:
+    A TestObject, which might be BadTest if the object cannot be found or
+        loaded correctly.
+  """
+  index = _get_name_index(conf)
+  if index.is_missing(fullname):
+    return BadTest(fullname, False,
+                   [(fullname, 'No test object %s.' % fullname)])
+  entry = index.get(fullname)
+  if entry:
+    test = _get_indexed_object(fullname, entry, conf)
+    if test:
+      return test
+    # The index is out of date, e.g. because a module changed.
+    index.remove_prefix(fullname)
+  test = _guess_requested_object(fullname, conf)
+  if isinstance(test, Package):
+    index.add(fullname, _IndexEntry('package'))
+  elif isinstance(test, Module):
+    index.add(fullname, _IndexEntry('module', fullname))
+  elif isinstance(test, Class):
+    module_name, class_name = fullname.rsplit('.', 1)
+    index.add(fullname, _IndexEntry('class', module_name, class_name))
+  elif isinstance(test, Method):
+    module_name, class_name, _ = fullname.rsplit('.', 2)
+    index.add(fullname, _IndexEntry('method', module_name, class_name))
+  elif isinstance(test, BadTest) and not test.exists:
+    index.add_missing(fullname, _get_package_dir_mtimes(fullname, conf))
+  return test
+
+
+def _get_indexed_object(fullname, entry, conf):
+  """Gets the TestObject described by an entry of the name index.
+
+  Args:
+    fullname: Name of the object, e.g. package.module.class.method.
+    entry: The _IndexEntry for fullname.
+    conf: The configuration to use.
+
+  Returns:
+    A TestObject, or None if the object does not match the entry anymore.
+  """
+  if entry.kind == 'package':
+    return Package(fullname)
+  errors_out = []
+  module = load_module_from_module_name(
+      entry.module_name, errors_out, include_import_error=True,
+      include_test_functions=conf.include_test_functions)
+  if errors_out:
+    return BadTest(fullname, True, errors_out)
+  if not module:
+    return None
+  if entry.kind == 'module':
+    return Module(fullname, module)
+  cls = getattr(module, entry.class_name, None)
+  if not (cls and inspect.isclass(cls)):
+    return None
+  if entry.kind == 'class':
+    return Class(fullname, cls)
+  method_name = fullname.rsplit('.', 1)[1]
+  method = getattr(cls, method_name, None)
+  if not (method and inspect.ismethod(method)):
+    return None
+  return Method(fullname, cls, method_name)
+
+
+def _guess_requested_object(fullname, conf):
+  """Gets the TestObject with the particular name by trying to import it.
+
+  The name is tried as a package or module, then as a class, and finally as a
+  method.
+
+  Args:
+    fullname: Name of the object, e.g. package.module.class.method.
+    conf: The configuration to use.
+
+  Returns:
+    A TestObject, which might be BadTest if the object cannot be found or
+        loaded correctly.
+  """
   errors_out = []
   # package or module
   module = load_module_from_module_name(
@@ -682,3 +1557,341 @@ def get_requested_object(fullname, conf):
   return BadTest(fullname, False,
                  [(fullname, 'No test object %s.' % fullname)])
 
+
+def get_estimated_secs(methods, durations):
+  """Estimates how long it takes to run test methods in a single unit.
+
+  Args:
+    methods: A list of Method objects, e.g. as returned by get_methods().
+    durations: A dictionary mapping full names of test methods to how long
+        they take to run in seconds, and full names of modules and classes to
+        how long their setUpModule/tearDownModule or setUpClass/tearDownClass
+        fixtures take.
+
+  Returns:
+    The estimated duration in seconds.  Methods without a recorded duration
+    are assumed to take _DEFAULT_METHOD_SECS.
+  """
+  secs = 0.0
+  # Fixtures run once per unit for all modules and classes containing one of
+  # the methods.
+  containers = set()
+  for method in methods:
+    secs += durations.get(method.fullname, _DEFAULT_METHOD_SECS)
+    parts = method.fullname.split('.')
+    for i in range(1, len(parts)):
+      containers.add('.'.join(parts[:i]))
+  for name in containers:
+    secs += durations.get(name, 0)
+  return secs
+
+
+def partition_units(test, conf, durations, target_secs, errors_out=None):
+  """Splits a test object into units that take about the same time to run.
+
+  This is an alternative to get_unit_methods() that ignores the
+  parallelize_{modules,classes,methods} options.  A test object is run as a
+  single unit if it is estimated to finish within target_secs, so fast
+  siblings stay together in their parent's unit.  Slower objects are split
+  into their children, down to single methods if necessary, unless that would
+  split up a module or class with fixtures (see TestObject.get_units).
+
+  Args:
+    test: The TestObject to split.
+    conf: The configuration to use.
+    durations: A dictionary of durations as accepted by get_estimated_secs().
+    target_secs: The desired duration of a unit in seconds.
+    errors_out: A list to which import error tracebacks are appended, or None
+        to ignore errors.
+
+  Returns:
+    A list of (unit, methods) tuples like get_unit_methods() returns.  Units
+    without any test methods are left out.
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(test, 'test', TestObject)
+  utils.check_type(durations, 'durations', dict)
+  utils.check_type(target_secs, 'target_secs', (int, float))
+  unit_methods = []
+  _partition_units(test, conf, durations, target_secs, errors_out,
+                   unit_methods)
+  return unit_methods
+
+
+def _partition_units(test, conf, durations, target_secs, errors_out,
+                     unit_methods_out):
+  """Appends the units of a test object as described in partition_units()."""
+  if not isinstance(test, TestContainer):
+    unit_methods_out.extend(test.get_unit_methods(conf, errors_out))
+    return
+  # Errors of objects that are not split up will be reported when the unit
+  # is run.
+  methods = test.get_methods(conf)
+  if not methods:
+    return
+  if (not test.can_split() or
+      get_estimated_secs(methods, durations) <= target_secs):
+    unit_methods_out.append((test, methods))
+    return
+  for child in test.get_children(conf, errors_out):
+    _partition_units(child, conf, durations, target_secs, errors_out,
+                     unit_methods_out)
+
+
+def get_shard(unit_methods, shard_index, shard_count, durations=None):
+  """Selects the test units that belong to one shard of a batch.
+
+  Sharding lets independent executors (e.g. several versions of an app, or
+  several CI workers) each run a disjoint part of the same tests.  Every
+  executor has to find the same units and use the same shard_count.
+
+  If durations are given, units are distributed by their estimated duration so
+  that all shards take about the same time: the longest units are assigned
+  first, each to the shard with the least work so far.  Shards are then only
+  disjoint if all executors use the same durations.  Otherwise, units are
+  assigned by a stable hash of their name, which does not depend on anything
+  but the name.
+
+  Args:
+    unit_methods: A list of (unit, methods) tuples, e.g. as returned by
+        get_unit_methods().
+    shard_index: The index of the shard to select, in [0, shard_count).
+    shard_count: How many shards the units are split into.
+    durations: A dictionary of durations as accepted by get_estimated_secs(),
+        or None to assign units by hash.
+
+  Returns:
+    The (unit, methods) tuples of the shard, in their original order.
+
+  Raises:
+    TypeError: Wrong input arguments.
+    ValueError: If shard_index is not in [0, shard_count).
+  """
+  utils.check_type(unit_methods, 'unit_methods', list)
+  utils.check_type(shard_index, 'shard_index', int)
+  utils.check_type(shard_count, 'shard_count', int)
+  utils.check_type(durations, 'durations', (types.NoneType, dict))
+  if not 0 <= shard_index < shard_count:
+    raise ValueError('shard_index must be at least 0 and under shard_count '
+                     '(%s) but is %s.' % (shard_count, shard_index))
+  if shard_count == 1:
+    return list(unit_methods)
+  if durations is None:
+    return [(unit, methods) for (unit, methods) in unit_methods
+            if _get_name_hash(unit.fullname) % shard_count == shard_index]
+  costs = sorted((-get_estimated_secs(methods, durations), unit.fullname)
+                 for (unit, methods) in unit_methods)
+  shard_secs = [0.0] * shard_count
+  selected = set()
+  for (neg_secs, fullname) in costs:
+    shard = shard_secs.index(min(shard_secs))
+    shard_secs[shard] -= neg_secs
+    if shard == shard_index:
+      selected.add(fullname)
+  return [(unit, methods) for (unit, methods) in unit_methods
+          if unit.fullname in selected]
+
+
+def _get_name_hash(fullname):
+  """Gets a hash of a name that is the same in every process.
+
+  Args:
+    fullname: The name to hash.
+
+  Returns:
+    A non-negative integer.
+  """
+  return int(hashlib.md5(fullname).hexdigest()[:8], 16)
+
+
+def _get_app_roots(conf):
+  """Gets the directories that contain the application's own modules.
+
+  These are the directories that contain the top-level packages of the
+  configured test packages, i.e. usually the application's root directory.
+
+  Args:
+    conf: The configuration to use.
+
+  Returns:
+    A sorted list of absolute directory paths.
+  """
+  roots = set()
+  for package_name in conf.test_package_names:
+    location = static_discovery.locate_module(package_name.split('.')[0])
+    if location and location[1]:
+      path = os.path.abspath(location[1]).rstrip(os.sep)
+      roots.add(os.path.dirname(path))
+  return sorted(roots)
+
+
+def _is_in_roots(path, roots):
+  """Determines whether a path is inside one of several directories.
+
+  Args:
+    path: An absolute path.
+    roots: A list of absolute directory paths.
+
+  Returns:
+    True if the path is in one of the directories, False otherwise.
+  """
+  return any(path.startswith(os.path.join(root, '')) for root in roots)
+
+
+def _locate_module_source(module_name, paths_cache):
+  """Finds the source file of a module without importing it.
+
+  Args:
+    module_name: The full name of a module or package.
+    paths_cache: A dictionary of previous results by module name.
+
+  Returns:
+    The absolute path of the module's source file (or the package's
+    __init__.py), or None if there is no such module or it has no source.
+  """
+  if module_name in paths_cache:
+    return paths_cache[module_name]
+  path = None
+  location = static_discovery.locate_module(module_name)
+  if location and location[0] == module_name and location[1]:
+    path = location[1]
+    if location[2]:
+      path = os.path.join(path, '__init__.py')
+    if path.endswith('.py') and os.path.exists(path):
+      path = os.path.normpath(os.path.abspath(path))
+    else:
+      path = None
+  paths_cache[module_name] = path
+  return path
+
+
+def _get_parent_names(module_name):
+  """Gets the names of the packages containing a module.
+
+  Args:
+    module_name: The full name of a module.
+
+  Returns:
+    A list of package names, outermost first.
+  """
+  parts = module_name.split('.')
+  return ['.'.join(parts[:i]) for i in range(1, len(parts))]
+
+
+def _get_direct_dependencies(module_name, path):
+  """Gets the names of the modules that importing a module imports directly.
+
+  These are the modules its source imports, as well as the packages containing
+  them and the module itself.  Results are cached for as long as the source
+  file is not modified.  Modules that were first loaded when the module was
+  imported are added as well, which catches imports the source does not show.
+
+  Args:
+    module_name: The full name of the module.
+    path: The path of the module's source file.
+
+  Returns:
+    A set of candidate module names, which might include names that are not
+    modules (see static_discovery.get_imported_module_names()).
+  """
+  mtime = _get_mtime(path)
+  cached = _DEPENDENCIES_CACHE.get(path)
+  if cached and cached[0] == module_name and cached[1] == mtime:
+    names = cached[2]
+  else:
+    names = set(_get_parent_names(module_name))
+    for name in static_discovery.get_imported_module_names(module_name, path):
+      names.add(name)
+      names.update(_get_parent_names(name))
+    _DEPENDENCIES_CACHE[path] = (module_name, mtime, names)
+  imported = _IMPORTED_MODULE_NAMES.get(module_name)
+  if imported:
+    names = names.union(imported)
+  return names
+
+
+def get_affected_unit_methods(unit_methods, changed_paths, conf):
+  """Selects the test units that might be affected by changes to source files.
+
+  A unit is affected if one of the modules containing its methods imports one
+  of the changed files, directly or through other modules of the application.
+  Imports are found by analyzing the source of the modules, and by recording
+  which modules were loaded when a test module was imported.  Only modules in
+  the application's directories (see _get_app_roots()) are followed, so
+  changes to the standard library or the SDK are not detected.  Files that are
+  not Python sources (e.g. templates or data files) never affect any test.
+
+  Args:
+    unit_methods: A list of (unit, methods) tuples, e.g. as returned by
+        get_unit_methods().
+    changed_paths: A list of paths of changed files.  Relative paths are
+        relative to the application's root directory.
+    conf: The configuration to use.
+
+  Returns:
+    The (unit, methods) tuples of the affected units, in their original order.
+    Units whose module cannot be found are always included.
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(unit_methods, 'unit_methods', list)
+  utils.check_type(changed_paths, 'changed_paths', list)
+  utils.check_type(conf, 'conf', config.Config)
+  roots = _get_app_roots(conf)
+  changed = set()
+  for path in changed_paths:
+    if path.endswith('.pyc'):
+      path = path[:-1]
+    if os.path.isabs(path):
+      candidates = [path]
+    else:
+      candidates = [os.path.join(root, path) for root in roots]
+    changed.update(os.path.normpath(os.path.abspath(candidate))
+                   for candidate in candidates)
+  paths_cache = {}
+  unit_module_names = []
+  for (unit, methods) in unit_methods:
+    # Methods are always named module.class.method.
+    names = set(method.fullname.rsplit('.', 2)[0] for method in methods)
+    if not names:
+      location = static_discovery.locate_module(unit.fullname)
+      if location:
+        names.add(location[0])
+    unit_module_names.append(names)
+  # Find all modules of the application that the units' modules depend on.
+  dependents = {}
+  affected = set()
+  visited = set()
+  for names in unit_module_names:
+    visited.update(names)
+  to_visit = list(visited)
+  while to_visit:
+    module_name = to_visit.pop()
+    path = _locate_module_source(module_name, paths_cache)
+    if not path or not _is_in_roots(path, roots):
+      continue
+    if path in changed:
+      affected.add(module_name)
+    for name in _get_direct_dependencies(module_name, path):
+      if name == module_name:
+        continue
+      dependents.setdefault(name, set()).add(module_name)
+      if name not in visited:
+        visited.add(name)
+        to_visit.append(name)
+  # Everything that depends on a changed module is affected as well.
+  to_visit = list(affected)
+  while to_visit:
+    for name in dependents.get(to_visit.pop(), ()):
+      if name not in affected:
+        affected.add(name)
+        to_visit.append(name)
+  selected = []
+  for ((unit, methods), names) in zip(unit_methods, unit_module_names):
+    if (not names or names & affected or
+        not all(_locate_module_source(name, paths_cache) for name in names)):
+      selected.append((unit, methods))
+  return selected
@@ -33,10 +33,14 @@ try:
 except ImportError:
   import simplejson as json
 
-from aeta import task_deferred as deferred
 from aeta import utils
 
-__all__ = ['TestBatch', 'RunTestUnitTask', 'get_ctx_options']
+__all__ = ['TestBatch', 'BatchStatus', 'BatchProgress', 'ProgressShard',
+           'RunTestUnitTask', 'UnitCheckpoint', 'MethodResultChunk',
+           'StoredBlob', 'TestDuration', 'get_ctx_options', 'is_immediate',
+           'record_test_durations', 'get_test_durations',
+           'get_method_result_chunks', 'record_unit_summary',
+           'get_batch_summary', 'get_finished_units']
 
 
 # The maximum size of a JSON object in a JsonHolder.  Since memcache and the
@@ -44,8 +48,15 @@ __all__ = ['TestBatch', 'RunTestUnitTask', 'get_ctx_options']
 # 1MB.
 _MAX_JSON_BYTES = 1024 * 1000
 
-# How long to wait between attempts to delete dead blobs.
-_DELETE_BLOB_TIME_SECS = 10 * 60
+# How many of the most recent durations a TestDuration keeps.
+_NUM_RECENT_DURATIONS = 20
+
+# How many ProgressShards the summaries of the test units of a batch are spread
+# over.
+_NUM_PROGRESS_SHARDS = 8
+
+# The counts in the summary of a test unit, see ProgressShard.
+_SUMMARY_COUNTS = ['passes', 'failures', 'errors', 'skips', 'load_errors']
 
 
 class JsonHolder(ndb.Model):
@@ -67,8 +78,8 @@ class JsonHolder(ndb.Model):
   def set_json(self, json_obj, conf):
     """Sets the JSON value of this object.
 
-    If the JSON value is stored in the Blobstore, a task will be added to
-    eventually delete the blob.
+    If the JSON value is stored in the Blobstore, a StoredBlob is put so that
+    the blob is eventually deleted along with its TestBatch.
 
     Note that you also have to put() the model after calling this function to
     actually update it.
@@ -92,8 +103,7 @@ class JsonHolder(ndb.Model):
         f.write(data)
       files.finalize(file_name)
       self.blob_key = files.blobstore.get_blob_key(file_name)
-      deferred.defer(_delete_blob_if_done, self.key, self.blob_key, conf,
-                     _queue=conf.test_queue, _countdown=_DELETE_BLOB_TIME_SECS)
+      StoredBlob(key=StoredBlob.get_key(self.key, self.blob_key)).put()
 
   def get_json(self):
     """Gets the JSON value of this object.
@@ -112,6 +122,16 @@ class JsonHolder(ndb.Model):
         f.close()
     return json_obj
 
+  def has_json(self):
+    """Determines whether the JSON value of this object has been set.
+
+    Unlike get_json(), this never reads from the Blobstore.
+
+    Returns:
+      True if set_json() was called for this object, False otherwise.
+    """
+    return self.data is not None or bool(self.blob_key)
+
 
 class TestBatch(JsonHolder):
   """A collection of tests to be run at once.
@@ -152,7 +172,8 @@ class TestBatch(JsonHolder):
       keys.append(RunTestUnitTask.get_key(self.key, i))
     return ndb.get_multi(keys, **get_ctx_options(conf))
 
-  def set_info(self, load_errors, test_unit_methods, conf):
+  def set_info(self, load_errors, test_unit_methods, conf,
+               import_profile=None):
     """Sets batch information.
 
     This information can be retrieved as JSON using get_json().  This will also
@@ -163,6 +184,9 @@ class TestBatch(JsonHolder):
       test_unit_methods: A mapping from test unit fullname to a list of method
           fullnames in that object.
       conf: The configuration to use.
+      import_profile: The profile of imports while finding the tests, as
+          returned by ImportProfiler.get_profile_json(), or None if imports
+          were not profiled.  If given, it is stored as 'import_profile'.
     """
     utils.check_type(load_errors, 'load_errors', list)
     utils.check_type(test_unit_methods, 'test_unit_methods', dict)
@@ -171,17 +195,142 @@ class TestBatch(JsonHolder):
             'load_errors': load_errors,
             'test_unit_methods': test_unit_methods,
            }
+    if import_profile is not None:
+      data['import_profile'] = import_profile
     self.set_json(data, conf)
 
 
+class BatchStatus(ndb.Model):
+  """The state of a TestBatch that can change while its tests are running.
+
+  It is kept apart from the TestBatch so that every task can check it without
+  reading the batch's data.  A batch without a BatchStatus runs normally.
+  Always set the key to the return value of get_key.
+
+  Attributes:
+    fail_fast: Whether to abort the batch once a test unit has an error or
+        failure.
+    aborted: Whether the batch was aborted.  Test units that did not start
+        yet are skipped then.
+    cancelled: Whether the batch was cancelled.  Its other entities are
+        deleted then, and tasks that are still running do not store anything.
+    max_reruns: How many times test methods that fail or cause an error are
+        run again to tell flaky tests from consistently failing ones.
+  """
+  fail_fast = ndb.BooleanProperty(default=False, indexed=False)
+  aborted = ndb.BooleanProperty(default=False, indexed=False)
+  cancelled = ndb.BooleanProperty(default=False, indexed=False)
+  max_reruns = ndb.IntegerProperty(default=0, indexed=False)
+
+  @classmethod
+  def get_key(cls, batch_key):
+    """Gets the key of the BatchStatus of a TestBatch.
+
+    Args:
+      batch_key: The key to the TestBatch.
+
+    Returns:
+      A ndb.Key instance corresponding to the BatchStatus.
+    """
+    utils.check_type(batch_key, 'batch_key', ndb.Key)
+    return ndb.Key(cls, 'status', parent=batch_key)
+
+
+class BatchProgress(ndb.Model):
+  """When a TestBatch last made progress.
+
+  Batches that have not made progress for conf.batch_retention_secs are
+  deleted by cleanup.delete_old_batches(), which finds them by querying
+  BatchProgress entities instead of reading the batches.  It is written without
+  being read whenever the batch starts or a task stores results for it.  Like
+  ProgressShards, it is a root entity, so these writes do not contend with the
+  batch's entity group.  Always set the key to the return value of get_key.
+
+  Attributes:
+    last_progress: When the batch last made progress.
+  """
+  last_progress = ndb.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def get_key(cls, batch_key):
+    """Gets the key of the BatchProgress of a TestBatch.
+
+    Args:
+      batch_key: The key to the TestBatch.
+
+    Returns:
+      A ndb.Key instance corresponding to the BatchProgress.
+    """
+    utils.check_type(batch_key, 'batch_key', ndb.Key)
+    return ndb.Key(cls, batch_key.id())
+
+  @classmethod
+  def get_batch_key(cls, progress_key):
+    """Gets the key of the TestBatch whose progress a BatchProgress records.
+
+    Args:
+      progress_key: The key to the BatchProgress.
+
+    Returns:
+      A ndb.Key instance corresponding to the TestBatch.
+    """
+    utils.check_type(progress_key, 'progress_key', ndb.Key)
+    return ndb.Key(TestBatch, progress_key.id())
+
+
+class ProgressShard(ndb.Model):
+  """Summaries of the results of some finished test units of a TestBatch.
+
+  How far a batch is along can be told from its few ProgressShards, without
+  reading the results of all its units.  Each unit is summarized in the shard
+  given by its index, so units that finish at the same time rarely update the
+  same shard.  Shards are root entities, so they do not share an entity group
+  with each other or with the batch.  Summarizing a unit again (e.g. when its
+  task is retried) replaces its summary.  Always set the key to one of the
+  return values of get_keys.
+
+  Attributes:
+    units: A dictionary mapping the index of each summarized unit, as a
+        string, to a dictionary with the number of test methods that passed
+        ('passes'), failed ('failures'), caused an error ('errors') or were
+        skipped ('skips'), and the number of load errors ('load_errors').
+  """
+  units = ndb.JsonProperty(default=None)
+
+  @classmethod
+  def get_keys(cls, batch_key):
+    """Gets the keys of all ProgressShards of a TestBatch.
+
+    Args:
+      batch_key: The key to the TestBatch.
+
+    Returns:
+      A list of ndb.Key instances, where the unit with index i is summarized
+      in the shard with the key at index i % len(keys).
+    """
+    utils.check_type(batch_key, 'batch_key', ndb.Key)
+    return [ndb.Key(cls, '%s-%s' % (batch_key.id(), i))
+            for i in range(_NUM_PROGRESS_SHARDS)]
+
+
 class RunTestUnitTask(JsonHolder):
   """The state of a task that runs a single TestSuite in a batch of them.
 
   When creating a new RunTestUnitTask, always set its key to the return value
   of get_key.  This enables easy access to RunTestUnitTasks given their batch.
+  RunTestUnitTasks are root entities whose ids are made of the batch id and
+  the unit's index, so the units of a batch can store their results at the
+  same time without contending on one entity group.
 
   JSON data should be of the form returned by get_test_result_json(), or None
-  if the test has not finished running.
+  if the test has not finished running.  If the unit was not run (or not run
+  to the end) because its batch was aborted, the JSON also has
+  'skipped': True.  If failed test methods were run again, the JSON also has
+  'reruns': {'attempts': a dictionary mapping the full names of these methods
+                 to the list of their outcomes, the first run included,
+             'flaky': the names of the methods that passed when run again,
+             'failing': the names of the methods that failed every time}.
+  Flaky methods are not part of 'errors' and 'failures'.
 
   Attributes:
     fullname: The full name to the TestSuite being run.
@@ -202,9 +351,64 @@ class RunTestUnitTask(JsonHolder):
     """
     utils.check_type(batch_key, 'batch_key', ndb.Key)
     utils.check_type(index, 'index', int)
-    return ndb.Key(cls, str(index), parent=batch_key)
+    return ndb.Key(cls, '%s-%s' % (batch_key.id(), index))
+
+  @classmethod
+  def get_batch_key(cls, task_key):
+    """Gets the key of the TestBatch a RunTestUnitTask is part of.
+
+    Args:
+      task_key: The key to the RunTestUnitTask.
+
+    Returns:
+      A ndb.Key instance corresponding to the TestBatch.
+    """
+    utils.check_type(task_key, 'task_key', ndb.Key)
+    batch_id = task_key.id().rsplit('-', 1)[0]
+    # Batch ids are random strings (see utils.rand_unique_id), or integers
+    # allocated by the datastore.
+    if batch_id.isdigit():
+      batch_id = int(batch_id)
+    return ndb.Key(TestBatch, batch_id)
+
+  @classmethod
+  def get_index(cls, task_key):
+    """Gets the index of the unit of a RunTestUnitTask in its batch.
+
+    Args:
+      task_key: The key to the RunTestUnitTask.
+
+    Returns:
+      The integer index passed to get_key.
+    """
+    utils.check_type(task_key, 'task_key', ndb.Key)
+    return int(task_key.id().rsplit('-', 1)[1])
 
-  def set_test_result(self, load_errors, testresult, output, conf):
+  @classmethod
+  def query_unit_keys(cls, batch_key):
+    """Gets a query for the keys of all test units of a TestBatch.
+
+    Since the keys of descendants sort right after the key of their root,
+    the key range of the RunTestUnitTasks of the batch also covers the
+    entities stored under them (UnitCheckpoints, MethodResultChunks and
+    StoredBlobs).
+
+    Args:
+      batch_key: The key to the TestBatch.
+
+    Returns:
+      A kindless ndb.Query for the RunTestUnitTasks of the batch and their
+      descendants.
+    """
+    utils.check_type(batch_key, 'batch_key', ndb.Key)
+    # Task ids of the batch start with '<batch id>-', and '.' follows '-'.
+    start = ndb.Key(cls, '%s-' % batch_key.id())
+    end = ndb.Key(cls, '%s.' % batch_key.id())
+    return ndb.Query(filters=ndb.AND(ndb.FilterNode('__key__', '>=', start),
+                                     ndb.FilterNode('__key__', '<', end)))
+
+  def set_test_result(self, load_errors, testresult, output, conf,
+                      timings=None, import_profile=None):
     """Sets test result information.
 
     This information can be retrieved as JSON using get_json().
@@ -214,6 +418,33 @@ class RunTestUnitTask(JsonHolder):
       testresult: The unittest.TestResult for this test run.
       output: The output of print statements in the test.
       conf: The configuration to use.
+      timings: A JSON-convertible description of how long the tests took, or
+          None if they were not timed.  If given, it is stored as 'timings'.
+      import_profile: The profile of imports while loading and running the
+          tests, as returned by ImportProfiler.get_profile_json(), or None if
+          imports were not profiled.  If given, it is stored as
+          'import_profile'.
+    """
+    self.set_json(self.get_test_result_json(load_errors, testresult, output,
+                                            timings=timings,
+                                            import_profile=import_profile),
+                  conf)
+
+  def get_test_result_json(self, load_errors, testresult, output,
+                           timings=None, import_profile=None):
+    """Gets test result information in the form stored by set_test_result().
+
+    Args:
+      load_errors: A list of (object name, error string) pairs for load errors.
+      testresult: The unittest.TestResult for this test run.
+      output: The output of print statements in the test.
+      timings: A JSON-convertible description of how long the tests took, or
+          None if they were not timed.
+      import_profile: The profile of imports while loading and running the
+          tests, or None if imports were not profiled.
+
+    Returns:
+      A JSON-convertible dictionary of the test result.
     """
     utils.check_type(load_errors, 'load_errors', list)
     utils.check_type(testresult, 'testresult', unittest.TestResult)
@@ -226,7 +457,220 @@ class RunTestUnitTask(JsonHolder):
         'failures': [(tc.fullname, exc) for (tc, exc) in testresult.failures],
         'output': output,
     }
-    self.set_json(data, conf)
+    if timings is not None:
+      data['timings'] = timings
+    if import_profile is not None:
+      data['import_profile'] = import_profile
+    return data
+
+
+class UnitCheckpoint(JsonHolder):
+  """The progress of a test unit that continues in another task.
+
+  If a task runs out of time, it stops the unit after a test method and stores
+  what it has done so far in a UnitCheckpoint, which the task that continues
+  the unit picks up.  There is at most one checkpoint per unit, and it is
+  deleted once the unit's RunTestUnitTask has its result.  Always set the key
+  to the return value of get_key.
+
+  JSON data is of the following form:
+  {'result': the result of the methods run so far, as returned by
+       RunTestUnitTask.get_test_result_json(),
+   'last_method': the full name of the last test method that was run,
+   'num_chunks': how many MethodResultChunks were written for the unit
+  }
+
+  Once the whole unit ran, its failed test methods may be run again (see
+  BatchStatus.max_reruns).  The checkpoint then also has
+  'attempts': the outcomes of these methods so far, as in the 'reruns' of
+      RunTestUnitTask data,
+  'rerun_methods': the full names of the methods to run again next.
+  """
+
+  @classmethod
+  def get_key(cls, task_key):
+    """Gets the key of the UnitCheckpoint of a test unit.
+
+    Args:
+      task_key: The key to the RunTestUnitTask of the unit.
+
+    Returns:
+      A ndb.Key instance corresponding to the UnitCheckpoint.
+    """
+    utils.check_type(task_key, 'task_key', ndb.Key)
+    return ndb.Key(cls, 'checkpoint', parent=task_key)
+
+
+class MethodResultChunk(JsonHolder):
+  """Outcomes of some test methods of a test unit that is still running.
+
+  While a unit runs, the outcomes of its finished methods are written as a
+  sequence of chunks, so clients can report them before the whole unit is done.
+  Chunks are only ever added, never rewritten, and are deleted once the unit's
+  RunTestUnitTask has its result.  Always set the key to the return value of
+  get_key.
+
+  JSON data is a list of [method fullname, outcome, traceback] lists, where
+  outcome is one of 'pass', 'fail', 'error', 'skip', 'xfail' or 'xpass' and
+  traceback is the error string for failures and errors, otherwise None.
+  """
+
+  @classmethod
+  def get_key(cls, task_key, index):
+    """Gets the key of a MethodResultChunk.
+
+    Args:
+      task_key: The key to the RunTestUnitTask of the unit the chunk is for.
+      index: The integer index of the chunk, counting from 0 in the order the
+          chunks were written.
+
+    Returns:
+      A ndb.Key instance corresponding to the MethodResultChunk.
+    """
+    utils.check_type(task_key, 'task_key', ndb.Key)
+    utils.check_type(index, 'index', int)
+    return ndb.Key(cls, str(index), parent=task_key)
+
+
+class StoredBlob(ndb.Model):
+  """A blob that holds the JSON data of a JsonHolder.
+
+  It is a child of the JsonHolder, so the blobs of a TestBatch can be found
+  with keys-only queries when the batch is deleted.  The key's id is the blob
+  key.  StoredBlobs are always put in the datastore, even if the results are
+  stored elsewhere, so that no blob is ever left behind.  Always set the key to
+  the return value of get_key.
+
+  Attributes:
+    created: When the blob was written.
+  """
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+  @classmethod
+  def get_key(cls, holder_key, blob_key):
+    """Gets the key of a StoredBlob.
+
+    Args:
+      holder_key: The key to the JsonHolder whose data is in the blob.
+      blob_key: The BlobKey of the blob.
+
+    Returns:
+      A ndb.Key instance corresponding to the StoredBlob.
+    """
+    utils.check_type(holder_key, 'holder_key', ndb.Key)
+    return ndb.Key(cls, str(blob_key), parent=holder_key)
+
+
+class TestDuration(ndb.Model):
+  """How long a test method or fixture took in its most recent runs.
+
+  The key's id is the full name of the test method, or of the module or class
+  for the time taken by its setUpModule/tearDownModule or
+  setUpClass/tearDownClass fixtures.  Durations are kept in the datastore
+  regardless of the storage option, so they are available to later batches.
+
+  Attributes:
+    recent_secs: The durations of the most recent runs in seconds, oldest
+        first.  At most _NUM_RECENT_DURATIONS are kept.
+    num_runs: How many runs have been recorded in total.
+    mean_secs: The mean of recent_secs.
+    p90_secs: The 90th percentile of recent_secs.
+  """
+  recent_secs = ndb.FloatProperty(repeated=True, indexed=False)
+  num_runs = ndb.IntegerProperty(default=0, indexed=False)
+  mean_secs = ndb.FloatProperty(default=None, indexed=False)
+  p90_secs = ndb.FloatProperty(default=None, indexed=False)
+
+  @classmethod
+  def get_key(cls, fullname):
+    """Gets the key of the TestDuration for a test object.
+
+    Args:
+      fullname: The full name of the test method, class, or module.
+
+    Returns:
+      A ndb.Key instance corresponding to the TestDuration.
+    """
+    utils.check_type(fullname, 'fullname', basestring)
+    return ndb.Key(cls, fullname)
+
+  def add_duration(self, secs):
+    """Adds the duration of a run and updates the statistics.
+
+    Args:
+      secs: How long the run took in seconds.
+    """
+    utils.check_type(secs, 'secs', (int, float))
+    recent = list(self.recent_secs) + [float(secs)]
+    self.recent_secs = recent[-_NUM_RECENT_DURATIONS:]
+    self.num_runs += 1
+    self.mean_secs = sum(self.recent_secs) / len(self.recent_secs)
+    ordered = sorted(self.recent_secs)
+    self.p90_secs = ordered[int(0.9 * (len(ordered) - 1) + 0.5)]
+
+
+def record_test_durations(durations):
+  """Adds durations of a test run to the history of the tests.
+
+  Args:
+    durations: A dictionary mapping full names of test methods, classes, or
+        modules to how long they took in seconds, see TestDuration.
+  """
+  utils.check_type(durations, 'durations', dict)
+  names = sorted(durations)
+  keys = [TestDuration.get_key(name) for name in names]
+  entities = ndb.get_multi(keys)
+  for i, name in enumerate(names):
+    if entities[i] is None:
+      entities[i] = TestDuration(key=keys[i])
+    entities[i].add_duration(durations[name])
+  ndb.put_multi(entities)
+
+
+def get_test_durations(fullnames):
+  """Gets the typical durations of tests from their history.
+
+  Args:
+    fullnames: A list of full names of test methods, classes, or modules.
+
+  Returns:
+    A dictionary mapping each name with a recorded history to its mean
+    duration in seconds.
+  """
+  utils.check_type(fullnames, 'fullnames', list)
+  entities = ndb.get_multi([TestDuration.get_key(name) for name in fullnames])
+  return dict((name, entity.mean_secs)
+              for (name, entity) in zip(fullnames, entities) if entity)
+
+
+def get_method_result_chunks(task_keys, conf):
+  """Gets the MethodResultChunks written for test units.
+
+  Chunks are read in order until one is missing, so a single get_multi() is
+  needed per chunk of the unit with the most chunks.
+
+  Args:
+    task_keys: A list of keys of RunTestUnitTasks.
+    conf: The configuration to use.
+
+  Returns:
+    A list with a list of MethodResultChunks for each task key, in the order
+    they were written.
+  """
+  utils.check_type(task_keys, 'task_keys', list)
+  chunks = [[] for _ in task_keys]
+  indexes = range(len(task_keys))
+  while indexes:
+    keys = [MethodResultChunk.get_key(task_keys[i], len(chunks[i]))
+            for i in indexes]
+    entities = ndb.get_multi(keys, **get_ctx_options(conf))
+    found = []
+    for (i, entity) in zip(indexes, entities):
+      if entity:
+        chunks[i].append(entity)
+        found.append(i)
+    indexes = found
+  return chunks
 
 
 def get_ctx_options(conf):
@@ -248,29 +692,96 @@ def get_ctx_options(conf):
     return {}
   if method == 'memcache':
     return {'use_memcache': True, 'use_datastore': False}
-  if method == 'immediate':
+  if is_immediate(conf):
     return {'use_cache': True, 'use_memcache': False, 'use_datastore': False}
   logging.warning('[aeta] Unknown run method %s.  Falling back to memcache.',
                   method)
   return {'use_memcache': True, 'use_datastore': False}
 
 
-def _delete_blob_if_done(obj_key, blob_key, conf):
-  """Deletes a blob if its object has also been deleted.
+def is_immediate(conf):
+  """Determines whether tests run in the request that starts them.
+
+  Args:
+    conf: The configuration to use.
+
+  Returns:
+    True if conf.storage is 'immediate' or 'immediate_parallel', False
+    otherwise.
+  """
+  return conf.storage in ('immediate', 'immediate_parallel')
+
 
-  Otherwise, it will try to delete the blob later.
+def record_unit_summary(task_key, summary, conf):
+  """Records the summary of the result of a test unit in its ProgressShard.
 
   Args:
-    obj_key: The ndb.Key of a JsonHolder.
-    blob_key: The BlobKey to delete.
+    task_key: The key of the RunTestUnitTask of the unit.
+    summary: A dictionary with the counts of the result, see ProgressShard.
     conf: The configuration to use.
   """
-  if obj_key.get(**get_ctx_options(conf)):
-    deferred.defer(_delete_blob_if_done, obj_key, blob_key, conf,
-                   _queue=conf.test_queue, _countdown=_DELETE_BLOB_TIME_SECS)
+  utils.check_type(task_key, 'task_key', ndb.Key)
+  utils.check_type(summary, 'summary', dict)
+  ctx_options = get_ctx_options(conf)
+  index = RunTestUnitTask.get_index(task_key)
+  shard_keys = ProgressShard.get_keys(RunTestUnitTask.get_batch_key(task_key))
+  shard_key = shard_keys[index % len(shard_keys)]
+
+  def update():
+    shard = shard_key.get(**ctx_options) or ProgressShard(key=shard_key)
+    units = dict(shard.units or {})
+    units[str(index)] = summary
+    shard.units = units
+    shard.put(**ctx_options)
+
+  if ctx_options.get('use_datastore', True):
+    ndb.transaction(update, retries=5)
   else:
-    info = blobstore.BlobInfo.get(blob_key)
-    if info:
-      info.delete()
+    update()
+
 
+def get_batch_summary(batch_key, conf):
+  """Gets how far a batch is along from its ProgressShards.
 
+  Args:
+    batch_key: The key of the TestBatch.
+    conf: The configuration to use.
+
+  Returns:
+    A dictionary with the number of finished test units ('num_done') and the
+    sums of the counts of their summaries (see ProgressShard), and when the
+    batch last made progress ('last_progress', a datetime or None if unknown).
+  """
+  utils.check_type(batch_key, 'batch_key', ndb.Key)
+  keys = ProgressShard.get_keys(batch_key)
+  keys.append(BatchProgress.get_key(batch_key))
+  entities = ndb.get_multi(keys, **get_ctx_options(conf))
+  progress = entities.pop()
+  summary = dict((name, 0) for name in _SUMMARY_COUNTS)
+  summary['num_done'] = 0
+  for shard in entities:
+    for unit_summary in ((shard and shard.units) or {}).values():
+      summary['num_done'] += 1
+      for name in _SUMMARY_COUNTS:
+        summary[name] += unit_summary.get(name, 0)
+  summary['last_progress'] = progress and progress.last_progress
+  return summary
+
+
+def get_finished_units(batch_key, conf):
+  """Gets which test units of a batch have finished from its ProgressShards.
+
+  Only the few small shards are read, whatever the size of the results.
+
+  Args:
+    batch_key: The key of the TestBatch.
+    conf: The configuration to use.
+
+  Returns:
+    A set of the integer indices of the finished units.
+  """
+  utils.check_type(batch_key, 'batch_key', ndb.Key)
+  shards = ndb.get_multi(ProgressShard.get_keys(batch_key),
+                         **get_ctx_options(conf))
+  return set(int(index) for shard in shards if shard and shard.units
+             for index in shard.units)
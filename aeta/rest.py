@@ -24,6 +24,9 @@ The interface has the following top level paths:
 - start_batch/<fullname>
 - batch_info/<batch id>
 - batch_results/<batch id>?start=<integer>
+- batch_progress/<batch id>
+- import_profile/<batch id>
+- cancel_batch/<batch id>
 
 For the start_batch request, a full object name (according to the pattern
 described above) is expected to follow the top level path.  Other requests
@@ -39,8 +42,10 @@ Usage:
   POST /tests/rest/get_methods/some.test
 
 This will get a list of test methods contained in some test object.  If no test
-name is given, it will return all test methods.  The response will be JSON in
-the following format:
+name is given, it will return all test methods.  With the optional shard_index
+and shard_count parameters (e.g. ?shard_index=0&shard_count=4), only the
+methods in that shard of the test units are returned, see Start batch.  The
+response will be JSON in the following format:
 {'method_names': A list of test method full names.
  'load_errors': A list of errors that were encountered while trying to get the
                 test units contained in the batch.  Each error is of the form
@@ -59,6 +64,44 @@ will run all tests named by the part of the URL after start_batch/.  If no
 test name is given, it will run all tests named in the application's
 test_package_names configuration.
 
+To split the tests across several independent executors, pass the optional
+shard_index and shard_count parameters, e.g.
+
+  POST /tests/rest/start_batch/some.test?shard_index=1&shard_count=4
+
+Each executor then runs a disjoint subset of the test units, and together the
+shard_count executors run all of them.  Units are assigned to shards by a
+stable hash of their names, so that executors agree on the shards without
+sharing any state.  shard_index must be at least 0 and under shard_count.
+
+To only run the tests affected by a change, pass the paths of the changed
+source files as changed_path parameters in the request body, e.g.
+
+  POST /tests/rest/start_batch/some.test
+  changed_path=models/user.py&changed_path=lib/util.py
+
+Relative paths are relative to the application's root directory.  Only the test
+units whose modules import one of the changed files, directly or through other
+modules of the application, are run.  Without changed_path parameters, all
+tests are run.
+
+For a quick answer to whether any test fails, pass the fail_fast parameter:
+
+  POST /tests/rest/start_batch/some.test?fail_fast=1
+
+The batch is then aborted once a test unit has an error or failure, and the
+test units that have not started by then are skipped, see Batch results.
+
+To tell flaky tests from consistently failing ones, pass the max_reruns
+parameter:
+
+  POST /tests/rest/start_batch/some.test?max_reruns=2
+
+Test methods that fail or cause an error are then run again in new tasks, up to
+max_reruns more times, until they pass.  Only the failed methods are run
+again.  The result of a unit is available once its reruns are done, see
+Batch results.
+
 The response will be the numeric ID of the test batch.
 
 
@@ -82,6 +125,8 @@ response will be JSON in the following format:
  'load_errors': A list of errors that were encountered while trying to get the
                 test units contained in the batch.  Each error is of the form
                 [object fullname, exception string].
+ 'aborted': Whether the batch was aborted after a failure because it was
+            started with fail_fast.
 }
 
 
@@ -110,12 +155,121 @@ The response will be JSON in the following format:
   'failures': An array of [test method name, error traceback] arrays of all
               test methods which failed,
   'output': Output of the entire test run,
+  'timings': {'start': seconds since the epoch when the first test started,
+              'methods': An array of [test method name, start offset,
+                         duration, outcome] arrays of the methods that ran,
+                         with times in milliseconds,
+              'fixtures': A mapping from module or class name to the
+                          milliseconds spent in its fixtures},
+  'skipped': Only present (and true) if the batch was aborted before the unit
+             ran to the end.  Test methods of the unit that are not listed in
+             'timings' were not run.
+  'reruns': Only present if failed test methods were run again (see
+            max_reruns in Start batch):
+            {'attempts': A mapping from test method name to the array of its
+                         outcomes, the first run included,
+             'flaky': An array of the names of the methods that passed when
+                      run again.  They are not listed in 'errors' and
+                      'failures',
+             'failing': An array of the names of the methods that failed
+                        every time}
  }]
+
+Test units that take a while store the outcomes of their finished test methods
+while they are still running, see the stream_results_* options in aeta.yaml.
+To get these as well, pass the partial parameter:
+
+  GET /tests/rest/batch_results/364?start=5&partial=1
+
+The response will then be JSON in the following format:
+
+{'results': The list of test results described above,
+ 'partial_results': An array of
+     {'index': index of the test unit,
+      'fullname': full name of the test unit,
+      'methods': An array of [test method name, outcome, error traceback]
+                 arrays of the test methods that have finished so far.
+                 outcome is one of 'pass', 'fail', 'error', 'skip', 'xfail'
+                 (expected failure) or 'xpass' (unexpected success), and the
+                 traceback is null unless the method failed or caused an
+                 error.
+     }
+     objects for the units from start on that have not finished yet, ordered
+     by index.  Once a unit has finished, its outcomes are only part of its
+     result.
+}
+
+
+Batch progress
+---------------
+
+Usage:
+  GET /tests/rest/batch_progress/364
+
+This gets how far the batch is along without reading the results of its test
+units, which is much cheaper than batch_results for large batches.  The
+response will be JSON in the following format:
+
+{'num_units': The number of testing units in the batch, or null if this number
+              is not currently known.
+ 'num_done': The number of test units that have finished.
+ 'passes': The number of test methods of these units that passed (including
+           expected failures and flaky methods, see max_reruns).
+ 'failures': The number of their test methods that failed.
+ 'errors': The number of their test methods that caused an error.
+ 'skips': The number of their test methods that were skipped.
+ 'load_errors': The number of their load errors.
+ 'last_progress': Seconds since the epoch when the batch last made progress,
+                  or null if this is not known.
+}
+
+
+Import profile
+---------------
+
+Usage:
+  GET /tests/rest/import_profile/364
+
+If the profile_imports option is enabled, this returns the modules whose
+import took the most time while the batch was initialized and its completed
+test units were run.  Costs of a module imported in several tasks are added
+up.  The response will be JSON in the following format:
+
+{'num_profiles': The number of profiles that were merged, i.e. the batch
+                 initialization plus every completed task that was profiled.
+ 'total_secs': The total time spent importing modules.
+ 'modules': An array of {'module': module name,
+                         'inclusive_secs': seconds spent importing the module
+                                           including its own imports,
+                         'exclusive_secs': seconds spent in the module itself,
+                         'inclusive_kb': growth of the peak resident set
+                                         size in kilobytes including the
+                                         module's imports, or null,
+                         'exclusive_kb': growth of the peak resident set
+                                         size in kilobytes due to the module
+                                         itself, or null}
+            objects, sorted by exclusive_secs, most expensive first.
+}
+
+
+Cancel batch
+---------------
+
+Usage:
+  POST /tests/rest/cancel_batch/364
+
+This stops a batch that is still running, e.g. because its results are no
+longer needed.  Its tasks that did not start yet are removed from the queue,
+tasks that are running stop before their next test unit, and the batch and its
+results are deleted, so other requests for the batch fail afterwards.  The
+response will be JSON in the following format:
+
+{'num_tasks_deleted': How many queued tasks were removed from the queue.}
 """
 
 __author__ = 'schuppe@google.com (Robert Schuppenies)'
 
-
+import calendar
 
 from google.appengine.ext import ndb
 try:
@@ -134,6 +288,7 @@ from aeta import utils
 from aeta import config
 from aeta import logic
 from aeta import handlers
+from aeta import import_profiler
 from aeta import models
 from aeta import runner
 
@@ -186,6 +341,42 @@ def get_batch_results(batch, start):
   return results
 
 
+def get_partial_results(batch, start, conf):
+  """Gets the outcomes of test methods in units that are still running.
+
+  Args:
+    batch: The models.TestBatch instance whose tests to get.
+    start: The lowest index of the test unit to return outcomes for.
+    conf: The configuration to use.
+
+  Returns:
+    A list of {'index': unit index, 'fullname': unit fullname,
+    'methods': list of [method fullname, outcome, traceback]} dictionaries for
+    all unfinished units starting from start that have streamed outcomes,
+    ordered by index.
+  """
+  utils.check_type(batch, 'batch', models.TestBatch)
+  utils.check_type(start, 'start', int)
+  if batch.num_units is None:
+    return []
+  tasks = ndb.get_multi([models.RunTestUnitTask.get_key(batch.key, i)
+                         for i in range(start, batch.num_units)])
+  running = [(start + i, task) for (i, task) in enumerate(tasks)
+             if task and not task.has_json()]
+  chunk_lists = models.get_method_result_chunks(
+      [task.key for (_, task) in running], conf)
+  partial_results = []
+  for ((index, task), chunks) in zip(running, chunk_lists):
+    if not chunks:
+      continue
+    methods = []
+    for chunk in chunks:
+      methods.extend(chunk.get_json())
+    partial_results.append({'index': index, 'fullname': task.fullname,
+                            'methods': methods})
+  return partial_results
+
+
 class BaseRESTRequestHandler(handlers.BaseRequestHandler):
   """Request handler for REST API."""
 
@@ -209,15 +400,68 @@ class BaseRESTRequestHandler(handlers.BaseRequestHandler):
       self.render_error(msg, 404)
     return batch
 
+  def get_shard(self):
+    """Gets the shard of tests requested by the shard parameters.
+
+    If the parameters are invalid, an error is written to the response.
+
+    Returns:
+      A (shard_index, shard_count) tuple, which is (0, 1) if no shard was
+      requested, or None if the parameters are invalid.
+    """
+    try:
+      shard_index = int(self.request.get('shard_index') or 0)
+      shard_count = int(self.request.get('shard_count') or 1)
+    except ValueError:
+      self.render_error('shard_index and shard_count must be integers.', 400)
+      return None
+    if not 0 <= shard_index < shard_count:
+      self.render_error('shard_index must be at least 0 and under shard_count '
+                        '(%s) but is %s' % (shard_count, shard_index), 400)
+      return None
+    return shard_index, shard_count
+
+  def get_flag(self, name):
+    """Gets the value of a boolean request parameter.
+
+    Args:
+      name: The name of the parameter.
+
+    Returns:
+      Whether the parameter is '1', 'true' or 'yes' (in any case).  Other
+      values, such as '0' or 'false', and a missing parameter are False.
+    """
+    return self.request.get(name, '').lower() in ('1', 'true', 'yes')
+
+  def get_changed_paths(self):
+    """Gets the paths of changed files given by changed_path parameters.
+
+    Returns:
+      A list of paths, or None if no changed paths were given.
+    """
+    paths = [str(path) for path in self.request.get_all('changed_path')
+             if path]
+    return paths or None
+
 
 class GetMethodsRequestHandler(BaseRESTRequestHandler):
   """Request handler for getting test methods."""
 
   def get(self, fullname):
+    shard = self.get_shard()
+    if not shard:
+      return
+    shard_index, shard_count = shard
     conf = config.get_config()
     load_errors = []
     test = logic.get_requested_object(fullname, conf)
-    methods = test.get_methods(conf, load_errors)
+    if shard_count == 1:
+      methods = test.get_methods(conf, load_errors)
+    else:
+      methods = []
+      for (_, unit_methods) in runner.get_unit_methods(
+          test, conf, load_errors, shard_index, shard_count):
+        methods.extend(unit_methods)
     data = {'method_names': [method.fullname for method in methods],
             'load_errors': load_errors}
     self.response.out.write(json.dumps(data))
@@ -227,6 +471,17 @@ class StartBatchRequestHandler(BaseRESTRequestHandler):
   """Request handler for starting a test batch."""
 
   def post(self, fullname):
+    shard = self.get_shard()
+    if not shard:
+      return
+    shard_index, shard_count = shard
+    try:
+      max_reruns = int(self.request.get('max_reruns') or 0)
+    except ValueError:
+      max_reruns = -1
+    if max_reruns < 0:
+      self.render_error('max_reruns must be a non-negative integer.', 400)
+      return
     conf = config.get_config()
     obj = logic.get_requested_object(fullname, conf)
     if isinstance(obj, logic.BadTest):
@@ -238,17 +493,24 @@ class StartBatchRequestHandler(BaseRESTRequestHandler):
       return
     conf = config.get_config()
     try:
-      batch = runner.start_batch(fullname, conf)
+      batch = runner.start_batch(fullname, conf, shard_index=shard_index,
+                                 shard_count=shard_count,
+                                 changed_paths=self.get_changed_paths(),
+                                 fail_fast=self.get_flag('fail_fast'),
+                                 max_reruns=max_reruns)
     except DeadlineExceededError:
       self.render_error('Tests took too long to run.  Consider setting the '
                         '"storage" option in aeta.yaml to something other '
                         'than "immediate", such as "memcache".', 500)
       return
-    if conf.storage == 'immediate':
+    if models.is_immediate(conf):
       tasks = batch.get_tasks(conf)
       data = {'batch_info': batch.get_json(),
               'results': [task.get_json() for task in tasks]
              }
+      if conf.profile_imports:
+        # The batch is gone after this request, so include its profile now.
+        data['import_profile'] = get_import_profile(batch, conf)
     else:
       data = {'batch_id': str(batch.key.id())}
     self.response.out.write(json.dumps(data))
@@ -260,7 +522,13 @@ class BatchInfoRequestHandler(BaseRESTRequestHandler):
   def get(self, batch_id):
     batch = self.get_batch(batch_id)
     if batch:
-      self.response.out.write(json.dumps(batch.get_json()))
+      info = batch.get_json()
+      if info is not None:
+        conf = config.get_config()
+        status = models.BatchStatus.get_key(batch.key).get(
+            **models.get_ctx_options(conf))
+        info['aborted'] = bool(status and status.aborted)
+      self.response.out.write(json.dumps(info))
 
 
 class BatchResultsRequestHandler(BaseRESTRequestHandler):
@@ -284,8 +552,72 @@ class BatchResultsRequestHandler(BaseRESTRequestHandler):
         results = get_batch_results(batch, start)
       except MemcacheFailureError:
         self.render_error('Memcache failed when running tests.  ' +
-                          _MEMCACHE_FAILURE_MESSAGE)
-      self.response.out.write(json.dumps(results))
+                          _MEMCACHE_FAILURE_MESSAGE, 500)
+        return
+      if self.get_flag('partial'):
+        partial_results = get_partial_results(batch, start,
+                                              config.get_config())
+        self.response.out.write(json.dumps(
+            {'results': results, 'partial_results': partial_results}))
+      else:
+        self.response.out.write(json.dumps(results))
+
+
+def get_import_profile(batch, conf):
+  """Gets the merged import profile of a batch.
+
+  Args:
+    batch: The models.TestBatch instance whose import profile to get.
+    conf: The configuration to use.
+
+  Returns:
+    The JSON-convertible profile, as described for import_profile/ in the
+    module documentation.
+  """
+  utils.check_type(batch, 'batch', models.TestBatch)
+  holders = [batch] + [task for task in batch.get_tasks(conf) or [] if task]
+  profiles = []
+  for holder in holders:
+    data = holder.get_json()
+    if data and data.get('import_profile'):
+      profiles.append(data['import_profile'])
+  profile = import_profiler.merge_profiles(profiles)
+  profile['num_profiles'] = len(profiles)
+  return profile
+
+
+class ImportProfileRequestHandler(BaseRESTRequestHandler):
+  """Request handler for getting the import profile of a test batch."""
+
+  def get(self, batch_id):
+    batch = self.get_batch(batch_id)
+    if batch:
+      profile = get_import_profile(batch, config.get_config())
+      self.response.out.write(json.dumps(profile))
+
+
+class BatchProgressRequestHandler(BaseRESTRequestHandler):
+  """Request handler for getting how far a test batch is along."""
+
+  def get(self, batch_id):
+    batch = self.get_batch(batch_id)
+    if batch:
+      summary = models.get_batch_summary(batch.key, config.get_config())
+      summary['num_units'] = batch.num_units
+      if summary['last_progress'] is not None:
+        summary['last_progress'] = calendar.timegm(
+            summary['last_progress'].utctimetuple())
+      self.response.out.write(json.dumps(summary))
+
+
+class CancelBatchRequestHandler(BaseRESTRequestHandler):
+  """Request handler for cancelling a test batch."""
+
+  def post(self, batch_id):
+    batch = self.get_batch(batch_id)
+    if batch:
+      num_deleted = runner.cancel_batch(batch.key, config.get_config())
+      self.response.out.write(json.dumps({'num_tasks_deleted': num_deleted}))
 
 
 def get_handler_mapping(urlprefix):
@@ -295,5 +627,10 @@ def get_handler_mapping(urlprefix):
              ('%sstart_batch/(.*)' % urlprefix, StartBatchRequestHandler),
              ('%sbatch_info/(.*)' % urlprefix, BatchInfoRequestHandler),
              ('%sbatch_results/(.*)' % urlprefix, BatchResultsRequestHandler),
+             ('%sbatch_progress/(.*)' % urlprefix,
+              BatchProgressRequestHandler),
+             ('%simport_profile/(.*)' % urlprefix,
+              ImportProfileRequestHandler),
+             ('%scancel_batch/(.*)' % urlprefix, CancelBatchRequestHandler),
             )
   return mapping
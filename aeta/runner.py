@@ -25,34 +25,410 @@ Operation:
 5.  If no progress has been made on a test batch (no additional tests run)
     for a long time, the entire batch and all tasks are deleted to conserve
     memory.
+6.  A batch can also be stopped early by cancel_batch.  Its queued tasks are
+    removed and its entities are deleted right away.
 """
 
 __author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
 
+import collections
+import datetime
 import logging
 import os
 import StringIO
 import sys
+import threading
 import time
+import types
 import unittest
 
 from google.appengine.ext import ndb
 
 from aeta import config
+from aeta import import_profiler
 from aeta import logic
 from aeta import models
 from aeta import task_deferred as deferred
 from aeta import utils
 
 
-# How long to wait between attempts to delete the batch and tasks.  The batch
-# and tasks will almost certainly not be deleted unless this amount of time
-# passes without any more tests finishing (because all have completed or
-# because one times/errors out).
-_DELETE_TIME_SECS = 30 * 60
+# Time between tests that is shorter than this is not considered to be spent
+# in fixtures.
+_MIN_FIXTURE_SECS = 0.01
 
+# A batch's BatchProgress is only written again once it is older than this, so
+# that units finishing at the same time rarely write the same entity.
+_PROGRESS_INTERVAL_SECS = 60
 
-def _run_test_and_capture_output(test):
+# Short names for test outcomes in timing records.
+_OUTCOME_PASS = 'pass'
+_OUTCOME_FAIL = 'fail'
+_OUTCOME_ERROR = 'error'
+_OUTCOME_SKIP = 'skip'
+_OUTCOME_EXPECTED_FAILURE = 'xfail'
+_OUTCOME_UNEXPECTED_SUCCESS = 'xpass'
+
+
+class _TimingTestResult(unittest.TextTestResult):
+  """A TestResult that records how long each test and fixture takes.
+
+  Time between two tests is spent in setUpModule/setUpClass and
+  tearDownModule/tearDownClass fixtures.  It is attributed to the module of
+  the next test if the module changes, otherwise to its class if the class
+  changes.  Time after the last test is attributed to the last test's class.
+
+  Attributes:
+    timings: A list of [fullname, start, stop, outcome] lists, one for every
+        test method that was run, where start and stop are seconds since the
+        epoch.
+    fixture_secs: A dictionary mapping full names of modules and classes to
+        the seconds spent in their fixtures.
+    deadline: Seconds since the epoch after which no more test methods are
+        started, or None to run all of them.  Fixtures of the last class and
+        module that were run still get torn down.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(_TimingTestResult, self).__init__(*args, **kwargs)
+    self.timings = []
+    self.fixture_secs = {}
+    self.deadline = None
+    self._current = None
+    self._last_stop = None
+    self._last_class = None
+
+  def _add_fixture_time(self, fullname, secs):
+    if secs >= _MIN_FIXTURE_SECS:
+      self.fixture_secs[fullname] = self.fixture_secs.get(fullname, 0) + secs
+
+  def _set_outcome(self, test, outcome):
+    if self._current and self._current[0] is test:
+      self._current[1][3] = outcome
+
+  def startTestRun(self):
+    super(_TimingTestResult, self).startTestRun()
+    self._last_stop = time.time()
+
+  def startTest(self, test):
+    super(_TimingTestResult, self).startTest(test)
+    now = time.time()
+    fullname = getattr(test, 'fullname', test.id())
+    class_name = fullname.rsplit('.', 1)[0]
+    if self._last_stop is not None and class_name != self._last_class:
+      module_name = class_name.rsplit('.', 1)[0]
+      if (self._last_class is None or
+          module_name != self._last_class.rsplit('.', 1)[0]):
+        self._add_fixture_time(module_name, now - self._last_stop)
+      else:
+        self._add_fixture_time(class_name, now - self._last_stop)
+    self._last_class = class_name
+    self._current = (test, [fullname, now, None, _OUTCOME_PASS])
+
+  def stopTest(self, test):
+    super(_TimingTestResult, self).stopTest(test)
+    if self._current and self._current[0] is test:
+      self._last_stop = time.time()
+      record = self._current[1]
+      record[2] = self._last_stop
+      self.timings.append(record)
+      self._current = None
+      if self.deadline is not None and self._last_stop >= self.deadline:
+        self.stop()
+
+  def stopTestRun(self):
+    super(_TimingTestResult, self).stopTestRun()
+    if self._last_class is not None and self._last_stop is not None:
+      self._add_fixture_time(self._last_class, time.time() - self._last_stop)
+
+  def addError(self, test, err):
+    super(_TimingTestResult, self).addError(test, err)
+    self._set_outcome(test, _OUTCOME_ERROR)
+
+  def addFailure(self, test, err):
+    super(_TimingTestResult, self).addFailure(test, err)
+    self._set_outcome(test, _OUTCOME_FAIL)
+
+  def addSkip(self, test, reason):
+    super(_TimingTestResult, self).addSkip(test, reason)
+    self._set_outcome(test, _OUTCOME_SKIP)
+
+  def addExpectedFailure(self, test, err):
+    super(_TimingTestResult, self).addExpectedFailure(test, err)
+    self._set_outcome(test, _OUTCOME_EXPECTED_FAILURE)
+
+  def addUnexpectedSuccess(self, test):
+    super(_TimingTestResult, self).addUnexpectedSuccess(test)
+    self._set_outcome(test, _OUTCOME_UNEXPECTED_SUCCESS)
+
+  def get_timings_json(self):
+    """Gets a compact JSON-convertible description of the timings.
+
+    Returns:
+      A dictionary of the form
+      {'start': seconds since the epoch when the first test started,
+       'methods': a list of [fullname, start offset, duration, outcome] for
+           every test method, with times in milliseconds relative to 'start',
+       'fixtures': a mapping from module or class name to the milliseconds
+           spent in its fixtures
+      }
+    """
+    start = self.timings and self.timings[0][1] or 0
+    methods = [[fullname, int(round((start_secs - start) * 1000)),
+                int(round((stop_secs - start_secs) * 1000)), outcome]
+               for (fullname, start_secs, stop_secs, outcome) in self.timings]
+    fixtures = dict((name, int(round(secs * 1000)))
+                    for (name, secs) in self.fixture_secs.items())
+    return {'start': start, 'methods': methods, 'fixtures': fixtures}
+
+  def get_durations(self):
+    """Gets the durations to add to the history of the tests.
+
+    Skipped tests are left out since their duration says nothing about how
+    long they take when they are run.
+
+    Returns:
+      A dictionary mapping full names of test methods, modules, and classes to
+      how long they took in seconds, see models.TestDuration.
+    """
+    durations = dict(self.fixture_secs)
+    for (fullname, start_secs, stop_secs, outcome) in self.timings:
+      if outcome != _OUTCOME_SKIP:
+        durations[fullname] = stop_secs - start_secs
+    return durations
+
+
+class _StreamingTestResult(_TimingTestResult):
+  """A _TimingTestResult that stores method outcomes while the tests run.
+
+  Outcomes of finished methods are buffered and written as
+  models.MethodResultChunks once conf.stream_results_methods methods have
+  finished or conf.stream_results_secs seconds have passed since the last
+  write.  Outcomes that are still buffered when the unit finishes are not
+  written, since the whole result of the unit is stored then.
+
+  Attributes:
+    chunk_keys: The keys of the MethodResultChunks that were written.
+  """
+
+  def __init__(self, task_key, conf, first_chunk, *args, **kwargs):
+    super(_StreamingTestResult, self).__init__(*args, **kwargs)
+    self.chunk_keys = []
+    self._task_key = task_key
+    self._conf = conf
+    self._first_chunk = first_chunk
+    self._pending = []
+    self._last_write = time.time()
+
+  def stopTest(self, test):
+    num_timings = len(self.timings)
+    super(_StreamingTestResult, self).stopTest(test)
+    if len(self.timings) == num_timings:
+      return
+    fullname, _, _, outcome = self.timings[-1]
+    traceback = None
+    if outcome == _OUTCOME_ERROR:
+      traceback = self.errors[-1][1]
+    elif outcome == _OUTCOME_FAIL:
+      traceback = self.failures[-1][1]
+    self._pending.append([fullname, outcome, traceback])
+    max_methods = self._conf.stream_results_methods
+    max_secs = self._conf.stream_results_secs
+    if ((max_methods and len(self._pending) >= max_methods) or
+        (max_secs and time.time() - self._last_write >= max_secs)):
+      self._write_pending()
+
+  def _write_pending(self):
+    """Writes the buffered outcomes as a new MethodResultChunk."""
+    key = models.MethodResultChunk.get_key(
+        self._task_key, self._first_chunk + len(self.chunk_keys))
+    chunk = models.MethodResultChunk(key=key)
+    self._last_write = time.time()
+    try:
+      chunk.set_json(self._pending, self._conf)
+      chunk.put(**models.get_ctx_options(self._conf))
+    # The outcomes are written with the next chunk; pylint: disable-msg=W0703
+    except:
+      logging.exception('[aeta] Error writing the results of finished test '
+                        'methods.')
+      return
+    self.chunk_keys.append(key)
+    self._pending = []
+
+
+def _get_result_class(task_key, conf, deadline=None, first_chunk=0):
+  """Gets the TestResult class to run a test unit with.
+
+  Args:
+    task_key: The key of the RunTestUnitTask of the unit.
+    conf: The configuration to use.
+    deadline: Seconds since the epoch after which no more test methods should
+        be started, or None to run all of them.
+    first_chunk: The index of the first MethodResultChunk to write, which is
+        not 0 if earlier tasks already ran part of the unit.
+
+  Returns:
+    A callable accepted as resultclass by unittest.TextTestRunner, which
+    creates a _StreamingTestResult if results are streamed and a
+    _TimingTestResult otherwise.  Results are not streamed with immediate
+    storage since the whole batch runs in one request then.
+  """
+  stream = (not models.is_immediate(conf) and
+            (conf.stream_results_methods or conf.stream_results_secs))
+  if not stream and deadline is None:
+    return _TimingTestResult
+
+  def make_result(*args, **kwargs):
+    if stream:
+      result = _StreamingTestResult(task_key, conf, first_chunk, *args,
+                                    **kwargs)
+    else:
+      result = _TimingTestResult(*args, **kwargs)
+    result.deadline = deadline
+    return result
+
+  return make_result
+
+
+class _ThreadLocalOutput(object):
+  """A stream that writes to a different stream in every thread.
+
+  It replaces sys.stdout and sys.stderr while test units run in several
+  threads, so that the output of every unit can be captured separately.
+  """
+
+  def __init__(self, default):
+    """Initializes the stream.
+
+    Args:
+      default: The stream to write to in threads that did not set one.
+    """
+    self._default = default
+    self._local = threading.local()
+
+  def set_stream(self, stream):
+    """Sets the stream to write to in the current thread.
+
+    Args:
+      stream: The stream, or None to write to the default stream.
+    """
+    self._local.stream = stream
+
+  def __getattr__(self, name):
+    stream = getattr(self._local, 'stream', None) or self._default
+    return getattr(stream, name)
+
+
+class _OutputBuffer(object):
+  """A stream that keeps the beginning and the end of what is written to it.
+
+  At most limit bytes are kept: the first half of them from the beginning of
+  the output and the second half from the end.  The bytes in between are
+  dropped as they are written, so memory use does not depend on how much is
+  written.
+
+  Attributes:
+    limit: How many bytes to keep, or 0 to keep everything.
+    num_dropped: How many bytes were dropped.
+  """
+
+  def __init__(self, limit):
+    self.limit = limit
+    self.num_dropped = 0
+    self._head = []
+    self._head_bytes = 0
+    self._tail = collections.deque()
+    self._tail_bytes = 0
+
+  def write(self, data):
+    if not self.limit:
+      self._head.append(data)
+      return
+    head_room = self.limit // 2 - self._head_bytes
+    if head_room > 0:
+      self._head.append(data[:head_room])
+      self._head_bytes += len(data[:head_room])
+      data = data[head_room:]
+    if not data:
+      return
+    self._tail.append(data)
+    self._tail_bytes += len(data)
+    # Drop the oldest bytes of the tail that are over its half of the limit.
+    excess = self._tail_bytes - (self.limit - self.limit // 2)
+    while excess > 0:
+      first = self._tail[0]
+      if len(first) <= excess:
+        self._tail.popleft()
+        dropped = len(first)
+      else:
+        self._tail[0] = first[excess:]
+        dropped = excess
+      self._tail_bytes -= dropped
+      self.num_dropped += dropped
+      excess -= dropped
+
+  def getvalue(self):
+    """Gets what was kept of the output.
+
+    Returns:
+      The kept output, with a note about how many bytes were dropped between
+      its beginning and its end.
+    """
+    value = ''.join(self._head)
+    if self.num_dropped:
+      value += ('\n[aeta] %s bytes of output were dropped here.\n' %
+                self.num_dropped)
+    return value + ''.join(self._tail)
+
+
+class _CapturedOutput(object):
+  """A stream that captures the output of tests with bounded memory use.
+
+  The output of each test method is limited to max_method_output_bytes and the
+  output of all of them to max_output_bytes (see aeta.yaml), keeping the
+  beginning and the end of the output in both cases.
+  """
+
+  def __init__(self, conf=None):
+    """Initializes the stream.
+
+    Args:
+      conf: The configuration that limits the output, or None to keep all of
+          it.
+    """
+    self._method_limit = conf and conf.max_method_output_bytes or 0
+    self._output = _OutputBuffer(conf and conf.max_output_bytes or 0)
+    self._method_output = self._output
+    self.start_method()
+
+  def start_method(self):
+    """Starts capturing the output of the next test method."""
+    if self._method_output is not self._output:
+      self._output.write(self._method_output.getvalue())
+    if self._method_limit:
+      self._method_output = _OutputBuffer(self._method_limit)
+
+  def write(self, data):
+    self._method_output.write(data)
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    pass
+
+  def getvalue(self):
+    """Gets the captured output.
+
+    Returns:
+      What was kept of the output of all test methods.
+    """
+    self.start_method()
+    return self._output.getvalue()
+
+
+def _run_test_and_capture_output(test, resultclass=_TimingTestResult,
+                                 conf=None):
   """Run a test and capture the printed output.
 
   By default, the unittest framework only writes test related data to the given
@@ -61,27 +437,55 @@ def _run_test_and_capture_output(test):
 
   Args:
     test: The test to run (can be a TestSuite or a TestCase).
+    resultclass: The TestResult class to collect the results with, see
+        _get_result_class().
+    conf: The configuration that limits how much output is kept, see
+        _CapturedOutput, or None to keep all of it.
 
   Returns:
     A (testresult, output) tuple. 'testresult' is the return value of
-    the TestRunner, 'output' the print output emitted during the test run.
+    the TestRunner, an instance of resultclass, 'output' the print output
+    emitted during the test run.
 
   Raises:
     TypeError: Wrong input arguments.
   """
   utils.check_type(test, 'test', (unittest.TestSuite, unittest.TestCase))
-  output = StringIO.StringIO()
+  output = _CapturedOutput(conf)
+
+  def make_result(*args, **kwargs):
+    result = resultclass(*args, **kwargs)
+    orig_start_test = result.startTest
+
+    def start_test(case):
+      output.start_method()
+      orig_start_test(case)
+
+    result.startTest = start_test
+    return result
+
   original_stdout = sys.stdout
   original_stderr = sys.stderr
-  sys.stdout = output
-  sys.stderr = output
+  # Other threads may be running tests as well, see _run_in_threads().
+  threaded = isinstance(original_stdout, _ThreadLocalOutput)
+  if threaded:
+    original_stdout.set_stream(output)
+    original_stderr.set_stream(output)
+  else:
+    sys.stdout = output
+    sys.stderr = output
   try:
     # Ignore output from unittest.
-    runner = unittest.TextTestRunner(stream=StringIO.StringIO(), verbosity=2)
+    runner = unittest.TextTestRunner(stream=StringIO.StringIO(), verbosity=2,
+                                     resultclass=make_result)
     testresult = runner.run(test)
   finally:
-    sys.stdout = original_stdout
-    sys.stderr = original_stderr
+    if threaded:
+      original_stdout.set_stream(None)
+      original_stderr.set_stream(None)
+    else:
+      sys.stdout = original_stdout
+      sys.stderr = original_stderr
   return testresult, output.getvalue()
 
 
@@ -95,81 +499,841 @@ def _this_task_has_failed_before():
   return int(os.environ.get('X-AppEngine-TaskRetryCount', '0')) > 0
 
 
-def _run_test_unit(fullname, task_key, conf):
+def _start_import_profiler(conf):
+  """Starts profiling imports if this is enabled.
+
+  Args:
+    conf: The configuration to use.
+
+  Returns:
+    A running import_profiler.ImportProfiler, or None if imports are not
+    profiled.
+  """
+  if not conf.profile_imports:
+    return None
+  profiler = import_profiler.ImportProfiler()
+  if not profiler.start():
+    logging.warning('[aeta] Not profiling imports since another request is '
+                    'already profiling them.')
+    return None
+  return profiler
+
+
+def _stop_import_profiler(profiler):
+  """Stops profiling imports.
+
+  Args:
+    profiler: The profiler returned by _start_import_profiler().
+
+  Returns:
+    The import profile as returned by ImportProfiler.get_profile_json(), or
+    None if imports were not profiled.
+  """
+  if not profiler:
+    return None
+  profiler.stop()
+  return profiler.get_profile_json()
+
+
+def _get_deadline(conf):
+  """Gets the time after which the current task should stop running tests.
+
+  Args:
+    conf: The configuration to use.
+
+  Returns:
+    Seconds since the epoch after which no more test methods should be
+    started, or None if the task should run all of them.  There is no deadline
+    with immediate storage, since there is no task to continue in then.
+  """
+  if not conf.task_deadline_secs or models.is_immediate(conf):
+    return None
+  return time.time() + conf.task_deadline_secs
+
+
+def _get_suite_cases(suite):
+  """Gets the test cases of a suite in the order they are run.
+
+  Args:
+    suite: A TestSuite.
+
+  Returns:
+    A list of (full name, test case) tuples.
+  """
+  cases = []
+  suites = [suite]
+  while suites:
+    test = suites.pop()
+    if isinstance(test, unittest.TestSuite):
+      suites.extend(reversed(list(test)))
+    else:
+      cases.append((getattr(test, 'fullname', test.id()), test))
+  return cases
+
+
+def _get_remaining_suite(suite, last_method):
+  """Gets the test cases of a suite that come after a given test method.
+
+  Args:
+    suite: The TestSuite of a test unit.
+    last_method: The full name of a test method in the suite.
+
+  Returns:
+    A TestSuite of the test cases after last_method, in the order they are in
+    suite, or None if suite does not contain last_method.
+  """
+  cases = _get_suite_cases(suite)
+  names = [name for (name, _) in cases]
+  if last_method not in names:
+    return None
+  return unittest.TestSuite(
+      [case for (_, case) in cases[names.index(last_method) + 1:]])
+
+
+def _get_methods_suite(suite, method_names):
+  """Gets the test cases of a suite that have one of the given names.
+
+  Args:
+    suite: The TestSuite of a test unit.
+    method_names: A list of the full names of test methods.
+
+  Returns:
+    A TestSuite of the test cases in method_names, in the order they are in
+    suite.  Names that are not in suite are ignored.
+  """
+  names = set(method_names)
+  return unittest.TestSuite([case for (name, case) in _get_suite_cases(suite)
+                             if name in names])
+
+
+def _get_failed_attempts(data):
+  """Gets the first attempts of the test methods that a unit should rerun.
+
+  Args:
+    data: The result of the unit, as returned by
+        models.RunTestUnitTask.get_test_result_json().
+
+  Returns:
+    A dictionary mapping the full name of every test method that failed or
+    caused an error to a list with its outcome.
+  """
+  attempts = {}
+  for (name, _) in data['errors']:
+    attempts[name] = [_OUTCOME_ERROR]
+  for (name, _) in data['failures']:
+    attempts[name] = [_OUTCOME_FAIL]
+  return attempts
+
+
+def _abort_if_failed(status, data, fullname, conf):
+  """Aborts a fail-fast batch if a test unit has failed.
+
+  Args:
+    status: The BatchStatus of the batch, or None if it has none.
+    data: The result of the unit, as returned by
+        models.RunTestUnitTask.get_test_result_json().
+    fullname: The full name of the unit.
+    conf: The configuration to use.
+  """
+  if (status and status.fail_fast and not status.aborted and
+      (data['load_errors'] or data['errors'] or data['failures'])):
+    status.aborted = True
+    status.put(**models.get_ctx_options(conf))
+    logging.info('[aeta] Aborting the batch since the test %s failed.',
+                 fullname)
+
+
+def _merge_timings_json(first, second):
+  """Merges the timings of two parts of a test unit.
+
+  Args:
+    first: The timings of the first part, as returned by
+        _TimingTestResult.get_timings_json().
+    second: The timings of the part after it.
+
+  Returns:
+    The timings of both parts, relative to the start of the first part.
+  """
+  if not first['methods']:
+    first = dict(first, start=second['start'])
+  shift = int(round((second['start'] - first['start']) * 1000))
+  methods = first['methods'] + [
+      [fullname, offset + shift, duration, outcome]
+      for (fullname, offset, duration, outcome) in second['methods']]
+  fixtures = dict(first['fixtures'])
+  for (name, millis) in second['fixtures'].items():
+    fixtures[name] = fixtures.get(name, 0) + millis
+  return {'start': first['start'], 'methods': methods, 'fixtures': fixtures}
+
+
+def _merge_test_result_json(first, second):
+  """Merges the results of two parts of a test unit.
+
+  Args:
+    first: The result of the first part, as returned by
+        models.RunTestUnitTask.get_test_result_json().
+    second: The result of the part after it.
+
+  Returns:
+    The result of both parts.
+  """
+  merged = dict(first)
+  merged.update(second)
+  for name in ['load_errors', 'errors', 'failures', 'output']:
+    merged[name] = first[name] + second[name]
+  if 'timings' in first and 'timings' in second:
+    merged['timings'] = _merge_timings_json(first['timings'],
+                                            second['timings'])
+  return merged
+
+
+def _delete_unit_progress(task_key, num_chunks, conf):
+  """Deletes the checkpoint and streamed outcomes of a finished test unit.
+
+  They are part of the unit's stored result at this point.  If deleting them
+  fails, they are deleted along with the batch.
+
+  Args:
+    task_key: The key of the RunTestUnitTask of the unit.
+    num_chunks: How many MethodResultChunks were written for the unit.
+    conf: The configuration to use.
+  """
+  keys = [models.MethodResultChunk.get_key(task_key, i)
+          for i in range(num_chunks)]
+  keys.append(models.UnitCheckpoint.get_key(task_key))
+  try:
+    ndb.delete_multi(keys, **models.get_ctx_options(conf))
+  # pylint: disable-msg=W0703
+  except:
+    logging.exception('[aeta] Error deleting the progress of the test unit '
+                      '%s.', task_key)
+
+
+def _get_unit_summary(data):
+  """Summarizes the result of a test unit for its batch's progress.
+
+  Args:
+    data: The result of the unit, as stored in its RunTestUnitTask.
+
+  Returns:
+    A dictionary with the counts of the result, see models.ProgressShard.
+  """
+  outcomes = [method[3] for method in
+              (data.get('timings') or {}).get('methods', [])]
+  flaky = (data.get('reruns') or {}).get('flaky', [])
+  return {'passes': (outcomes.count(_OUTCOME_PASS) +
+                     outcomes.count(_OUTCOME_EXPECTED_FAILURE) + len(flaky)),
+          'failures': len(data.get('failures', [])),
+          'errors': len(data.get('errors', [])),
+          'skips': outcomes.count(_OUTCOME_SKIP),
+          'load_errors': len(data.get('load_errors', []))}
+
+
+def _record_unit_summary(task_key, data, conf):
+  """Adds the result of a test unit to its batch's progress.
+
+  The progress only serves to report on the batch while it runs, so errors
+  are logged instead of failing the unit, whose result is stored already.
+
+  Args:
+    task_key: The ndb.Key of the RunTestUnitTask of the unit.
+    data: The result of the unit, see RunTestUnitTask.
+    conf: The configuration to use.
+  """
+  try:
+    models.record_unit_summary(task_key, _get_unit_summary(data), conf)
+  # pylint: disable-msg=W0703
+  except:
+    logging.exception('[aeta] Error recording the progress of the test unit '
+                      '%s.', task_key)
+
+
+def _store_result(task, data, conf):
+  """Stores the result of a test unit and adds it to its batch's progress.
+
+  Args:
+    task: The RunTestUnitTask of the unit.
+    data: The result of the unit, see RunTestUnitTask.
+    conf: The configuration to use.
+  """
+  task.set_json(data, conf)
+  task.put(**models.get_ctx_options(conf))
+  _record_unit_summary(task.key, data, conf)
+
+
+def _run_test_unit(fullname, task_key, conf, has_failed_before=None,
+                   deadline=None, continued=False):
   """Runs a single test unit based on a RunTestUnitTask.
 
   The test identified by the task is run and the result is stored in the
   RunTestUnitTask.
 
+  If the task passes its deadline (see the task_deadline_secs option), the
+  unit is stopped after the current test method, which tears down the class
+  and module fixtures in use.  What was done so far is stored in a
+  models.UnitCheckpoint, and another task continues the unit with the
+  remaining methods, setting up their fixtures again.
+
+  If the batch reruns failed test methods (see BatchStatus.max_reruns) and
+  some failed, the result is stored by _rerun_test_methods instead.
+
   Args:
     fullname: The full name of the test unit to run.
     task_key: The key of the RunTestUnitTask to run.
     conf: The configuration to use.
+    has_failed_before: Whether running the unit failed before, in which case
+        an error is stored instead of running it again, or None to determine
+        this from the current task.
+    deadline: Seconds since the epoch after which no more test methods should
+        be started, or None to determine this from the task_deadline_secs
+        option.
+    continued: Whether earlier tasks ran part of the unit and stored a
+        checkpoint to continue from.
+
+  Returns:
+    True if the unit is done (apart from reruns), False if it continues in
+    another task.
   """
   ctx_options = models.get_ctx_options(conf)
   task = models.RunTestUnitTask(key=task_key, fullname=fullname)
+  checkpoint_key = models.UnitCheckpoint.get_key(task_key)
+  checkpoint = None
+  if continued:
+    holder = checkpoint_key.get(**ctx_options)
+    checkpoint = holder and holder.get_json()
+  batch_key = models.RunTestUnitTask.get_batch_key(task_key)
+  status_key = models.BatchStatus.get_key(batch_key)
+  status = status_key.get(**ctx_options)
+  if status and status.cancelled:
+    logging.info('[aeta] Not running the test %s since its batch was '
+                 'cancelled.', fullname)
+    return True
+  if status and status.aborted:
+    # Skip the unit without importing or running any tests.
+    data = task.get_test_result_json([], unittest.TestResult(), '')
+    if checkpoint:
+      data = _merge_test_result_json(checkpoint['result'], data)
+    data['skipped'] = True
+    _store_result(task, data, conf)
+    if checkpoint:
+      _delete_unit_progress(task_key, checkpoint['num_chunks'], conf)
+    return True
   load_errors = []
-  if _this_task_has_failed_before():
+  if has_failed_before is None:
+    has_failed_before = _this_task_has_failed_before()
+  if has_failed_before or (continued and not checkpoint):
     # This will appear to the user as a "load error" in the test.
-    msg = 'Unknown error running test %s.  See log for details.' % fullname
+    if has_failed_before:
+      msg = 'Unknown error running test %s.  See log for details.' % fullname
+    else:
+      msg = ('The progress of the test %s was lost while continuing it in '
+             'another task.' % fullname)
     load_errors.append((fullname, msg))
     try:
-      task.set_test_result(load_errors, unittest.TestResult(), '', conf)
-      task.put(**ctx_options)
+      data = task.get_test_result_json(load_errors, unittest.TestResult(), '')
+      if checkpoint:
+        data = _merge_test_result_json(checkpoint['result'], data)
+      _store_result(task, data, conf)
     # pylint: disable-msg=W0703
     except:
       msg = 'Error writing message about the test %s that failed!' % fullname
       logging.exception(msg)
+    return True
+  if deadline is None:
+    deadline = _get_deadline(conf)
+  first_chunk = 0
+  if checkpoint:
+    first_chunk = checkpoint['num_chunks']
+  profiler = _start_import_profiler(conf)
+  try:
+    test = logic.get_requested_object(fullname, conf)
+    if checkpoint:
+      # Load errors were already reported by the first part of the unit.
+      suite = _get_remaining_suite(test.get_suite(conf),
+                                   checkpoint['last_method'])
+      if suite is None:
+        msg = ('Could not continue the test %s in another task since its test '
+               'methods changed.' % fullname)
+        load_errors.append((fullname, msg))
+        suite = unittest.TestSuite()
+    else:
+      suite = test.get_suite(conf, load_errors)
+    # Since the test is a TestSuite, its run method will handle all the
+    # administrative work involved in setUpModule, setUpClass, skipping, etc.
+    result, output = _run_test_and_capture_output(
+        suite, resultclass=_get_result_class(task_key, conf, deadline,
+                                             first_chunk), conf=conf)
+  finally:
+    import_profile = _stop_import_profiler(profiler)
+  timings = None
+  last_method = checkpoint and checkpoint['last_method']
+  if isinstance(result, _TimingTestResult):
+    timings = result.get_timings_json()
+    if result.timings:
+      last_method = result.timings[-1][0]
+  data = task.get_test_result_json(load_errors, result, output,
+                                   timings=timings,
+                                   import_profile=import_profile)
+  if checkpoint:
+    data = _merge_test_result_json(checkpoint['result'], data)
+  num_chunks = first_chunk
+  if isinstance(result, _StreamingTestResult):
+    num_chunks += len(result.chunk_keys)
+  done = True
+  if result.shouldStop and last_method:
+    remaining = _get_remaining_suite(suite, last_method)
+    done = not (remaining and remaining.countTestCases())
+  # The batch may have been cancelled while the tests ran, in which case the
+  # result must not bring back its deleted entities.
+  status = status_key.get(**ctx_options)
+  if status and status.cancelled:
+    logging.info('[aeta] Discarding the result of the test %s since its batch '
+                 'was cancelled.', fullname)
+    if num_chunks:
+      _delete_unit_progress(task_key, num_chunks, conf)
+    return True
+  attempts = None
+  if done and status and status.max_reruns:
+    attempts = _get_failed_attempts(data)
+  if attempts:
+    # The result is stored once the failed methods were run again.
+    holder = models.UnitCheckpoint(key=checkpoint_key)
+    holder.set_json({'result': data, 'last_method': last_method,
+                     'num_chunks': num_chunks, 'attempts': attempts,
+                     'rerun_methods': sorted(attempts)}, conf)
+    holder.put(**ctx_options)
+    logging.info('[aeta] Running %s failed methods of the test %s again.',
+                 len(attempts), fullname)
+    _start_rerun(fullname, task_key, conf)
+  elif done:
+    _store_result(task, data, conf)
+    if continued or num_chunks:
+      _delete_unit_progress(task_key, num_chunks, conf)
+  else:
+    holder = models.UnitCheckpoint(key=checkpoint_key)
+    holder.set_json({'result': data, 'last_method': last_method,
+                     'num_chunks': num_chunks}, conf)
+    holder.put(**ctx_options)
+    deferred.defer(_run_test_unit, fullname, task_key, conf, continued=True,
+                   _queue=conf.test_queue)
+    logging.info('[aeta] Continuing the test %s after %s in another task.',
+                 fullname, last_method)
+  _record_progress(batch_key, conf)
+  if not attempts:
+    _abort_if_failed(status, data, fullname, conf)
+  if conf.record_durations and isinstance(result, _TimingTestResult):
+    try:
+      models.record_test_durations(result.get_durations())
+    # The results are already stored; pylint: disable-msg=W0703
+    except:
+      logging.exception('Error recording durations of the test %s.', fullname)
+  return done
+
+
+def _start_rerun(fullname, task_key, conf):
+  """Starts running the failed test methods of a test unit again.
+
+  The methods are run in another task, except with immediate storage, where
+  the results are only kept during the current request and they are run right
+  away instead.
+
+  Args:
+    fullname: The full name of the test unit.
+    task_key: The key of the unit's RunTestUnitTask.
+    conf: The configuration to use.
+  """
+  if models.is_immediate(conf):
+    _rerun_test_methods(fullname, task_key, conf)
+  else:
+    deferred.defer(_rerun_test_methods, fullname, task_key, conf,
+                   _queue=conf.test_queue)
+
+
+def _rerun_test_methods(fullname, task_key, conf):
+  """Runs the failed test methods of a test unit again.
+
+  The methods to run and the outcomes of their earlier attempts are read from
+  the unit's UnitCheckpoint, see _run_test_unit.  Methods that fail again are
+  run again (see _start_rerun) until they have been run BatchStatus.max_reruns
+  more times than at first.  Then the unit's result is stored, with the
+  methods that passed in some attempt classified as flaky and the others as
+  failing.
+
+  Args:
+    fullname: The full name of the test unit.
+    task_key: The key of the unit's RunTestUnitTask.
+    conf: The configuration to use.
+  """
+  ctx_options = models.get_ctx_options(conf)
+  batch_key = models.RunTestUnitTask.get_batch_key(task_key)
+  status_key = models.BatchStatus.get_key(batch_key)
+  holder = models.UnitCheckpoint.get_key(task_key).get(**ctx_options)
+  checkpoint = holder and holder.get_json()
+  status = status_key.get(**ctx_options)
+  if not (checkpoint and status) or status.cancelled:
+    # The batch was deleted or cancelled.
+    return
+  data = checkpoint['result']
+  attempts = checkpoint['attempts']
+  methods = checkpoint['rerun_methods']
+  if _this_task_has_failed_before():
+    # Running the methods again broke the task, so they count as failing.
+    msg = ('Unknown error running the failed methods of the test %s again.  '
+           'See log for details.' % fullname)
+    data['load_errors'] = data['load_errors'] + [(fullname, msg)]
+    methods = []
+  else:
+    test = logic.get_requested_object(fullname, conf)
+    suite = _get_methods_suite(test.get_suite(conf), methods)
+    result, output = _run_test_and_capture_output(suite, conf=conf)
+    data['output'] += output
+    outcomes = dict((name, outcome)
+                    for (name, _, _, outcome) in result.timings)
+    # Methods that could not be run (e.g. because a fixture failed) keep the
+    # outcomes they have so far.
+    for name in methods:
+      if name in outcomes:
+        attempts[name].append(outcomes[name])
+    methods = [name for name in methods
+               if outcomes.get(name) in (_OUTCOME_ERROR, _OUTCOME_FAIL) and
+               len(attempts[name]) <= status.max_reruns]
+    status = status_key.get(**ctx_options)
+    if not status or status.cancelled:
+      return
+  if methods:
+    holder.set_json(dict(checkpoint, result=data, attempts=attempts,
+                         rerun_methods=methods), conf)
+    holder.put(**ctx_options)
+    _record_progress(batch_key, conf)
+    _start_rerun(fullname, task_key, conf)
     return
-  test = logic.get_requested_object(fullname, conf)
-  suite = test.get_suite(conf, load_errors)
-  # Since the test is a TestSuite, its run method will handle all the
-  # administrative work involved in setUpModule, setUpClass, skipping, etc.
-  result, output = _run_test_and_capture_output(suite)
-  task.set_test_result(load_errors, result, output, conf)
-  task.put(**ctx_options)
+  flaky = sorted(name for (name, outcomes) in attempts.items()
+                 if outcomes[-1] not in (_OUTCOME_ERROR, _OUTCOME_FAIL))
+  failing = sorted(set(attempts) - set(flaky))
+  data['errors'] = [error for error in data['errors']
+                    if error[0] not in flaky]
+  data['failures'] = [failure for failure in data['failures']
+                      if failure[0] not in flaky]
+  data['reruns'] = {'attempts': attempts, 'flaky': flaky, 'failing': failing}
+  task = models.RunTestUnitTask(key=task_key, fullname=fullname)
+  _store_result(task, data, conf)
+  _delete_unit_progress(task_key, checkpoint['num_chunks'], conf)
+  _record_progress(batch_key, conf)
+  if flaky:
+    logging.info('[aeta] Flaky test methods in %s: %s', fullname,
+                 ', '.join(flaky))
+  _abort_if_failed(status, data, fullname, conf)
+
+
+def _run_test_units(fullnames, task_keys, conf):
+  """Runs several test units one after another in a single task.
+
+  Each unit's result is stored in its own RunTestUnitTask, just like
+  _run_test_unit does.  If the task is retried, units that finished in an
+  earlier attempt are skipped, and the first unfinished unit (which was
+  running when the earlier attempt failed) gets an error.  If the task passes
+  its deadline, the remaining units are run in another task.
+
+  Args:
+    fullnames: A list of the full names of the test units to run.
+    task_keys: A list of the keys of the corresponding RunTestUnitTasks.
+    conf: The configuration to use.
+  """
+  deadline = _get_deadline(conf)
+  has_failed_before = _this_task_has_failed_before()
+  if has_failed_before:
+    tasks = ndb.get_multi(task_keys, **models.get_ctx_options(conf))
+  else:
+    tasks = [None] * len(task_keys)
+  ran_unit = False
+  for (i, (fullname, task_key, task)) in enumerate(zip(fullnames, task_keys,
+                                                       tasks)):
+    if task and task.get_json() is not None:
+      continue
+    if ran_unit and deadline is not None and time.time() >= deadline:
+      deferred.defer(_run_test_units, fullnames[i:], task_keys[i:], conf,
+                     _queue=conf.test_queue)
+      return
+    done = _run_test_unit(fullname, task_key, conf, has_failed_before,
+                          deadline)
+    has_failed_before = False
+    ran_unit = True
+    if not done:
+      # The unit continues in another task, and so do the units after it.
+      if i + 1 < len(fullnames):
+        deferred.defer(_run_test_units, fullnames[i + 1:], task_keys[i + 1:],
+                       conf, _queue=conf.test_queue)
+      return
+
+
+def _pack_units(unit_methods, durations, target_secs):
+  """Groups consecutive test units into tasks of about the same duration.
+
+  Args:
+    unit_methods: A list of (unit, methods) tuples.
+    durations: A dictionary of durations as accepted by
+        logic.get_estimated_secs().
+    target_secs: The desired duration of a task in seconds.
+
+  Returns:
+    A list of lists of indexes into unit_methods, one list per task.  Units
+    estimated to take longer than target_secs get a task of their own.
+  """
+  groups = []
+  group_secs = 0.0
+  for (i, (_, methods)) in enumerate(unit_methods):
+    secs = logic.get_estimated_secs(methods, durations)
+    if groups and group_secs + secs <= target_secs:
+      groups[-1].append(i)
+      group_secs += secs
+    else:
+      groups.append([i])
+      group_secs = secs
+  return groups
+
+
+def _sort_longest_first(groups, unit_methods, durations):
+  """Sorts the tasks of a batch so that the longest ones are started first.
+
+  Otherwise a slow unit whose name sorts last would start last and make the
+  whole batch take longer.
+
+  Args:
+    groups: A list of lists of indexes into unit_methods, one list per task.
+    unit_methods: A list of (unit, methods) tuples.
+    durations: A dictionary of durations as accepted by
+        logic.get_estimated_secs().  Without durations, the estimates are
+        based on the number of test methods.
+
+  Returns:
+    The groups sorted by their estimated duration, longest first.  Groups that
+    are estimated to take equally long keep their order.
+  """
+  def get_secs(group):
+    return sum(logic.get_estimated_secs(unit_methods[i][1], durations)
+               for i in group)
+  return sorted(groups, key=get_secs, reverse=True)
 
 
-def _delete_batch(batch_key, prev_done, conf):
-  """Deletes the given batch and its tasks if no progress has been made.
+def _get_batch_keys(batch, conf):
+  """Gets the keys of the entities of a batch that hold its tests and results.
 
-  Otherwise, it will check back in _DELETE_TIME_SECS seconds.
+  The batch's BatchStatus and BatchProgress are not included.  Finished units
+  are told from the batch's ProgressShards, so no test results are read.
 
-  Note that any blobs used in this batch will eventually be deleted after their
-  respective TestBatch/RunTestUnitTask objects are deleted; see
-  models._delete_blob_if_done().
+  Args:
+    batch: The TestBatch.
+    conf: The configuration to use.
+
+  Returns:
+    A list of the keys of the batch, its RunTestUnitTasks and ProgressShards,
+    and the streamed results and checkpoints of its units.
+  """
+  keys = [batch.key]
+  keys.extend(models.ProgressShard.get_keys(batch.key))
+  task_keys = [models.RunTestUnitTask.get_key(batch.key, i)
+               for i in range(batch.num_units or 0)]
+  keys.extend(task_keys)
+  # Units that never finished can have streamed results and checkpoints left
+  # over.
+  finished = models.get_finished_units(batch.key, conf)
+  unfinished_keys = [key for (i, key) in enumerate(task_keys)
+                     if i not in finished]
+  for chunks in models.get_method_result_chunks(unfinished_keys, conf):
+    keys.extend(chunk.key for chunk in chunks)
+  keys.extend(models.UnitCheckpoint.get_key(key) for key in unfinished_keys)
+  return keys
+
+
+def _get_task_name(batch_key, suffix):
+  """Gets the name of a task that runs part of a batch.
+
+  Tasks are named after the batch so that cancel_batch can delete them from
+  the queue.  Batch IDs are random, so names are never reused.
+
+  Args:
+    batch_key: The key of the TestBatch.
+    suffix: What distinguishes the task from the other tasks of the batch,
+        e.g. the index of its first test unit.
+
+  Returns:
+    The name of the task.
+  """
+  return 'aeta-%s-%s' % (batch_key.id(), suffix)
+
+
+def _record_progress(batch_key, conf):
+  """Records that a batch made progress now.
+
+  This keeps the batch from being deleted for conf.batch_retention_secs, see
+  cleanup.delete_old_batches().  The BatchProgress is only written if it is
+  older than _PROGRESS_INTERVAL_SECS.  It is called after results are stored,
+  and errors are logged, so that they do not make the task run the tests
+  again.
 
   Args:
-    batch_key: The key to the TestBatch to delete.
-    prev_done: How many tests were done _DELETE_TIME_SECS seconds ago.  If the
-        number of completed tests has not increased, the batch is deleted.
+    batch_key: The key of the TestBatch.
     conf: The configuration to use.
   """
   ctx_options = models.get_ctx_options(conf)
-  batch = batch_key.get(**ctx_options)
-  if batch is None: return  # For idempotency.
-  utils.check_type(batch, 'batch', models.TestBatch)
-  tasks = [task for task in batch.get_tasks(conf) if task]
-  num_done = len(tasks)
-  if num_done == prev_done:
-    task_keys = [task.key for task in tasks]
-    ndb.delete_multi([batch_key] + task_keys, **ctx_options)
+  progress_key = models.BatchProgress.get_key(batch_key)
+  try:
+    progress = progress_key.get(**ctx_options)
+    # Properties with auto_now are in UTC.
+    min_time = (datetime.datetime.utcnow() -
+                datetime.timedelta(seconds=_PROGRESS_INTERVAL_SECS))
+    if not (progress and progress.last_progress and
+            progress.last_progress > min_time):
+      models.BatchProgress(key=progress_key).put(**ctx_options)
+  # pylint: disable-msg=W0703
+  except:
+    logging.exception('[aeta] Error recording the progress of the batch %s.',
+                      batch_key)
+
+
+def _get_durations(test, conf):
+  """Gets the recorded durations of the methods and fixtures in a test object.
+
+  Args:
+    test: The TestObject whose durations to get.
+    conf: The configuration to use.
+
+  Returns:
+    A dictionary of durations as accepted by logic.partition_units().
+  """
+  names = set()
+  for method in test.get_methods(conf):
+    parts = method.fullname.split('.')
+    for i in range(1, len(parts) + 1):
+      names.add('.'.join(parts[:i]))
+  try:
+    return models.get_test_durations(sorted(names))
+  # Durations are only used as estimates; pylint: disable-msg=W0703
+  except:
+    logging.exception('Error getting durations of the tests in %s.',
+                      test.fullname)
+    return {}
+
+
+def get_unit_methods(test, conf, errors_out=None, shard_index=0,
+                     shard_count=1, changed_paths=None, durations=None,
+                     shard_durations=None):
+  """Splits the tests of a batch into units.
+
+  The durations recorded so far change with every batch that finishes, so
+  executors of different shards that start at different times could see
+  different ones.  Sharded batches therefore use shard_durations instead, which
+  are the same for every executor, to both split and shard the tests.
+
+  Args:
+    test: The TestObject to run.
+    conf: The configuration to use.
+    errors_out: A list to which import error tracebacks are appended, or None
+        to ignore errors.
+    shard_index: The index of the shard of the tests to run, see
+        logic.get_shard().
+    shard_count: How many shards the tests are split into.
+    changed_paths: A list of paths of changed source files to only run the
+        units affected by them (see logic.get_affected_unit_methods()), or
+        None to run all units.
+    durations: The recorded durations of the tests as returned by
+        _get_durations(), or None to get them if they are needed.
+    shard_durations: Durations shared by all executors of a sharded batch
+        (e.g. a snapshot stored by the caller), as returned by
+        _get_durations(), to balance the shards by estimated duration, or None
+        to shard by name.
+
+  Returns:
+    A list of (unit, methods) tuples as returned by
+    logic.TestObject.get_unit_methods().
+
+  Raises:
+    ValueError: If shard_index is not in [0, shard_count).
+  """
+  if shard_count > 1:
+    durations = shard_durations or {}
+  elif durations is None and conf.unit_target_secs:
+    durations = _get_durations(test, conf)
+  if conf.unit_target_secs:
+    unit_methods = logic.partition_units(test, conf, durations,
+                                         conf.unit_target_secs, errors_out)
   else:
-    deferred.defer(_delete_batch, batch_key, num_done, conf,
-                   _queue=conf.test_queue, _countdown=_DELETE_TIME_SECS)
+    unit_methods = test.get_unit_methods(conf, errors_out)
+  if changed_paths is not None:
+    unit_methods = logic.get_affected_unit_methods(unit_methods, changed_paths,
+                                                   conf)
+  return logic.get_shard(unit_methods, shard_index, shard_count,
+                         shard_durations)
+
+
+def _run_in_threads(calls, task_keys, conf):
+  """Runs the test units of a batch with immediate_parallel storage.
 
+  The calls are made in a pool of conf.max_workers threads, and the output of
+  each unit is captured in its own thread.  Every thread has its own ndb
+  context, so the latest BatchStatus of the batch is copied into the context
+  of each thread before its call (which lets a failure abort a fail-fast
+  batch), and the RunTestUnitTasks stored by the calls are copied into the
+  context of the calling thread afterwards, along with their summaries.
 
-def _initialize_batch(fullname, batch_key, conf):
+  Args:
+    calls: A list of DeferredCalls that run test units.
+    task_keys: A list with the keys of the RunTestUnitTasks of the units run
+        by each call.
+    conf: The configuration to use.
+  """
+  if not calls:
+    return
+  ctx_options = models.get_ctx_options(conf)
+  status_key = models.BatchStatus.get_key(
+      models.RunTestUnitTask.get_batch_key(task_keys[0][0]))
+  # The latest status, replaced once a call aborts the batch.
+  latest_status = [status_key.get(**ctx_options)]
+
+  def run(i):
+    if latest_status[0]:
+      latest_status[0].put(**ctx_options)
+    calls[i].run()
+    status = status_key.get(**ctx_options)
+    if status and status.aborted:
+      latest_status[0] = status
+    return ndb.get_multi(task_keys[i], **ctx_options)
+
+  original_stdout = sys.stdout
+  original_stderr = sys.stderr
+  sys.stdout = _ThreadLocalOutput(original_stdout)
+  sys.stderr = _ThreadLocalOutput(original_stderr)
+  try:
+    results = utils.map_in_threads(run, range(len(calls)), conf.max_workers)
+  finally:
+    sys.stdout = original_stdout
+    sys.stderr = original_stderr
+  tasks = [task for task_list in results for task in task_list if task]
+  entities = list(tasks)
+  if latest_status[0]:
+    entities.append(latest_status[0])
+  ndb.put_multi(entities, **ctx_options)
+  for task in tasks:
+    if task.has_json():
+      _record_unit_summary(task.key, task.get_json(), conf)
+
+
+def _initialize_batch(fullname, batch_key, conf, shard_index=0,
+                      shard_count=1, changed_paths=None, shard_durations=None):
   """Initializes a TestBatch to start the tests running.
 
   This function creates a RunTestUnitTask for every test unit in the batch and
-  starts running them in the background.
+  starts running them in the background, the ones that are expected to take
+  longest first.
 
   Args:
     batch_key: The ndb.Key of the batch to initialize.
     conf: The configuration to use.
-    run_immediately: If set to True, tests will be run immediately rather than
-        in the task queue.  They will be finished before this function returns.
+    shard_index: The index of the shard of the tests to run.
+    shard_count: How many shards the tests are split into.
+    changed_paths: A list of paths of changed source files to only run the
+        tests affected by them, or None to run all tests.
+    shard_durations: Durations to balance the shards by, see start_batch().
   """
   ctx_options = models.get_ctx_options(conf)
   errors_out = []
@@ -187,36 +1351,66 @@ def _initialize_batch(fullname, batch_key, conf):
       msg = 'Error writing message about the batch %s that failed!' % fullname
       logging.exception(msg)
     return
-  test = logic.get_requested_object(fullname, conf)
-  test_units = test.get_units(conf, errors_out)
+  profiler = _start_import_profiler(conf)
+  try:
+    test = logic.get_requested_object(fullname, conf)
+    # Ignore loading errors of the units' methods for now.  _run_test_unit will
+    # detect loading errors when its task is executed.
+    durations = None
+    if conf.task_target_secs or conf.record_durations:
+      durations = _get_durations(test, conf)
+    unit_methods = get_unit_methods(test, conf, errors_out, shard_index,
+                                    shard_count, changed_paths, durations,
+                                    shard_durations)
+  finally:
+    import_profile = _stop_import_profiler(profiler)
   test_unit_methods = {}
   tasks = []
-  defer_calls = []
-  for (i, unit) in enumerate(test_units):
-    # Ignore loading errors for now.  _run_test_unit will detect loading errors
-    # when its task is executed.
-    method_names = [method.fullname for method in unit.get_methods(conf)]
+  for (i, (unit, methods)) in enumerate(unit_methods):
+    method_names = [method.fullname for method in methods]
     test_unit_methods[unit.fullname] = method_names
     task_key = models.RunTestUnitTask.get_key(batch_key, i)
     tasks.append(models.RunTestUnitTask(key=task_key, fullname=unit.fullname))
-  batch.set_info(errors_out, test_unit_methods, conf)
+  batch.set_info(errors_out, test_unit_methods, conf,
+                 import_profile=import_profile)
+  status = models.BatchStatus.get_key(batch_key).get(**ctx_options)
+  if status and status.cancelled:
+    logging.info('[aeta] Not starting the batch %s since it was cancelled.',
+                 fullname)
+    return
   # Put batch after tasks, so that we don't see that the batch has tasks before
   # they exist.
   ndb.put_multi(tasks + [batch], **ctx_options)
-  for task in tasks:
-    call = deferred.DeferredCall(_run_test_unit, str(task.fullname), task.key,
-                                 conf)
-    if conf.storage == 'immediate':
-      call.run()
+  if conf.task_target_secs:
+    # Run several short units per task to save the overhead of a task each.
+    groups = _pack_units(unit_methods, durations, conf.task_target_secs)
+  else:
+    groups = [[i] for i in range(len(tasks))]
+  groups = _sort_longest_first(groups, unit_methods, durations or {})
+  calls = []
+  for group in groups:
+    name = _get_task_name(batch_key, group[0])
+    if len(group) == 1:
+      task = tasks[group[0]]
+      calls.append(deferred.DeferredCall(_run_test_unit, str(task.fullname),
+                                         task.key, conf, _name=name))
     else:
-      defer_calls.append(call)
-  if ctx_options.get('use_datastore', True):
-    defer_calls.append(deferred.DeferredCall(_delete_batch, batch.key, 0, conf,
-                                             _countdown=_DELETE_TIME_SECS))
-  deferred.defer_multi(defer_calls, queue=conf.test_queue)
+      calls.append(deferred.DeferredCall(
+          _run_test_units, [str(tasks[i].fullname) for i in group],
+          [tasks[i].key for i in group], conf, _name=name))
+  if conf.storage == 'immediate_parallel':
+    _run_in_threads(calls, [[tasks[i].key for i in group] for group in groups],
+                    conf)
+  elif conf.storage == 'immediate':
+    for call in calls:
+      call.run()
+  else:
+    deferred.defer_multi(calls, queue=conf.test_queue)
 
 
-def start_batch(fullname, conf):
+def start_batch(fullname, conf, shard_index=0, shard_count=1,
+                changed_paths=None, fail_fast=False, max_reruns=0,
+                shard_durations=None):
   """Creates a TestBatch for all the given tests and returns it.
 
   Eventually, all tests will automatically run in the background.
@@ -226,28 +1420,113 @@ def start_batch(fullname, conf):
         period-separated name of a test package, module, class, or method, or
         the empty string to run all tests.
     conf: The configuration to use.
-    run_immediately: If set to True, tests will be run immediately rather than
-        in the task queue.  They will be finished before this function returns.
+    shard_index: The index of the shard of the tests to run, see
+        logic.get_shard().
+    shard_count: How many shards the tests are split into.  By default, all
+        tests are run.
+    changed_paths: A list of paths of source files that changed, e.g. in a
+        commit.  If given, only the tests that import one of them (directly or
+        indirectly) are run.
+    fail_fast: Whether to abort the batch once a test unit has an error or
+        failure.  Test units that did not start by then are skipped.
+    max_reruns: How many times to run test methods that fail or cause an
+        error again, in new tasks, to tell flaky tests from consistently
+        failing ones.
+    shard_durations: A dictionary mapping full names of test methods, classes
+        and modules to durations in seconds (like
+        models.get_test_durations() returns), which every executor of a
+        sharded batch has to pass unchanged to balance the shards by
+        estimated duration, or None to shard by name.
 
   Returns:
     The TestBatch created for the run.
 
   Raises:
     TypeError: Wrong input arguments.
+    ValueError: If shard_index is not in [0, shard_count) or max_reruns is
+        negative.
   """
   utils.check_type(fullname, 'fullname', str)
   utils.check_type(conf, 'conf', config.Config)
+  utils.check_type(shard_index, 'shard_index', int)
+  utils.check_type(shard_count, 'shard_count', int)
+  utils.check_type(changed_paths, 'changed_paths', (types.NoneType, list))
+  utils.check_type(fail_fast, 'fail_fast', bool)
+  utils.check_type(max_reruns, 'max_reruns', int)
+  utils.check_type(shard_durations, 'shard_durations', (types.NoneType, dict))
+  if not 0 <= shard_index < shard_count:
+    raise ValueError('shard_index must be at least 0 and under shard_count '
+                     '(%s) but is %s.' % (shard_count, shard_index))
+  if max_reruns < 0:
+    raise ValueError('max_reruns must not be negative but is %s.' %
+                     max_reruns)
   ctx_options = models.get_ctx_options(conf)
   # It's necessary to set the key because if ctx_options['use_datastore'] ==
   # False, the key will not be set to something reasonable automatically.
   batch_key = ndb.Key(models.TestBatch, utils.rand_unique_id())
   batch = models.TestBatch(fullname=fullname, key=batch_key)
-  batch.put(**ctx_options)
-  call = deferred.DeferredCall(_initialize_batch, fullname, batch_key, conf)
-  if conf.storage == 'immediate':
+  progress_key = models.BatchProgress.get_key(batch_key)
+  entities = [batch, models.BatchProgress(key=progress_key)]
+  if fail_fast or max_reruns:
+    status_key = models.BatchStatus.get_key(batch_key)
+    entities.append(models.BatchStatus(key=status_key, fail_fast=fail_fast,
+                                       max_reruns=max_reruns))
+  ndb.put_multi(entities, **ctx_options)
+  call = deferred.DeferredCall(_initialize_batch, fullname, batch_key, conf,
+                               shard_index, shard_count, changed_paths,
+                               shard_durations,
+                               _name=_get_task_name(batch_key, 'init'))
+  if models.is_immediate(conf):
     call.run()
     # _initialize_batch() should have updated batch data
     return batch.key.get(**ctx_options)
   else:
     deferred.defer_multi([call], queue=conf.test_queue)
     return batch
+
+
+def cancel_batch(batch_key, conf):
+  """Cancels a batch that is still running.
+
+  The tasks of the batch that did not start yet are deleted from the queue,
+  and the batch and its results are deleted.  Tasks that are already running
+  stop before their next test unit and do not store their results.  A small
+  BatchStatus entity that marks the batch as cancelled is kept until the
+  batch is deleted by cleanup.delete_old_batches().
+
+  Args:
+    batch_key: The key of the TestBatch to cancel.
+    conf: The configuration to use.
+
+  Returns:
+    How many queued tasks were deleted.
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(batch_key, 'batch_key', ndb.Key)
+  utils.check_type(conf, 'conf', config.Config)
+  ctx_options = models.get_ctx_options(conf)
+  status_key = models.BatchStatus.get_key(batch_key)
+  status = status_key.get(**ctx_options)
+  if not status:
+    status = models.BatchStatus(key=status_key)
+  status.cancelled = True
+  status.put(**ctx_options)
+  batch = batch_key.get(**ctx_options)
+  # The batch may have been deleted already, e.g. by an earlier cancellation.
+  num_units = (batch and batch.num_units) or 0
+  names = [_get_task_name(batch_key, 'init')]
+  names.extend(_get_task_name(batch_key, i) for i in range(num_units))
+  num_deleted = 0
+  try:
+    num_deleted = deferred.delete_tasks(names, queue=conf.test_queue)
+  # Running tasks exit early anyway; pylint: disable-msg=W0703
+  except:
+    logging.exception('[aeta] Error deleting the queued tasks of the batch '
+                      '%s.', batch_key.id())
+  if batch is not None:
+    ndb.delete_multi(_get_batch_keys(batch, conf), **ctx_options)
+  logging.info('[aeta] Cancelled the batch %s and deleted %s queued tasks.',
+               batch_key.id(), num_deleted)
+  return num_deleted
@@ -59,6 +59,18 @@ aeta.REST_BATCH_INFO_PATH = 'batch_info';
  */
 aeta.REST_BATCH_RESULTS_PATH = 'batch_results';
 
+/**
+ * The path to retrieve the import profile of a batch, relative to REST_PATH.
+ * @const
+ */
+aeta.REST_IMPORT_PROFILE_PATH = 'import_profile';
+
+/**
+ * How many of the most expensive imports to show.
+ * @const
+ */
+aeta.NUM_IMPORTS_SHOWN = 20;
+
 /**
  * How long to wait between polls to the server, in milliseconds.  The wait
  * time is incremented by this time before each call.
@@ -197,14 +209,21 @@ aeta.getMethods = function(fullname, successCallback, errorCallback) {
 /**
  * Asynchronously starts a test batch running.
  * @param {string} fullname The name of the test to run.
+ * @param {boolean} failFast Whether to abort the batch after the first test
+ *     unit with an error or failure.
+ * @param {number} maxReruns How many times to run failed test methods again.
  * @param {function(number)} successCallback The function to call with the
  *     batch id of the new batch, if successful.
  * @param {function(string)} errorCallback The function to call with the error
  *     message, if there is an error.
  */
-aeta.startBatch = function(fullname, successCallback, errorCallback) {
-  aeta.getRestJsonData(aeta.REST_START_BATCH_PATH + '/' + fullname, '',
-                       successCallback, errorCallback);
+aeta.startBatch = function(fullname, failFast, maxReruns, successCallback,
+                           errorCallback) {
+  var params = [];
+  if (failFast) params.push('fail_fast=1');
+  if (maxReruns) params.push('max_reruns=' + maxReruns);
+  aeta.getRestJsonData(aeta.REST_START_BATCH_PATH + '/' + fullname,
+                       params.join('&'), successCallback, errorCallback);
 };
 
 /**
@@ -241,6 +260,54 @@ aeta.batchResults = function(batchId, start, successCallback, errorCallback) {
   aeta.getRestJsonData(url, null, successCallback, errorCallback);
 };
 
+/**
+ * Requests the import profile of a test batch.
+ * @param {number} batchId The id of the batch to get the profile for.
+ * @param {function({num_profiles: number,
+ *                   total_secs: number,
+ *                   modules: !Array.<{module: string,
+ *                                     inclusive_secs: number,
+ *                                     exclusive_secs: number,
+ *                                     inclusive_kb: ?number,
+ *                                     exclusive_kb: ?number}>})}
+ *     successCallback The function to call with the profile, if successful.
+ * @param {function(string)} errorCallback The function to call with the error
+ *     message, if there is an error.
+ */
+aeta.importProfile = function(batchId, successCallback, errorCallback) {
+  aeta.getRestJsonData(aeta.REST_IMPORT_PROFILE_PATH + '/' + batchId, null,
+                       successCallback, errorCallback);
+};
+
+/**
+ * Formats an import profile as a table of the most expensive imports.
+ * @param {{total_secs: number, modules: !Array.<Object>}} profile The profile
+ *     as returned by the server.
+ * @return {string} A human-readable description of the profile.
+ */
+aeta.formatImportProfile = function(profile) {
+  function pad(str, length) {
+    while (str.length < length) str = ' ' + str;
+    return str;
+  }
+  function formatKb(kb) {
+    return kb == null ? '?' : String(kb);
+  }
+  var lines = ['Most expensive imports (' + profile.total_secs.toFixed(3) +
+               ' s importing in total):',
+               pad('own s', 9) + pad('total s', 9) + pad('own KB', 9) +
+               pad('total KB', 9) + '  module'];
+  var modules = profile.modules.slice(0, aeta.NUM_IMPORTS_SHOWN);
+  for (var i = 0; i < modules.length; ++i) {
+    var module = modules[i];
+    lines.push(pad(module.exclusive_secs.toFixed(3), 9) +
+               pad(module.inclusive_secs.toFixed(3), 9) +
+               pad(formatKb(module.exclusive_kb), 9) +
+               pad(formatKb(module.inclusive_kb), 9) + '  ' + module.module);
+  }
+  return lines.join('\n');
+};
+
 
 /**
  * Returns the length of the greatest common prefix between two arrays.
@@ -585,7 +652,10 @@ aeta.TestObject.prototype.run = function() {
   this.recursivelyClearMessages();
   this.setState(aeta.STATE_RUNNING);
   aeta.updateDisplayedOutput();
-  new aeta.TestResultUpdater(this.testIndex, this.fullname).startBatch();
+  new aeta.TestResultUpdater(this.testIndex, this.fullname,
+                             $('#fail-fast').is(':checked'),
+                             parseInt($('#max-reruns').val(), 10) || 0)
+      .startBatch();
 };
 
 /**
@@ -711,14 +781,30 @@ aeta.TestIndex.prototype.addErrors = function(errs, state) {
  * @param {!aeta.TestIndex} aeta.testIndex The aeta.TestIndex that should be
  *     updated with results.
  * @param {string} fullname The full name of the test object to run.
+ * @param {boolean} failFast Whether to abort the batch after the first test
+ *     unit with an error or failure.
+ * @param {number} maxReruns How many times to run failed test methods again.
  */
-aeta.TestResultUpdater = function(testIndex, fullname) {
+aeta.TestResultUpdater = function(testIndex, fullname, failFast, maxReruns) {
   /**
    * The full name of the test object to run.
    * @type string
    */
   this.fullname = fullname;
 
+  /**
+   * Whether to abort the batch after the first test unit with an error or
+   * failure.
+   * @type boolean
+   */
+  this.failFast = failFast;
+
+  /**
+   * How many times to run failed test methods again.
+   * @type number
+   */
+  this.maxReruns = maxReruns;
+
   /**
    * Whether or not this test has already started.
    * @type boolean
@@ -764,6 +850,12 @@ aeta.TestResultUpdater = function(testIndex, fullname) {
    * @type {Object.<string, !Array.<string>>}
    */
   this.testUnitMethods = null;
+
+  /**
+   * Whether the server profiled imports for this batch.
+   * @type {boolean}
+   */
+  this.hasImportProfile = false;
 };
 
 /**
@@ -787,6 +879,7 @@ aeta.TestResultUpdater.prototype.getErrorCallback = function() {
 aeta.TestResultUpdater.prototype.updateBatchInfo = function(info) {
   this.numUnits = info.num_units;
   this.testUnitMethods = info.test_unit_methods;
+  this.hasImportProfile = info.import_profile != null;
   for (var testUnit in this.testUnitMethods) {
     var methods = this.testUnitMethods[testUnit];
     for (var i = 0; i < methods.length; ++i) {
@@ -807,11 +900,27 @@ aeta.TestResultUpdater.prototype.updateResults = function(results) {
     this.testIndex.addErrors(result.load_errors);
     this.testIndex.addErrors(result.errors);
     this.testIndex.addErrors(result.failures, aeta.STATE_FAIL);
+    // If the batch was aborted, the methods without timings were not run.
+    var ran = null;
+    if (result.skipped) {
+      ran = {};
+      var timings = (result.timings && result.timings.methods) || [];
+      for (var j = 0; j < timings.length; ++j) {
+        ran[timings[j][0]] = true;
+      }
+      this.testIndex.getOrAdd(result.fullname).addMessage(
+          'Some tests were not run because the batch was aborted after a ' +
+          'failure.');
+    }
     // All methods in the unit that haven't failed/errored must have passed.
     var methodNames = this.testUnitMethods[result.fullname];
     for (var j = 0; j < methodNames.length; ++j) {
       var test = this.testIndex.getOrAdd(methodNames[j]);
       if (test.state != aeta.STATE_ERROR && test.state != aeta.STATE_FAIL) {
+        if (ran && !ran[test.fullname]) {
+          test.setState(aeta.STATE_UNSTARTED);
+          continue;
+        }
         if (test.state != aeta.STATE_RUNNING) {
           aeta.logWarning('Test ' + test.fullname + ' was expected to be ' +
                           ' running but was ' + test.state + '.');
@@ -822,25 +931,51 @@ aeta.TestResultUpdater.prototype.updateResults = function(results) {
     if (result.output) {
       this.testIndex.getOrAdd(result.fullname).addMessage(result.output);
     }
+    if (result.reruns) {
+      var reruns = result.reruns;
+      for (var j = 0; j < reruns.flaky.length; ++j) {
+        var numFailed = reruns.attempts[reruns.flaky[j]].length - 1;
+        this.testIndex.getOrAdd(reruns.flaky[j]).addMessage(
+            'Flaky: passed after ' + numFailed + ' failed attempts.');
+      }
+      for (var j = 0; j < reruns.failing.length; ++j) {
+        var numAttempts = reruns.attempts[reruns.failing[j]].length;
+        this.testIndex.getOrAdd(reruns.failing[j]).addMessage(
+            'Failed all ' + numAttempts + ' attempts.');
+      }
+    }
   }
   aeta.updateDisplayedOutput();
   this.numUnitsFinished += results.length;
 };
 
+/**
+ * Shows an import profile as a message of the test object that was run.
+ * @param {Object} profile The import profile returned by the server.
+ */
+aeta.TestResultUpdater.prototype.showImportProfile = function(profile) {
+  this.testIndex.getOrAdd(this.fullname).addMessage(
+      aeta.formatImportProfile(profile));
+  aeta.updateDisplayedOutput();
+};
+
 /** Starts running the test object. */
 aeta.TestResultUpdater.prototype.startBatch = function() {
   if (!this.hasStarted) {
     this.hasStarted = true;
     var self = this;
-    aeta.startBatch(this.fullname, function(data) {
+    var onStarted = function(data) {
       if (data.batch_id) {
         self.batchId = data.batch_id;
         self.initializeBatchInfo();
       } else {
         self.updateBatchInfo(data.batch_info);
         self.updateResults(data.results);
+        if (data.import_profile) self.showImportProfile(data.import_profile);
       }
-    }, this.getErrorCallback());
+    };
+    aeta.startBatch(this.fullname, this.failFast, this.maxReruns, onStarted,
+                    this.getErrorCallback());
   }
 };
 
@@ -885,6 +1020,10 @@ aeta.TestResultUpdater.prototype.pollResults = function() {
       if (results.length) self.sleepTime = 0;
       self.sleepTime += aeta.POLL_BATCH_WAIT_MS_INC;
       setTimeout(function() { self.pollResults(); }, self.sleepTime);
+    } else if (self.hasImportProfile) {
+      aeta.importProfile(self.batchId, function(profile) {
+        self.showImportProfile(profile);
+      }, self.getErrorCallback());
     }
   }, this.getErrorCallback());
 };
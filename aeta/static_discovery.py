@@ -0,0 +1,639 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Finds tests by parsing the source of test modules rather than importing it.
+
+Importing a test module executes all of its module-level code, which can be
+expensive.  To list the tests in a module, it is usually enough to look at its
+syntax tree: unittest.TestCase subclasses, their test methods, class and
+module fixtures and test functions are all plain definitions.
+
+Some modules define their tests in ways that cannot be determined without
+running the code, e.g. using metaclasses, base classes from other modules,
+load_tests, or conditional definitions.  Such modules are marked as dynamic,
+and callers should fall back to importing them.
+"""
+
+__author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
+
+import imp
+import os
+
+try:
+  import ast
+except ImportError:
+  # Python 2.5 does not have the ast module, so static discovery is not
+  # available there.
+  ast = None
+
+from aeta import utils
+
+
+__all__ = ['ClassInfo',
+           'ModuleInfo',
+           'is_available',
+           'locate_module',
+           'get_module_info',
+           'get_imported_module_names',
+           'get_wrapped_class_name',
+          ]
+
+# Fully qualified names of classes that are known to be unittest.TestCase.
+_TEST_CASE_NAMES = frozenset(['unittest.TestCase',
+                              'unittest.case.TestCase',
+                              'unittest2.TestCase',
+                              'unittest2.case.TestCase',
+                             ])
+
+# Prefix of test methods, see unittest.TestLoader.testMethodPrefix.
+_TEST_METHOD_PREFIX = 'test'
+
+# Names of class-level and module-level fixtures.
+_CLASS_FIXTURE_NAMES = frozenset(['setUpClass', 'tearDownClass'])
+_MODULE_FIXTURE_NAMES = frozenset(['setUpModule', 'tearDownModule'])
+
+# Builtin functions which can modify namespaces in ways that are not visible in
+# the syntax tree.
+_NAMESPACE_FUNCTIONS = frozenset(['setattr', 'globals', 'vars', 'locals',
+                                  'execfile'])
+
+# A mapping from source path to (mtime, include_test_functions, ModuleInfo).
+_MODULE_INFO_CACHE = {}
+
+
+class ClassInfo(object):
+  """Information about a TestCase subclass found in a module's source.
+
+  Attributes:
+    name: The name under which the class is bound in its module.
+    method_names: A sorted list of names of test methods in the class,
+        including inherited ones.
+    has_class_fixture: Whether the class or one of its bases overrides
+        setUpClass or tearDownClass.
+  """
+
+  def __init__(self, name, method_names, has_class_fixture):
+    self.name = name
+    self.method_names = method_names
+    self.has_class_fixture = has_class_fixture
+
+
+class ModuleInfo(object):
+  """Information about the tests found in a module's source.
+
+  Attributes:
+    fullname: The full name of the module.
+    path: The path to the module's source file.
+    classes: A mapping from class name to ClassInfo for all TestCase
+        subclasses in the module.
+    has_module_fixture: Whether the module defines setUpModule or
+        tearDownModule.
+    dynamic_reason: None if the tests could be determined statically,
+        otherwise a string explaining why the module has to be imported.
+  """
+
+  def __init__(self, fullname, path):
+    self.fullname = fullname
+    self.path = path
+    self.classes = {}
+    self.has_module_fixture = False
+    self.dynamic_reason = None
+
+  @property
+  def is_dynamic(self):
+    """Whether the module has to be imported to determine its tests."""
+    return self.dynamic_reason is not None
+
+
+class _DynamicModuleError(Exception):
+  """Raised during analysis if a module's tests cannot be found statically."""
+
+
+def is_available():
+  """Determines whether static discovery is supported by this Python.
+
+  Returns:
+    True if source code can be analyzed, False otherwise.
+  """
+  return ast is not None
+
+
+def get_wrapped_class_name(module_name):
+  """Gets the name of the TestCase that wraps a module's test functions.
+
+  Args:
+    module_name: The full name of the module.
+
+  Returns:
+    The name of the class, e.g. TestUnicodeWrappedTestFunctions for the module
+    package.test_unicode.
+  """
+  _, _, submodule_name = module_name.rpartition('.')
+  test_case_name = ''.join(
+      s[:1].upper() + s[1:] for s in submodule_name.split('_'))
+  return test_case_name + 'WrappedTestFunctions'  # Prevent name collision.
+
+
+def locate_module(fullname):
+  """Finds the module or package a test object belongs to without importing.
+
+  Args:
+    fullname: The full name of a test object, e.g.
+        package.module.Class.method.
+
+  Returns:
+    A (module_name, path, is_package, rest) tuple, or None if no module could
+    be found.  'module_name' is the longest prefix of fullname that names a
+    module or package, 'path' is the path of the module's source file or the
+    package's directory, and 'rest' is a list of the remaining name elements.
+    For modules without source file, 'path' is None.
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(fullname, 'fullname', str)
+  if not fullname:
+    return None
+  elements = fullname.split('.')
+  search_path = None
+  num_found = 0
+  for element in elements:
+    try:
+      f, path, (_, _, kind) = imp.find_module(element, search_path)
+    except ImportError:
+      break
+    if f:
+      f.close()
+    num_found += 1
+    if kind == imp.PKG_DIRECTORY:
+      search_path = [path]
+      continue
+    if kind != imp.PY_SOURCE:
+      path = None
+    return ('.'.join(elements[:num_found]), path, False,
+            elements[num_found:])
+  if search_path is None:
+    return None
+  return ('.'.join(elements[:num_found]), search_path[0], True,
+          elements[num_found:])
+
+
+def get_module_info(fullname, path, include_test_functions=True):
+  """Gets information about the tests in a module by parsing its source.
+
+  Results are cached for as long as the source file is not modified.
+
+  Args:
+    fullname: The full name of the module.
+    path: The path of the module's source file.
+    include_test_functions: Whether test functions in the module should be
+        wrapped into a test case class, see logic.wrap_test_functions.
+
+  Returns:
+    A ModuleInfo for the module.  If the module's tests cannot be determined
+    without importing it (including when it cannot be parsed), the ModuleInfo
+    is dynamic.
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(fullname, 'fullname', str)
+  utils.check_type(path, 'path', str)
+  utils.check_type(include_test_functions, 'include_test_functions', bool)
+  info = ModuleInfo(fullname, path)
+  if ast is None:
+    info.dynamic_reason = 'The ast module is not available.'
+    return info
+  try:
+    mtime = os.stat(path).st_mtime
+  except OSError, e:
+    info.dynamic_reason = str(e)
+    return info
+  cached = _MODULE_INFO_CACHE.get(path)
+  if (cached and cached[0] == mtime and cached[1] == include_test_functions
+      and cached[2].fullname == fullname):
+    return cached[2]
+  try:
+    f = open(path, 'rU')
+    try:
+      source = f.read()
+    finally:
+      f.close()
+    tree = ast.parse(source, path)
+    _ModuleAnalyzer(info, include_test_functions).analyze(tree)
+  except _DynamicModuleError, e:
+    info.classes = {}
+    info.dynamic_reason = str(e)
+  # Any problem reading or parsing the module should be reported by importing
+  # it - pylint:disable-msg=W0703
+  except Exception, e:
+    info.classes = {}
+    info.dynamic_reason = 'Could not parse %s: %s' % (path, e)
+  _MODULE_INFO_CACHE[path] = (mtime, include_test_functions, info)
+  return info
+
+
+def get_imported_module_names(fullname, path):
+  """Gets the names of modules that a module's source imports.
+
+  Python 2 tries imports relative to the current package first, so both the
+  relative and the absolute meaning of every imported name are returned, as
+  well as both meanings of "from a import b" (b might be a module or an
+  attribute of a).  Callers should only consider names of existing modules.
+
+  Args:
+    fullname: The full name of the module.
+    path: The path of the module's source file.
+
+  Returns:
+    A set of full module names, which is empty if the source cannot be parsed.
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(fullname, 'fullname', str)
+  utils.check_type(path, 'path', str)
+  if ast is None:
+    return set()
+  try:
+    f = open(path, 'rU')
+    try:
+      source = f.read()
+    finally:
+      f.close()
+    tree = ast.parse(source, path)
+  # Any problem reading or parsing the module is reported when importing it -
+  # pylint:disable-msg=W0703
+  except Exception:
+    return set()
+  package_parts = fullname.split('.')
+  if os.path.splitext(os.path.basename(path))[0] != '__init__':
+    package_parts = package_parts[:-1]
+  package_name = '.'.join(package_parts)
+  names = set()
+  for node in ast.walk(tree):
+    if isinstance(node, ast.Import):
+      bases = [alias.name for alias in node.names]
+      from_names = []
+    elif isinstance(node, ast.ImportFrom):
+      if node.level:
+        parts = package_parts[:len(package_parts) - node.level + 1]
+        bases = ['.'.join(parts + ([node.module] if node.module else []))]
+      else:
+        bases = [node.module]
+      from_names = [alias.name for alias in node.names]
+    else:
+      continue
+    if package_name and not getattr(node, 'level', 0):
+      bases += ['%s.%s' % (package_name, base) for base in bases]
+    for base in bases:
+      names.add(base)
+      for from_name in from_names:
+        names.add('%s.%s' % (base, from_name))
+  return names
+
+
+def _get_dotted_name(node):
+  """Gets the dotted name of an expression like a.b.c.
+
+  Args:
+    node: An ast expression node.
+
+  Returns:
+    The dotted name as a string, or None if the expression is not a dotted
+    name.
+  """
+  if isinstance(node, ast.Name):
+    return node.id
+  if isinstance(node, ast.Attribute):
+    value = _get_dotted_name(node.value)
+    if value is not None:
+      return '%s.%s' % (value, node.attr)
+  return None
+
+
+def _is_relevant_name(name):
+  """Determines whether binding a name might change the tests in a module.
+
+  Args:
+    name: A name bound in a module or class.
+
+  Returns:
+    True if the name could be a test method, test function, fixture, or test
+    class (by convention, containing 'Test'), False otherwise.
+  """
+  return (name.startswith(_TEST_METHOD_PREFIX) or 'Test' in name or
+          name in _CLASS_FIXTURE_NAMES or name in _MODULE_FIXTURE_NAMES or
+          name == 'load_tests')
+
+
+class _ModuleAnalyzer(object):
+  """Finds the tests in a module's syntax tree.
+
+  Only top-level statements are analyzed.  Whenever something is found that
+  might define tests in a way that can only be determined by running the
+  code, _DynamicModuleError is raised.
+  """
+
+  def __init__(self, info, include_test_functions):
+    """Initializes the analyzer.
+
+    Args:
+      info: The ModuleInfo to fill in.
+      include_test_functions: Whether test functions should be wrapped into a
+          test case class.
+    """
+    self.info = info
+    self.include_test_functions = include_test_functions
+    # A mapping from name bound in the module to the fully qualified name of
+    # the module or object it was imported as.
+    self.imports = {}
+    # A mapping from class name to (is_test_case, method names, has fixture)
+    # for all classes defined in the module so far.
+    self.local_classes = {}
+    # Names of all module-level functions starting with 'test'.
+    self.test_functions = set()
+    # All names bound at module level.
+    self.bound_names = set()
+    # Whether the module's __name__ is changed.
+    self.renames_module = False
+
+  def analyze(self, tree):
+    """Analyzes a module and fills in self.info.
+
+    Args:
+      tree: The ast.Module of the module's source.
+
+    Raises:
+      _DynamicModuleError: The tests cannot be determined statically.
+    """
+    for stmt in tree.body:
+      self._visit_statement(stmt, conditional=False)
+    for name, (is_test_case, methods, has_fixture) in (
+        self.local_classes.items()):
+      if is_test_case:
+        self.info.classes[name] = ClassInfo(name, sorted(methods),
+                                            has_fixture)
+    if self.include_test_functions and self.test_functions:
+      if self.renames_module:
+        # The name of the wrapping class is based on the module's __name__.
+        raise _DynamicModuleError('The module changes its __name__.')
+      class_name = get_wrapped_class_name(self.info.fullname)
+      if class_name in self.bound_names:
+        raise _DynamicModuleError('%s is defined in the module.' % class_name)
+      self.info.classes[class_name] = ClassInfo(
+          class_name, sorted(self.test_functions), False)
+
+  def _visit_statement(self, stmt, conditional):
+    """Analyzes a single module-level statement.
+
+    Args:
+      stmt: The ast statement node.
+      conditional: Whether the statement is only executed conditionally, e.g.
+          inside an if or try statement.
+
+    Raises:
+      _DynamicModuleError: The tests cannot be determined statically.
+    """
+    if isinstance(stmt, ast.Import):
+      for alias in stmt.names:
+        if alias.asname:
+          self._bind(alias.asname, alias.name)
+        else:
+          top_name = alias.name.split('.')[0]
+          self._bind(top_name, top_name)
+    elif isinstance(stmt, ast.ImportFrom):
+      for alias in stmt.names:
+        if alias.name == '*':
+          raise _DynamicModuleError('"from %s import *" is used.' %
+                                    stmt.module)
+        name = alias.asname or alias.name
+        qualified_name = '%s.%s' % (stmt.module or '', alias.name)
+        if qualified_name in _TEST_CASE_NAMES:
+          self._bind(name, qualified_name)
+          # The imported TestCase itself will be found by dir(module).
+          self.local_classes[name] = (True, set(), False)
+        elif name in _MODULE_FIXTURE_NAMES:
+          self._bind(name, qualified_name)
+          self.info.has_module_fixture = True
+        elif _is_relevant_name(name):
+          raise _DynamicModuleError('%s is imported from %s.' %
+                                    (name, stmt.module))
+        else:
+          self._bind(name, qualified_name)
+    elif isinstance(stmt, ast.ClassDef):
+      if conditional:
+        raise _DynamicModuleError('Class %s is defined conditionally.' %
+                                  stmt.name)
+      self._visit_class(stmt)
+    elif isinstance(stmt, ast.FunctionDef):
+      if conditional and _is_relevant_name(stmt.name):
+        raise _DynamicModuleError('Function %s is defined conditionally.' %
+                                  stmt.name)
+      self._visit_function(stmt.name)
+    elif isinstance(stmt, (ast.Assign, ast.AugAssign)):
+      self._check_namespace_functions(stmt)
+      targets = getattr(stmt, 'targets', None) or [stmt.target]
+      for target in targets:
+        self._visit_assignment_target(target)
+    elif isinstance(stmt, ast.Delete):
+      for target in stmt.targets:
+        if isinstance(target, ast.Name) and (
+            target.id in self.local_classes or _is_relevant_name(target.id)):
+          raise _DynamicModuleError('%s is deleted.' % target.id)
+    elif isinstance(stmt, ast.Expr):
+      self._check_namespace_functions(stmt)
+    elif isinstance(stmt, ast.If):
+      for sub_stmt in stmt.body + stmt.orelse:
+        self._visit_statement(sub_stmt, conditional=True)
+    elif isinstance(stmt, ast.TryExcept):
+      sub_stmts = stmt.body + stmt.orelse
+      for handler in stmt.handlers:
+        sub_stmts += handler.body
+      for sub_stmt in sub_stmts:
+        self._visit_statement(sub_stmt, conditional=True)
+    elif isinstance(stmt, ast.TryFinally):
+      for sub_stmt in stmt.body + stmt.finalbody:
+        self._visit_statement(sub_stmt, conditional=True)
+    elif isinstance(stmt, ast.Exec):
+      raise _DynamicModuleError('exec is used at module level.')
+    elif not isinstance(stmt, (ast.Pass, ast.Print, ast.Assert, ast.Global)):
+      # Loops and with statements might bind anything.
+      self._check_namespace_functions(stmt)
+      for node in ast.walk(stmt):
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef)):
+          raise _DynamicModuleError('%s is defined in a compound statement.' %
+                                    node.name)
+        if (isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+            and _is_relevant_name(node.id)):
+          raise _DynamicModuleError('%s is assigned in a compound statement.' %
+                                    node.id)
+
+  def _check_namespace_functions(self, stmt):
+    """Checks that a statement does not modify namespaces using builtins.
+
+    Args:
+      stmt: The ast statement node.
+
+    Raises:
+      _DynamicModuleError: The statement calls e.g. setattr or globals.
+    """
+    for node in ast.walk(stmt):
+      if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+          node.func.id in _NAMESPACE_FUNCTIONS):
+        raise _DynamicModuleError('%s() is called at module level.' %
+                                  node.func.id)
+
+  def _bind(self, name, qualified_name):
+    """Records that a name is bound to an imported module or object.
+
+    Args:
+      name: The name bound in the module.
+      qualified_name: The fully qualified name of what was imported.
+    """
+    self.imports[name] = qualified_name
+    self.bound_names.add(name)
+    self.local_classes.pop(name, None)
+    self.test_functions.discard(name)
+
+  def _visit_function(self, name):
+    """Records a module-level function definition.
+
+    Args:
+      name: The name of the function.
+
+    Raises:
+      _DynamicModuleError: The tests cannot be determined statically.
+    """
+    if name == 'load_tests':
+      raise _DynamicModuleError('The module defines load_tests.')
+    self.bound_names.add(name)
+    self.imports.pop(name, None)
+    if name in self.local_classes:
+      raise _DynamicModuleError('Class %s is redefined.' % name)
+    if name in _MODULE_FIXTURE_NAMES:
+      self.info.has_module_fixture = True
+    if name.startswith(_TEST_METHOD_PREFIX):
+      self.test_functions.add(name)
+
+  def _visit_assignment_target(self, target):
+    """Analyzes the target of a module-level assignment.
+
+    Args:
+      target: The ast expression node assigned to.
+
+    Raises:
+      _DynamicModuleError: The tests cannot be determined statically.
+    """
+    if isinstance(target, (ast.Tuple, ast.List)):
+      for element in target.elts:
+        self._visit_assignment_target(element)
+    elif isinstance(target, ast.Name):
+      name = target.id
+      if name == '__name__':
+        self.renames_module = True
+      elif name in _MODULE_FIXTURE_NAMES:
+        self.info.has_module_fixture = True
+      elif name in self.local_classes or _is_relevant_name(name):
+        raise _DynamicModuleError('%s is assigned at module level.' % name)
+      self.bound_names.add(name)
+      self.imports.pop(name, None)
+    elif isinstance(target, ast.Attribute):
+      # Attributes of test classes, e.g. __name__, may be changed, but adding
+      # test methods or fixtures to them cannot be tracked.
+      owner = _get_dotted_name(target.value)
+      if owner in self.local_classes and _is_relevant_name(target.attr):
+        raise _DynamicModuleError('%s.%s is assigned at module level.' %
+                                  (owner, target.attr))
+    elif isinstance(target, ast.Subscript):
+      if isinstance(target.value, ast.Call):
+        raise _DynamicModuleError('A namespace is modified at module level.')
+
+  def _get_base_info(self, base):
+    """Gets information about a base class of a class in the module.
+
+    Args:
+      base: The ast expression node of the base class.
+
+    Returns:
+      A (is_test_case, method names, has_fixture) tuple.
+
+    Raises:
+      _DynamicModuleError: The base class cannot be analyzed statically.
+    """
+    name = _get_dotted_name(base)
+    if name is None:
+      raise _DynamicModuleError('A base class is not a plain name.')
+    if name in self.local_classes:
+      return self.local_classes[name]
+    first, _, rest = name.partition('.')
+    qualified_name = self.imports.get(first)
+    if qualified_name and rest:
+      qualified_name = '%s.%s' % (qualified_name, rest)
+    if qualified_name in _TEST_CASE_NAMES:
+      return (True, set(), False)
+    if name == 'object' and first not in self.bound_names:
+      return (False, set(), False)
+    raise _DynamicModuleError('Base class %s cannot be analyzed.' % name)
+
+  def _visit_class(self, node):
+    """Analyzes a module-level class definition.
+
+    Args:
+      node: The ast.ClassDef node.
+
+    Raises:
+      _DynamicModuleError: The tests cannot be determined statically.
+    """
+    if getattr(node, 'decorator_list', None):
+      raise _DynamicModuleError('Class %s is decorated.' % node.name)
+    if node.name in self.local_classes:
+      raise _DynamicModuleError('Class %s is redefined.' % node.name)
+    is_test_case = False
+    methods = set()
+    has_fixture = False
+    for base in node.bases:
+      base_is_test_case, base_methods, base_has_fixture = (
+          self._get_base_info(base))
+      is_test_case = is_test_case or base_is_test_case
+      methods.update(base_methods)
+      has_fixture = has_fixture or base_has_fixture
+    for stmt in node.body:
+      if isinstance(stmt, ast.FunctionDef):
+        name = stmt.name
+        if name.startswith(_TEST_METHOD_PREFIX):
+          methods.add(name)
+        elif name in _CLASS_FIXTURE_NAMES:
+          has_fixture = True
+        continue
+      if isinstance(stmt, ast.ClassDef):
+        # Nested classes are callable, so they could be test methods.
+        if _is_relevant_name(stmt.name):
+          raise _DynamicModuleError('%s.%s is a nested class.' %
+                                    (node.name, stmt.name))
+        continue
+      for sub_node in ast.walk(stmt):
+        if (isinstance(sub_node, ast.Name) and
+            isinstance(sub_node.ctx, ast.Store) and
+            (_is_relevant_name(sub_node.id) or
+             sub_node.id == '__metaclass__')):
+          raise _DynamicModuleError('%s.%s is assigned in the class body.' %
+                                    (node.name, sub_node.id))
+        if (isinstance(sub_node, ast.FunctionDef) and
+            not isinstance(stmt, ast.FunctionDef)):
+          raise _DynamicModuleError('%s.%s is defined conditionally.' %
+                                    (node.name, sub_node.name))
+    self.bound_names.add(node.name)
+    self.imports.pop(node.name, None)
+    self.local_classes[node.name] = (is_test_case, methods, has_fixture)
@@ -38,6 +38,7 @@ class DeferredCall(object):
   Attributes:
     func: The function to call.
     countdown: How many seconds to wait before calling the function.
+    name: The name of the task, or None to let the task queue choose one.
     args: Arguments to pass to func.
     kwargs: Keyword arguments to pass to func.
   """
@@ -48,6 +49,9 @@ class DeferredCall(object):
     Args:
       func: The function to call.
       _countdown: How many seconds to wait before running the task.
+      _name: The name of the task.  Names have to be unique within the queue
+          (even after the task ran), and a named task can be deleted from the
+          queue by delete_tasks().
       *args: Arguments to pass to func.
       **kwargs: Keyword arguments to pass to func.
 
@@ -59,6 +63,7 @@ class DeferredCall(object):
     self.func = func
     self.args = args
     self.countdown = kwargs.pop('_countdown', 0)
+    self.name = kwargs.pop('_name', None)
     self.kwargs = kwargs
 
   def run(self):
@@ -69,6 +74,9 @@ class DeferredCall(object):
 def defer_multi(calls, queue=_DEFAULT_QUEUE):
   """Defers multiple function calls.
 
+  Named calls that were already deferred (e.g. by an earlier attempt of a
+  retried task) are not deferred again.
+
   Args:
     calls: A list of DeferredCall objects.
     queue: The queue to run the tasks in.
@@ -79,8 +87,34 @@ def defer_multi(calls, queue=_DEFAULT_QUEUE):
     tasks = []
     for call in calls[batch_i : batch_i + taskqueue.MAX_TASKS_PER_ADD]:
       tasks.append(taskqueue.Task(url=url, countdown=call.countdown,
+                                  name=call.name,
                                   payload=pickle.dumps(call)))
-    taskqueue.Queue(queue).add(tasks)
+    try:
+      taskqueue.Queue(queue).add(tasks)
+    except taskqueue.TaskAlreadyExistsError:
+      # The other tasks are still added.
+      logging.info('[aeta] Some named tasks were already deferred.')
+
+
+def delete_tasks(names, queue=_DEFAULT_QUEUE):
+  """Deletes named tasks that did not run yet from a queue.
+
+  Names of tasks that do not exist or already ran are ignored.  Tasks that are
+  running are not stopped.
+
+  Args:
+    names: A list of the names of the tasks to delete.
+    queue: The queue the tasks are in.
+
+  Returns:
+    How many tasks were deleted.
+  """
+  num_deleted = 0
+  for batch_i in range(0, len(names), taskqueue.MAX_TASKS_PER_ADD):
+    tasks = taskqueue.Queue(queue).delete_tasks_by_name(
+        names[batch_i : batch_i + taskqueue.MAX_TASKS_PER_ADD])
+    num_deleted += len([task for task in tasks if task.was_deleted])
+  return num_deleted
 
 
 def defer(func, *args, **kwargs):
@@ -92,6 +126,7 @@ def defer(func, *args, **kwargs):
     func: The function to call.
     _queue: The name of the queue to use for this task.
     _countdown: How many seconds to wait before running the task.
+    _name: The name of the task, see DeferredCall.
     *args: Arguments to pass to func.
     **kwargs: Keyword arguments to pass to func.
 
@@ -99,7 +134,7 @@ def defer(func, *args, **kwargs):
     ValueError: func is not callable
   """
   queue = kwargs.pop('_queue', _DEFAULT_QUEUE)
-  # DeferredCall() will handle the _countdown keyword argument.
+  # DeferredCall() will handle the _countdown and _name keyword arguments.
   defer_multi([DeferredCall(func, *args, **kwargs)], queue=queue)
 
 
@@ -18,6 +18,8 @@ __author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
 
 import base64
 import os
+import sys
+import threading
 
 
 def type_name(typ):
@@ -69,3 +71,60 @@ def rand_unique_id():
   return base64.urlsafe_b64encode(os.urandom(18))
 
 
+def map_in_threads(func, items, max_threads):
+  """Calls a function on each item using a bounded number of threads.
+
+  This is useful for I/O bound work such as reading many files.  The results
+  are in the same order as the items, no matter in which order the calls
+  finish.
+
+  Args:
+    func: The function to call with each item.
+    items: A list of items.
+    max_threads: The maximum number of threads to use.  If this is 1 or less,
+        all calls are made in the calling thread.
+
+  Returns:
+    A list with the result of func(item) for each item.
+
+  Raises:
+    TypeError: Wrong input arguments.
+    Exception: The exception raised by the first item (in the order of items)
+        for which func raised an exception.
+  """
+  check_type(items, 'items', list)
+  check_type(max_threads, 'max_threads', int)
+  num_threads = min(max_threads, len(items))
+  if num_threads <= 1:
+    return [func(item) for item in items]
+  results = [None] * len(items)
+  exc_infos = [None] * len(items)
+  # Each thread repeatedly takes the index of the next item to process.
+  next_index = [0]
+  lock = threading.Lock()
+
+  def work():
+    while True:
+      lock.acquire()
+      try:
+        i = next_index[0]
+        next_index[0] += 1
+      finally:
+        lock.release()
+      if i >= len(items):
+        return
+      try:
+        results[i] = func(items[i])
+      # Reraised in the calling thread; pylint:disable-msg=W0702
+      except:
+        exc_infos[i] = sys.exc_info()
+
+  threads = [threading.Thread(target=work) for _ in range(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  for exc_info in exc_infos:
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+  return results
@@ -0,0 +1,116 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prepares new instances for running tests.
+
+The first test task that runs on a new instance has to import aeta, ndb, and
+the test modules, which makes the first tasks of every batch slow.  Warming up
+an instance does this work ahead of time.
+
+To warm up instances with aeta, enable warmup requests and route them to aeta
+in app.yaml:
+
+  inbound_services:
+  - warmup
+
+  handlers:
+  - url: /_ah/warmup
+    script: aeta.warmup.APP
+
+or, if you are using Python 2.5, "script: aeta/warmup.py".  Applications that
+already handle warmup requests can call warm_up() from their handler instead.
+"""
+
+__author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
+
+import logging
+import time
+import types
+
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp import util
+
+from aeta import config
+from aeta import logic
+from aeta import utils
+# Imported so they are loaded when warming up - pylint:disable-msg=W0611
+from aeta import models
+from aeta import runner
+
+
+__all__ = ['warm_up', 'WarmupRequestHandler']
+
+
+def warm_up(conf=None):
+  """Imports the test modules and indexes their tests ahead of time.
+
+  Test modules are imported one at a time until all are imported or
+  conf.warmup_budget_secs have passed, so that warmup requests do not time out
+  for large test suites.  Modules that were not imported yet are imported when
+  they are needed, as usual.
+
+  Args:
+    conf: The configuration to use, or None to load it.
+
+  Returns:
+    A dictionary with the number of imported test modules ('num_modules'),
+    the number of test modules that were skipped because the budget ran out
+    ('num_skipped') and the time warming up took in seconds ('secs').
+
+  Raises:
+    TypeError: Wrong input arguments.
+  """
+  utils.check_type(conf, 'conf', (types.NoneType, config.Config))
+  start = time.time()
+  if conf is None:
+    conf = config.get_config()
+  module_names = []
+  for package_name in conf.test_package_names:
+    module_names.extend(logic.get_module_names_in_package(
+        package_name, conf.test_module_pattern))
+  num_modules = 0
+  for module_name in module_names:
+    if time.time() - start >= conf.warmup_budget_secs:
+      break
+    # The module is imported explicitly, since getting its tests does not
+    # import it with static discovery.  Getting the methods adds its tests to
+    # the name index.  Errors are reported when the tests are run.
+    logic.load_module_from_module_name(
+        module_name, include_test_functions=conf.include_test_functions)
+    test = logic.get_requested_object(module_name, conf)
+    test.get_methods(conf)
+    num_modules += 1
+  stats = {'num_modules': num_modules,
+           'num_skipped': len(module_names) - num_modules,
+           'secs': time.time() - start}
+  logging.info('[aeta] Warmed up in %.3fs: imported %s test modules, skipped '
+               '%s.', stats['secs'], stats['num_modules'],
+               stats['num_skipped'])
+  return stats
+
+
+class WarmupRequestHandler(webapp.RequestHandler):
+  """Request handler for warmup requests (/_ah/warmup)."""
+
+  def get(self):
+    warm_up()
+    self.response.out.write('Warmed up.')
+
+
+# The app object is used in a Python 2.7 runtime.
+APP = webapp.WSGIApplication([('/_ah/warmup', WarmupRequestHandler)])
+
+# In a Python 2.5 environment, run this as a CGI script.
+if __name__ == '__main__':
+  util.run_wsgi_app(APP)
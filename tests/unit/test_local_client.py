@@ -358,6 +358,12 @@ class AetaCommunicatorTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertRaises(local_client.RestApiError, self.comm._get_rest_json_data,
                       'suffix')
 
+  def test_cancel_batch(self):
+    self.authenticator.expected_url = self.comm.rest_path + 'cancel_batch/123'
+    self.authenticator.expected_data = ''
+    self.authenticator.url_content = '{"num_tasks_deleted": 2}'
+    self.assertEqual({'num_tasks_deleted': 2}, self.comm.cancel_batch('123'))
+
 
 class TestResultUpdaterTest(unittest.TestCase, utils.MockAttributeMixin):
   """Tests for the _TestResultUpdater class."""
@@ -396,8 +402,12 @@ class TestResultUpdaterTest(unittest.TestCase, utils.MockAttributeMixin):
     ]
 
     @self.mock(local_client.AetaCommunicator)
-    def start_batch(comm_self, testname):
+    def start_batch(comm_self, testname, shard_index=0, shard_count=1,
+                    changed_paths=None, fail_fast=False, max_reruns=0):
       self.assertEqual(self.testname, testname)
+      self.assertEqual((0, 1, None, False, 0),
+                       (shard_index, shard_count, changed_paths, fail_fast,
+                        max_reruns))
       self.assertFalse(self.started_batch)
       self.started_batch = True
       return {'batch_id': self.batch_id}
@@ -418,14 +428,17 @@ class TestResultUpdaterTest(unittest.TestCase, utils.MockAttributeMixin):
         self.fail('Slept more than necessary')
       self.sleep_count += 1
 
+    self.partial_results = []
+
     @self.mock(local_client.AetaCommunicator)
-    def batch_results(comm_self, batch_id, start):
+    def batch_results(comm_self, batch_id, start, partial=False):
       self.assertEqual(self.batch_id, batch_id)
+      self.assertTrue(partial)
       results = []
       for i in range(start, len(self.finished_results)):
         if not self.finished_results[i]: break
         results.append(self.finished_results[i])
-      return results
+      return {'results': results, 'partial_results': self.partial_results}
 
     # We need fake test cases to pass into generated test methods as self.
     class Case(unittest.TestCase):
@@ -453,8 +466,12 @@ class TestResultUpdaterTest(unittest.TestCase, utils.MockAttributeMixin):
         'fullname': 'tests.Case2', 'output': 'everything is good'}
 
     @self.mock(local_client.AetaCommunicator)
-    def start_batch(comm_self, testname):
+    def start_batch(comm_self, testname, shard_index=0, shard_count=1,
+                    changed_paths=None, fail_fast=False, max_reruns=0):
       self.assertEqual(self.testname, testname)
+      self.assertEqual((0, 1, None, False, 0),
+                       (shard_index, shard_count, changed_paths, fail_fast,
+                        max_reruns))
       self.assertFalse(self.started_batch)
       self.started_batch = True
       return {'batch_info': self.future_batch_info,
@@ -485,6 +502,40 @@ class TestResultUpdaterTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertEqual('some stuff happened',
                      self.updater.test_outputs['tests.Case1.test1'])
 
+  def test_poll_partial_results(self):
+    self.partial_results = [
+        {'index': 1, 'fullname': 'tests.Case2',
+         'methods': [['tests.Case2.test1', 'pass', None],
+                     ['tests.Case2.test2', 'fail', 'Not as expected']]}]
+    self.updater.initialize()
+    self.updater.poll_results()
+    self.assertEqual(1, self.updater.num_units_finished)
+    self.assertEqual(set(['tests.Case1.test1', 'tests.Case1.test2',
+                          'tests.Case2.test1', 'tests.Case2.test2']),
+                     self.updater.test_methods_finished)
+    self.assertEqual({'tests.Case1.test2': 'Things are not as expected',
+                      'tests.Case2.test2': 'Not as expected'},
+                     self.updater.test_failures)
+
+  def test_output_after_partial_results(self):
+    self.partial_results = [
+        {'index': 0, 'fullname': 'tests.Case1',
+         'methods': [['tests.Case1.test1', 'error', 'TypeError']]}]
+    self.finished_results[0] = None
+    self.updater.initialize()
+    self.updater.poll_results()
+    self.assertEqual(set(['tests.Case1.test1']),
+                     self.updater.test_methods_finished)
+    self.partial_results = []
+    self.finished_results[0] = {
+        'load_errors': [], 'errors': [('tests.Case1.test1', 'TypeError')],
+        'failures': [], 'fullname': 'tests.Case1',
+        'output': 'some stuff happened'}
+    self.updater.poll_results()
+    # The output goes to the first method that was not reported yet.
+    self.assertEqual({'tests.Case1.test2': 'some stuff happened'},
+                     self.updater.test_outputs)
+
   def test_create_test_method_error(self):
     self.updater.initialize()
     method = self.updater.create_test_method('tests.Case1.test1')
@@ -510,6 +561,82 @@ class TestResultUpdaterTest(unittest.TestCase, utils.MockAttributeMixin):
     method = self.updater.create_test_method('tests.badmodule.Case3.test1')
     self.assertRaises(local_client.TestError, method, self.test_case)
 
+  def test_flaky(self):
+    self.partial_results = [
+        {'index': 1, 'fullname': 'tests.Case2',
+         'methods': [['tests.Case2.test1', 'fail', 'Not as expected']]}]
+    self.updater.initialize()
+    self.updater.poll_results()
+    self.assertTrue('tests.Case2.test1' in self.updater.test_failures)
+    self.partial_results = []
+    self.finished_results[1] = {
+        'load_errors': [], 'errors': [], 'failures': [],
+        'fullname': 'tests.Case2', 'output': '',
+        'reruns': {'attempts': {'tests.Case2.test1': ['fail', 'pass']},
+                   'flaky': ['tests.Case2.test1'], 'failing': []}}
+    self.updater.poll_results()
+    self.assertFalse('tests.Case2.test1' in self.updater.test_failures)
+    stdout = StringIO.StringIO()
+    self.mock(sys, 'stdout')(stdout)
+    self.updater.create_test_method('tests.Case2.test1')(self.test_case)
+    self.assertTrue('Flaky' in stdout.getvalue())
+
+  def test_flaky_not_reported_early(self):
+    self.partial_results = [
+        {'index': 1, 'fullname': 'tests.Case2',
+         'methods': [['tests.Case2.test1', 'fail', 'Not as expected'],
+                     ['tests.Case2.test2', 'pass', None]]}]
+    self.updater.initialize()
+    self.updater.max_reruns = 2
+    self.updater.poll_results()
+    # The failure may turn out to be flaky once the unit is done.
+    self.assertFalse('tests.Case2.test1' in self.updater.test_failures)
+    self.assertFalse('tests.Case2.test1' in
+                     self.updater.test_methods_finished)
+    self.assertTrue('tests.Case2.test2' in self.updater.test_methods_finished)
+    self.partial_results = []
+    self.finished_results[1] = {
+        'load_errors': [], 'errors': [], 'failures': [],
+        'fullname': 'tests.Case2', 'output': '',
+        'reruns': {'attempts': {'tests.Case2.test1': ['fail', 'pass']},
+                   'flaky': ['tests.Case2.test1'], 'failing': []}}
+    self.updater.poll_results()
+    self.assertTrue('tests.Case2.test1' in self.updater.test_methods_finished)
+    self.assertFalse('tests.Case2.test1' in self.updater.test_failures)
+
+  def test_cancel(self):
+    cancelled = []
+
+    @self.mock(local_client.AetaCommunicator)
+    def cancel_batch(comm_self, batch_id):
+      cancelled.append(batch_id)
+
+    # There is nothing to cancel before the batch was started.
+    self.updater.cancel()
+    self.assertEqual([], cancelled)
+    self.updater.initialize()
+    self.updater.cancel()
+    self.assertEqual([self.batch_id], cancelled)
+    # Batches whose results are all there are done already.
+    self.updater.num_units_finished = self.updater.num_units
+    self.updater.cancel()
+    self.assertEqual([self.batch_id], cancelled)
+
+  def test_skipped_unit(self):
+    self.finished_results[1] = {
+        'load_errors': [], 'errors': [],
+        'failures': [('tests.Case2.test1', 'Not as expected')],
+        'fullname': 'tests.Case2', 'output': '', 'skipped': True,
+        'timings': {'start': 0, 'fixtures': {},
+                    'methods': [['tests.Case2.test1', 0, 5, 'fail']]}}
+    self.updater.initialize()
+    self.updater.poll_results()
+    self.assertEqual(['tests.Case2.test2'], self.updater.test_skips.keys())
+    method = self.updater.create_test_method('tests.Case2.test2')
+    self.assertRaises(unittest.SkipTest, method, self.test_case)
+    method = self.updater.create_test_method('tests.Case2.test1')
+    self.assertRaises(AssertionError, method, self.test_case)
+
 
 class InsertTestMethodTest(unittest.TestCase):
   """Tests for _insert_test_method."""
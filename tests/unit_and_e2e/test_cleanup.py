@@ -0,0 +1,193 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the cleanup module of aeta."""
+
+__author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
+
+# Disable checking; pylint:disable-msg=C0111,W0212,R0904,C0103
+# - docstrings
+# - access to protected members
+# - too many public methods
+# - setUp() and tearDown() method names
+
+import copy
+import unittest
+
+from google.appengine.ext import blobstore
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+import webtest
+
+from aeta import cleanup
+from aeta import config
+from aeta import models
+from aeta import task_deferred as deferred
+from tests import utils
+
+
+class DeleteOldBatchesTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for the delete_old_batches function."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_all_stubs()
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'datastore'
+    self.batch = models.TestBatch(fullname='tests')
+    self.batch.key = ndb.Key(models.TestBatch, 'batchid')
+    self.batch.set_info([], {'tests.a': [], 'tests.b': []}, self.config)
+    self.task = models.RunTestUnitTask(
+        key=models.RunTestUnitTask.get_key(self.batch.key, 0),
+        fullname='tests.a')
+    self.task.set_json('a' * 2000000, self.config)
+    checkpoint = models.UnitCheckpoint(
+        key=models.UnitCheckpoint.get_key(
+            models.RunTestUnitTask.get_key(self.batch.key, 1)))
+    checkpoint.set_json({}, self.config)
+    self.entities = [
+        self.batch, self.task, checkpoint,
+        models.BatchStatus(key=models.BatchStatus.get_key(self.batch.key)),
+        models.BatchProgress(
+            key=models.BatchProgress.get_key(self.batch.key))]
+    models.record_unit_summary(self.task.key, {'passes': 1}, self.config)
+    self.entities.append(
+        models.ProgressShard.get_keys(self.batch.key)[0].get())
+    ndb.put_multi(self.entities)
+
+    @self.mock(config)
+    def get_config():
+      return self.config
+
+    self.deferred = []
+
+    @self.mock(deferred)
+    def defer(func, *args, **kwargs):
+      self.assertEqual(self.config.test_queue, kwargs.pop('_queue'))
+      self.deferred.append((func, args, kwargs))
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    self.tear_down_attributes()
+
+  def run_deferred(self):
+    while self.deferred:
+      (func, args, kwargs) = self.deferred.pop(0)
+      func(*args, **kwargs)
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, cleanup.delete_old_batches, 'conf')
+
+  def test_keep_recent(self):
+    stats = cleanup.delete_old_batches(self.config)
+    self.assertEqual({'num_batches': 0, 'num_entities': 0, 'num_blobs': 0},
+                     stats)
+    for entity in self.entities:
+      self.assertNotEqual(None, entity.key.get())
+    self.assertTrue(blobstore.BlobInfo.get(self.task.blob_key))
+
+  def test_delete_old(self):
+    self.config.batch_retention_secs = -60
+    other_key = ndb.Key(models.TestBatch, 'otherid')
+    other_progress = models.BatchProgress(
+        key=models.BatchProgress.get_key(other_key))
+    other_progress.put()
+    stats = cleanup.delete_old_batches(self.config)
+    # The other batch only has a BatchProgress left, e.g. after it was
+    # cancelled.
+    self.assertEqual(2, stats['num_batches'])
+    self.assertEqual(1, stats['num_blobs'])
+    # The entities, the StoredBlob of the task's data and the other progress.
+    self.assertEqual(len(self.entities) + 2, stats['num_entities'])
+    for entity in self.entities + [other_progress]:
+      self.assertEqual(None, entity.key.get())
+    self.assertEqual([], models.StoredBlob.query().fetch())
+    self.assertEqual(None, blobstore.BlobInfo.get(self.task.blob_key))
+
+  def test_loads_config(self):
+    self.config.batch_retention_secs = -60
+    self.assertEqual(1, cleanup.delete_old_batches()['num_batches'])
+
+  def test_not_in_datastore(self):
+    self.config.batch_retention_secs = -60
+    self.config.storage = 'memcache'
+    task = models.RunTestUnitTask(
+        key=models.RunTestUnitTask.get_key(ndb.Key(models.TestBatch, 'mem'),
+                                           0),
+        fullname='tests.a')
+    task.set_json('a' * 2000000, self.config)
+    task.put(**models.get_ctx_options(self.config))
+    stats = cleanup.delete_old_batches(self.config)
+    # The blob is deleted although its batch is not in the datastore.
+    self.assertEqual(2, stats['num_blobs'])
+    self.assertEqual(None, blobstore.BlobInfo.get(task.blob_key))
+    self.assertEqual([], models.StoredBlob.query().fetch())
+
+  def test_batch_limit(self):
+    self.config.batch_retention_secs = -60
+    self.mock(cleanup, '_MAX_BATCHES_PER_RUN')(1)
+    other_progress = models.BatchProgress(
+        key=models.BatchProgress.get_key(ndb.Key(models.TestBatch, 'other')))
+    other_progress.put()
+    self.assertEqual(1, cleanup.delete_old_batches(self.config)['num_batches'])
+    self.assertEqual([cleanup.delete_old_batches],
+                     [func for (func, _, _) in self.deferred])
+    self.run_deferred()
+    for entity in self.entities + [other_progress]:
+      self.assertEqual(None, entity.key.get())
+    self.assertEqual([], models.StoredBlob.query().fetch())
+
+  def test_blob_limit(self):
+    self.config.batch_retention_secs = -60
+    self.mock(cleanup, '_MAX_BATCHES_PER_RUN')(1)
+    # Only the blobs are left of batches that were not in the datastore.
+    ndb.delete_multi([entity.key for entity in self.entities])
+    tasks = []
+    for i in range(3):
+      task = models.RunTestUnitTask(
+          key=models.RunTestUnitTask.get_key(
+              ndb.Key(models.TestBatch, 'mem'), i),
+          fullname='tests.a')
+      task.set_json('a' * 2000000, self.config)
+      tasks.append(task)
+    stats = cleanup.delete_old_batches(self.config)
+    self.assertEqual(0, stats['num_batches'])
+    self.assertEqual(1, stats['num_blobs'])
+    self.run_deferred()
+    for task in tasks:
+      self.assertEqual(None, blobstore.BlobInfo.get(task.blob_key))
+    self.assertEqual([], models.StoredBlob.query().fetch())
+
+
+class CleanupRequestHandlerTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for the CleanupRequestHandler class."""
+
+  def setUp(self):
+    self.calls = []
+
+    @self.mock(cleanup)
+    def delete_old_batches():
+      self.calls.append(True)
+      return {'num_batches': 2, 'num_entities': 10, 'num_blobs': 1}
+
+    self.app = webtest.TestApp(cleanup.APP)
+
+  def tearDown(self):
+    self.tear_down_attributes()
+
+  def test_cleanup(self):
+    response = self.app.get('/_aeta/cleanup', status=200)
+    self.assertEqual([True], self.calls)
+    self.assertTrue('2' in response.body)
@@ -134,7 +134,22 @@ class LoadConfigTest(unittest.TestCase):
         'protected': False,
         # MOE:end_strip_and_replace 'protected': True,
         'permitted_emails': '',
-        'include_test_functions': True}
+        'include_test_functions': True,
+        'static_discovery': False,
+        'discovery_threads': 1,
+        'unit_target_secs': 0,
+        'record_durations': True,
+        'profile_imports': False,
+        'reload_changed_modules': False,
+        'task_target_secs': 0,
+        'warmup_budget_secs': 20,
+        'stream_results_methods': 0,
+        'stream_results_secs': 10,
+        'task_deadline_secs': 480,
+        'batch_retention_secs': 86400,
+        'max_workers': 4,
+        'max_output_bytes': 100000,
+        'max_method_output_bytes': 20000}
     # Flag used to track if the mock _load_yaml function has been called.
     self._mock_load_yaml_called = False
 
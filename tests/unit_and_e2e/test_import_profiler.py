@@ -0,0 +1,180 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the import_profiler module of aeta."""
+
+__author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
+
+# Disable checking; pylint:disable-msg=C0111,W0212,R0904,C0103
+# - docstrings
+# - access to protected members
+# - too many public methods
+# - setUp() and tearDown() method names
+
+import __builtin__
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from aeta import import_profiler
+
+
+class ImportProfilerTest(unittest.TestCase):
+  """Tests for the ImportProfiler class."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    sys.path.insert(0, self.temp_dir)
+    self.orig_import = __builtin__.__import__
+    self.profiler = import_profiler.ImportProfiler()
+
+  def tearDown(self):
+    self.profiler.stop()
+    sys.path.remove(self.temp_dir)
+    shutil.rmtree(self.temp_dir)
+    for name in ['profiled_outer', 'profiled_inner']:
+      sys.modules.pop(name, None)
+
+  def write_module(self, name, source):
+    f = open(os.path.join(self.temp_dir, name + '.py'), 'w')
+    f.write(source)
+    f.close()
+
+  def get_modules(self):
+    profile = self.profiler.get_profile_json()
+    return dict((module['module'], module) for module in profile['modules'])
+
+  def test_start_stop(self):
+    self.assertTrue(self.profiler.start())
+    self.assertNotEqual(self.orig_import, __builtin__.__import__)
+    self.profiler.stop()
+    self.assertEqual(self.orig_import, __builtin__.__import__)
+
+  def test_only_one_running(self):
+    self.assertTrue(self.profiler.start())
+    other = import_profiler.ImportProfiler()
+    self.assertFalse(other.start())
+    other.stop()
+    self.assertNotEqual(self.orig_import, __builtin__.__import__)
+
+  def test_inclusive_and_exclusive(self):
+    self.write_module('profiled_inner', 'import time\ntime.sleep(0.05)\n')
+    self.write_module('profiled_outer',
+                      'import time\nimport profiled_inner\ntime.sleep(0.02)\n')
+    self.profiler.start()
+    __import__('profiled_outer')
+    self.profiler.stop()
+    modules = self.get_modules()
+    outer = modules['profiled_outer']
+    inner = modules['profiled_inner']
+    self.assertTrue(inner['exclusive_secs'] >= 0.05)
+    self.assertTrue(outer['inclusive_secs'] >= 0.07)
+    self.assertTrue(outer['exclusive_secs'] >= 0.02)
+    self.assertTrue(outer['exclusive_secs'] < outer['inclusive_secs'] - 0.04)
+    profile = self.profiler.get_profile_json()
+    self.assertEqual('profiled_inner', profile['modules'][0]['module'])
+    self.assertAlmostEqual(outer['inclusive_secs'], profile['total_secs'])
+
+  def test_loaded_modules_ignored(self):
+    self.profiler.start()
+    __import__('os')
+    self.profiler.stop()
+    self.assertEqual({}, self.get_modules())
+
+  def test_import_error(self):
+    self.profiler.start()
+    self.assertRaises(ImportError, __import__, 'profiled_does_not_exist')
+    self.profiler.stop()
+    self.assertEqual({}, self.get_modules())
+
+  def test_max_modules(self):
+    self.write_module('profiled_inner', '')
+    self.write_module('profiled_outer', 'import profiled_inner\n')
+    self.profiler.start()
+    __import__('profiled_outer')
+    self.profiler.stop()
+    self.assertEqual(1, len(self.profiler.get_profile_json(1)['modules']))
+    self.assertRaises(TypeError, self.profiler.get_profile_json, None)
+
+
+class GetMemoryKbTest(unittest.TestCase):
+  """Tests for the _get_memory_kb function."""
+
+  def setUp(self):
+    self.orig_resource = import_profiler.resource
+    self.orig_unit_bytes = import_profiler._MAXRSS_UNIT_BYTES
+
+    class MockUsage(object):
+      ru_maxrss = 2048
+
+    class MockResource(object):
+      RUSAGE_SELF = 0
+
+      @staticmethod
+      def getrusage(who):
+        return MockUsage()
+
+    import_profiler.resource = MockResource
+
+  def tearDown(self):
+    import_profiler.resource = self.orig_resource
+    import_profiler._MAXRSS_UNIT_BYTES = self.orig_unit_bytes
+
+  def test_kilobytes(self):
+    import_profiler._MAXRSS_UNIT_BYTES = 1024
+    self.assertEqual(2048, import_profiler._get_memory_kb())
+
+  def test_bytes(self):
+    import_profiler._MAXRSS_UNIT_BYTES = 1
+    self.assertEqual(2, import_profiler._get_memory_kb())
+
+  def test_not_available(self):
+    import_profiler.resource = None
+    self.assertEqual(None, import_profiler._get_memory_kb())
+
+
+class MergeProfilesTest(unittest.TestCase):
+  """Tests for the merge_profiles function."""
+
+  def make_profile(self, total_secs, costs):
+    return {'total_secs': total_secs,
+            'modules': [{'module': name, 'inclusive_secs': secs,
+                         'exclusive_secs': secs, 'inclusive_kb': kb,
+                         'exclusive_kb': kb} for (name, secs, kb) in costs]}
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, import_profiler.merge_profiles, None)
+    self.assertRaises(TypeError, import_profiler.merge_profiles, [], None)
+
+  def test_empty(self):
+    self.assertEqual({'total_secs': 0.0, 'modules': []},
+                     import_profiler.merge_profiles([]))
+
+  def test_merge(self):
+    merged = import_profiler.merge_profiles([
+        self.make_profile(3.0, [('a', 1.0, None), ('b', 2.0, 10)]),
+        self.make_profile(2.0, [('a', 2.0, None), ('c', 0.5, None)])])
+    self.assertEqual(5.0, merged['total_secs'])
+    self.assertEqual(['a', 'b', 'c'],
+                     [module['module'] for module in merged['modules']])
+    self.assertEqual(3.0, merged['modules'][0]['exclusive_secs'])
+    self.assertEqual(None, merged['modules'][0]['exclusive_kb'])
+    self.assertEqual(10, merged['modules'][1]['exclusive_kb'])
+
+  def test_max_modules(self):
+    merged = import_profiler.merge_profiles(
+        [self.make_profile(3.0, [('a', 1.0, None), ('b', 2.0, None)])], 1)
+    self.assertEqual(['b'], [module['module'] for module in merged['modules']])
@@ -28,7 +28,9 @@ __author__ = 'schuppe@google.com (Robert Schuppenies)'
 import copy
 import inspect
 import os
+import shutil
 import sys
+import tempfile
 import types
 import unittest
 
@@ -250,16 +252,19 @@ class LoadModuleFromModuleNameTest(unittest.TestCase, utils.TestDataMixin):
     self.assertFalse(hasattr(result_module, class_name))
 
 
-class GetModuleNamesInPackageTest(unittest.TestCase, utils.TestDataMixin):
+class GetModuleNamesInPackageTest(unittest.TestCase, utils.TestDataMixin,
+                                  utils.MockAttributeMixin):
   """Tests for the get_module_names_in_package function."""
 
   # pylint: disable-msg=C0103
   def setUp(self):
     self.setup_test_data()
+    logic._MODULE_NAMES_CACHE.clear()
 
   # pylint: disable-msg=C0103
   def tearDown(self):
     self.tear_down_test_data()
+    self.tear_down_attributes()
 
   def test_invalid_input(self):
     self.assertRaises(TypeError, logic.get_module_names_in_package, None, [])
@@ -308,6 +313,34 @@ class GetModuleNamesInPackageTest(unittest.TestCase, utils.TestDataMixin):
         break
     self.assertTrue(found_mod_from_subpackage)
 
+  def test_index_reused(self):
+    modules = logic.get_module_names_in_package(self.test_package_name,
+                                                TEST_MODULE_PATTERN)
+
+    @self.mock(os)
+    def walk(*args):
+      self.fail('The package should not be traversed again.')
+
+    self.assertEqual(modules, logic.get_module_names_in_package(
+        self.test_package_name, TEST_MODULE_PATTERN))
+
+  def test_index_invalidated(self):
+    modules = logic.get_module_names_in_package(self.test_package_name,
+                                                TEST_MODULE_PATTERN)
+    orig_find = logic._find_module_names_in_path
+    walked = []
+
+    @self.mock(logic)
+    def _find_module_names_in_path(packagename, path, pattern, depth):
+      walked.append(path)
+      return orig_find(packagename, path, pattern, depth)
+
+    # Pretend that all directories have been modified.
+    self.mock(logic, '_get_mtime')(lambda path: -1)
+    self.assertEqual(modules, logic.get_module_names_in_package(
+        self.test_package_name, TEST_MODULE_PATTERN))
+    self.assertEqual(1, len(walked))
+
 
 class IsPrefixTest(unittest.TestCase):
   """Tests for the _is_prefix function."""
@@ -337,16 +370,85 @@ class IsInTestPackageTest(unittest.TestCase):
     self.assertFalse(logic._is_in_test_package('', conf))
 
 
-class GetRequestedObjectTest(unittest.TestCase, utils.TestDataMixin):
+class NameIndexTest(unittest.TestCase):
+  """Tests for the _NameIndex class."""
+
+  def setUp(self):
+    self.index = logic._NameIndex()
+
+  def test_get(self):
+    entry = logic._IndexEntry('class', 'package.module', 'Class')
+    self.index.add('package.module.Class', entry)
+    self.assertTrue(entry is self.index.get('package.module.Class'))
+    self.assertEqual(None, self.index.get('package.module'))
+    self.assertEqual(None, self.index.get('package.module.Class.method'))
+    self.assertEqual(None, self.index.get('package.other'))
+
+  def test_remove_prefix(self):
+    self.index.add('package', logic._IndexEntry('package'))
+    self.index.add('package.module', logic._IndexEntry('module'))
+    self.index.add('package.module.Class', logic._IndexEntry('class'))
+    self.index.add('package.other', logic._IndexEntry('module'))
+    self.index.remove_prefix('package.module')
+    self.assertEqual(None, self.index.get('package.module'))
+    self.assertEqual(None, self.index.get('package.module.Class'))
+    self.assertEqual('package', self.index.get('package').kind)
+    self.assertEqual('module', self.index.get('package.other').kind)
+    self.index.remove_prefix('does.not.exist')
+
+  def test_missing(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      mtime = os.stat(temp_dir).st_mtime
+      self.index.add_missing('package.module', {temp_dir: mtime})
+      self.index.add_missing('package.other', {temp_dir: mtime})
+      self.assertTrue(self.index.is_missing('package.module'))
+      self.assertFalse(self.index.is_missing('package'))
+      self.assertEqual(None, self.index.get('package.module'))
+      os.utime(temp_dir, (mtime + 10, mtime + 10))
+      self.assertFalse(self.index.is_missing('package.module'))
+      self.assertFalse(self.index.is_missing('package.other'))
+    finally:
+      shutil.rmtree(temp_dir)
+
+  def test_missing_replaced(self):
+    self.index.add_missing('package.module', {})
+    self.index.add('package.module', logic._IndexEntry('module'))
+    self.assertFalse(self.index.is_missing('package.module'))
+    self.index.add_missing('package.other', {})
+    self.index.clear_missing()
+    self.assertFalse(self.index.is_missing('package.other'))
+
+
+class GetRequestedObjectTest(unittest.TestCase, utils.TestDataMixin,
+                             utils.MockAttributeMixin):
   """Tests for the get_requested_object function."""
 
   def setUp(self):
     self.setup_test_data()
     self.config = copy.copy(config.get_config())
     self.config.test_package_names = [self.test_package_name]
+    logic._clear_name_indexes()
 
   def tearDown(self):
     self.tear_down_test_data()
+    self.tear_down_attributes()
+
+  def count_module_loads(self):
+    """Counts calls to load_module_from_module_name.
+
+    Returns:
+      A list to which the name of each loaded module is appended.
+    """
+    loaded = []
+    orig_load_module = logic.load_module_from_module_name
+
+    @self.mock(logic)
+    def load_module_from_module_name(fullname, *args, **kwargs):
+      loaded.append(fullname)
+      return orig_load_module(fullname, *args, **kwargs)
+
+    return loaded
 
   def test_invalid_input(self):
     self.assertRaises(TypeError, logic.get_requested_object, None, self.config)
@@ -410,6 +512,191 @@ class GetRequestedObjectTest(unittest.TestCase, utils.TestDataMixin):
     self.assertTrue(isinstance(result, logic.BadTest))
     self.assertEqual(1, len(result.load_errors))
 
+  def test_indexed(self):
+    self.test_package()
+    self.test_module()
+    self.test_class()
+    self.test_method()
+    loaded = self.count_module_loads()
+    self.test_package()
+    self.test_module()
+    self.test_class()
+    self.test_method()
+    # Only the module containing each object is loaded.
+    module_name = self.test_package_name + '.test_goodmodule'
+    self.assertEqual([module_name] * 3, loaded)
+
+  def test_indexed_by_discovery(self):
+    module_name = self.test_package_name + '.test_one_testcase'
+    (logic.get_requested_object(module_name, self.config)
+     .get_methods(self.config))
+    loaded = self.count_module_loads()
+    fullname = module_name + '.SimpleTestCase.test_pass'
+    result = logic.get_requested_object(fullname, self.config)
+    self.assertTrue(isinstance(result, logic.Method))
+    self.assertEqual(fullname, result.fullname)
+    self.assertEqual([module_name], loaded)
+
+  def test_missing_cached(self):
+    self.test_invalid_name()
+    loaded = self.count_module_loads()
+    self.test_invalid_name()
+    self.assertEqual([], loaded)
+
+  def test_broken_module_not_cached(self):
+    self.test_broken_module()
+    loaded = self.count_module_loads()
+    self.test_broken_module()
+    self.assertNotEqual([], loaded)
+
+  def test_stale_entry(self):
+    fullname = self.test_package_name + '.test_goodmodule.Foo'
+    index = logic._get_name_index(self.config)
+    index.add(fullname, logic._IndexEntry(
+        'class', self.test_package_name + '.test_goodmodule', 'Missing'))
+    self.test_class()
+
+
+class ReloadChangedTestModulesTest(unittest.TestCase):
+  """Tests for the reload_changed_test_modules function."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    sys.path.insert(0, self.temp_dir)
+    self.package_name = 'reload_package'
+    os.mkdir(os.path.join(self.temp_dir, self.package_name))
+    self.write_module('__init__', '')
+    self.write_module('helper', 'VALUE = 1\n')
+    self.write_module('test_a', self.get_test_source('ATest', ['test_one']))
+    self.write_module('test_b',
+                      'import unittest\n'
+                      'from reload_package.helper import VALUE\n'
+                      'class BTest(unittest.TestCase):\n'
+                      '  def test_value(self):\n'
+                      '    self.assertEqual(1, VALUE)\n')
+    self.config = copy.copy(config.get_config())
+    self.config.test_package_names = [self.package_name]
+    self.config.reload_changed_modules = True
+    logic._clear_name_indexes()
+    for name in ['test_a', 'test_b']:
+      logic.get_requested_object('%s.%s' % (self.package_name, name),
+                                 self.config)
+
+  def tearDown(self):
+    sys.path.remove(self.temp_dir)
+    shutil.rmtree(self.temp_dir)
+    for name in sys.modules.keys():
+      if logic._is_prefix(self.package_name, name):
+        del sys.modules[name]
+        logic._MODULE_SOURCES.pop(name, None)
+    logic._clear_name_indexes()
+
+  def get_test_source(self, class_name, method_names):
+    lines = ['import unittest', 'class %s(unittest.TestCase):' % class_name]
+    for method_name in method_names:
+      lines.append('  def %s(self):\n    pass' % method_name)
+    return '\n'.join(lines) + '\n'
+
+  def write_module(self, name, source, mtime=None):
+    path = os.path.join(self.temp_dir, self.package_name, name + '.py')
+    f = open(path, 'w')
+    f.write(source)
+    f.close()
+    # Make sure the change is visible even if the file system's mtime
+    # resolution is coarse.
+    if mtime is None:
+      mtime = os.stat(path).st_mtime
+    os.utime(path, (mtime + 10, mtime + 10))
+    pyc_path = path + 'c'
+    if os.path.exists(pyc_path):
+      os.remove(pyc_path)
+    return path
+
+  def get_method_names(self, fullname):
+    obj = logic.get_requested_object(fullname, self.config)
+    return [method.fullname for method in obj.get_methods(self.config)]
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, logic.reload_changed_test_modules, None)
+
+  def test_unchanged(self):
+    self.assertEqual([], logic.reload_changed_test_modules(self.config))
+
+  def test_touched(self):
+    self.write_module('test_a', self.get_test_source('ATest', ['test_one']))
+    self.assertEqual([], logic.reload_changed_test_modules(self.config))
+
+  def test_changed(self):
+    module_name = self.package_name + '.test_a'
+    module = sys.modules[module_name]
+    self.write_module('test_a',
+                      self.get_test_source('ATest', ['test_two', 'test_three']))
+    self.assertEqual([module_name],
+                     logic.reload_changed_test_modules(self.config))
+    self.assertTrue(module is sys.modules[module_name])
+    self.assertEqual([module_name + '.ATest.test_three',
+                      module_name + '.ATest.test_two'],
+                     self.get_method_names(module_name))
+
+  def test_changed_by_get_requested_object(self):
+    module_name = self.package_name + '.test_a'
+    self.write_module('test_a', self.get_test_source('ATest', ['test_two']))
+    self.assertEqual([module_name + '.ATest.test_two'],
+                     self.get_method_names(module_name + '.ATest'))
+
+  def test_not_enabled(self):
+    self.config.reload_changed_modules = False
+    module_name = self.package_name + '.test_a'
+    self.write_module('test_a', self.get_test_source('ATest', ['test_two']))
+    self.assertEqual([module_name + '.ATest.test_one'],
+                     self.get_method_names(module_name))
+
+  def test_dependents(self):
+    self.write_module('helper', 'VALUE = 2\n')
+    self.assertEqual([self.package_name + '.helper',
+                      self.package_name + '.test_b'],
+                     logic.reload_changed_test_modules(self.config))
+    self.assertEqual(2, sys.modules[self.package_name + '.test_b'].VALUE)
+
+  def test_added_after_lookup(self):
+    fullname = self.package_name + '.test_a.NewTest'
+    obj = logic.get_requested_object(fullname, self.config)
+    self.assertTrue(isinstance(obj, logic.BadTest))
+    self.assertFalse(obj.exists)
+    self.write_module('test_a', self.get_test_source('ATest', ['test_one']) +
+                      self.get_test_source('NewTest', ['test_new']))
+    logic.reload_changed_test_modules(self.config)
+    self.assertEqual([fullname + '.test_new'],
+                     self.get_method_names(fullname))
+
+  def test_new_module_after_lookup(self):
+    fullname = self.package_name + '.test_c'
+    obj = logic.get_requested_object(fullname, self.config)
+    self.assertTrue(isinstance(obj, logic.BadTest))
+    self.write_module('test_c', self.get_test_source('CTest', ['test_one']))
+    self.assertEqual([fullname + '.CTest.test_one'],
+                     self.get_method_names(fullname))
+
+  def test_removed(self):
+    module_name = self.package_name + '.test_a'
+    os.remove(os.path.join(self.temp_dir, self.package_name, 'test_a.py'))
+    self.assertEqual([module_name],
+                     logic.reload_changed_test_modules(self.config))
+    self.assertFalse(module_name in sys.modules)
+    obj = logic.get_requested_object(module_name, self.config)
+    self.assertTrue(isinstance(obj, logic.BadTest))
+    self.assertFalse(obj.exists)
+
+  def test_broken(self):
+    module_name = self.package_name + '.test_a'
+    self.write_module('test_a', 'raise ValueError\n')
+    self.assertEqual([module_name],
+                     logic.reload_changed_test_modules(self.config))
+    self.assertFalse(module_name in sys.modules)
+    obj = logic.get_requested_object(module_name, self.config)
+    self.assertTrue(isinstance(obj, logic.BadTest))
+    self.assertTrue(obj.exists)
+
 
 class GetUnitsTest(unittest.TestCase, utils.TestDataMixin):
   """Tests for TestObject.get_units."""
@@ -676,3 +963,383 @@ class GetTestSuiteTest(unittest.TestCase, utils.TestDataMixin):
                           '.ClassWithDifferentName2.test_method',
                           '.ClassWithDifferentMethodNames.test_method1',
                           '.ClassWithDifferentMethodNames.test_method2'])
+
+
+class GetUnitMethodsTest(unittest.TestCase, utils.TestDataMixin,
+                         utils.MockAttributeMixin):
+  """Tests for TestObject.get_unit_methods and the memoized children."""
+
+  def setUp(self):
+    self.setup_test_data()
+    self.config = copy.copy(config.get_config())
+    self.config.test_package_names = [self.test_package_name]
+    self.config.test_module_pattern = '^test_[\w]+$'
+
+  def tearDown(self):
+    self.tear_down_test_data()
+    self.tear_down_attributes()
+
+  def check(self, fullname):
+    """Checks that get_unit_methods agrees with get_units and get_methods."""
+    errors_out = []
+    test = logic.get_requested_object(fullname, self.config)
+    unit_methods = test.get_unit_methods(self.config, errors_out)
+    exp_errors = []
+    units = (logic.get_requested_object(fullname, self.config)
+             .get_units(self.config, exp_errors))
+    self.assertEqual([u.fullname for u in units],
+                     [u.fullname for (u, _) in unit_methods])
+    for unit, (_, methods) in zip(units, unit_methods):
+      self.assertEqual([m.fullname for m in unit.get_methods(self.config)],
+                       [m.fullname for m in methods])
+    self.assertEqual([err[0] for err in exp_errors],
+                     [err[0] for err in errors_out])
+
+  def test_package(self):
+    self.check(self.test_package_name)
+
+  def test_parallel(self):
+    self.config.parallelize_modules = True
+    self.config.parallelize_classes = True
+    self.config.parallelize_methods = True
+    self.check(self.test_package_name)
+
+  def test_invalid_object(self):
+    self.check('bad')
+
+  def test_children_loaded_once(self):
+    self.config.parallelize_modules = True
+    loaded = []
+    orig_load_module = logic.load_module_from_module_name
+
+    @self.mock(logic)
+    def load_module_from_module_name(fullname, *args, **kwargs):
+      loaded.append(fullname)
+      return orig_load_module(fullname, *args, **kwargs)
+
+    test = logic.get_requested_object(self.test_package_name, self.config)
+    first_errors = []
+    test.get_units(self.config, first_errors)
+    num_loaded = len(loaded)
+    self.assertTrue(num_loaded > 0)
+    second_errors = []
+    test.get_units(self.config, second_errors)
+    test.get_methods(self.config)
+    self.assertEqual(num_loaded, len(loaded))
+    # Errors from the first load are reported again.
+    self.assertEqual(first_errors, second_errors)
+
+  def test_children_per_config(self):
+    test = logic.get_requested_object(self.test_package_name, self.config)
+    all_modules = [m.fullname for m in test.get_children(self.config, None)]
+    other_config = copy.copy(self.config)
+    other_config.test_module_pattern = '^test_one_testcase$'
+    self.assertEqual([self.test_package_name + '.test_one_testcase'],
+                     [m.fullname for m in
+                      test.get_children(other_config, None)])
+    self.assertEqual(all_modules,
+                     [m.fullname for m in test.get_children(self.config,
+                                                            None)])
+
+
+class GetShardTest(unittest.TestCase):
+  """Tests for the get_shard function."""
+
+  def setUp(self):
+    self.unit_methods = []
+    for i in range(20):
+      unit = logic.Method('tests.module%s.Case.test' % i, unittest.TestCase,
+                          'test')
+      self.unit_methods.append((unit, [unit]))
+
+  def get_shards(self, shard_count, durations=None):
+    return [[unit.fullname for (unit, _) in
+             logic.get_shard(self.unit_methods, i, shard_count, durations)]
+            for i in range(shard_count)]
+
+  def check_disjoint(self, shards):
+    names = sum(shards, [])
+    self.assertEqual(sorted(unit.fullname for (unit, _) in self.unit_methods),
+                     sorted(names))
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, logic.get_shard, None, 0, 1)
+    self.assertRaises(TypeError, logic.get_shard, [], None, 1)
+    self.assertRaises(TypeError, logic.get_shard, [], 0, None)
+    self.assertRaises(TypeError, logic.get_shard, [], 0, 1, [])
+    self.assertRaises(ValueError, logic.get_shard, [], 1, 1)
+    self.assertRaises(ValueError, logic.get_shard, [], -1, 2)
+
+  def test_one_shard(self):
+    self.assertEqual(self.unit_methods,
+                     logic.get_shard(self.unit_methods, 0, 1))
+
+  def test_by_hash(self):
+    shards = self.get_shards(3)
+    self.check_disjoint(shards)
+    for shard in shards:
+      self.assertTrue(shard)
+    # Shards do not depend on the other units or their order.
+    self.unit_methods.reverse()
+    del self.unit_methods[5:]
+    for (exp_shard, shard) in zip(shards, self.get_shards(3)):
+      self.assertEqual(sorted(set(shard) & set(exp_shard)), sorted(shard))
+
+  def test_keeps_order(self):
+    shard = logic.get_shard(self.unit_methods, 0, 2)
+    self.assertEqual([u for u in self.unit_methods if u in shard], shard)
+
+  def test_by_duration(self):
+    durations = {'tests.module0.Case.test': 10.0}
+    shards = self.get_shards(2, durations)
+    self.check_disjoint(shards)
+    # 10 + 5 short units (15s) on one shard, 14 short units (14s) on the
+    # other.
+    long_shard = [shard for shard in shards
+                  if 'tests.module0.Case.test' in shard][0]
+    self.assertEqual(6, len(long_shard))
+    self.assertEqual(shards, self.get_shards(2, dict(durations)))
+
+
+class GetAffectedUnitMethodsTest(unittest.TestCase):
+  """Tests for the get_affected_unit_methods function."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    sys.path.insert(0, self.temp_dir)
+    self.package_name = 'impact_package'
+    os.mkdir(os.path.join(self.temp_dir, self.package_name))
+    test_source = ('import unittest\n'
+                   'class Test(unittest.TestCase):\n'
+                   '  def test(self):\n'
+                   '    pass\n')
+    self.write_module('__init__', '')
+    self.write_module('models', 'VALUE = 1\n')
+    self.write_module('util', 'from impact_package import models\n')
+    self.write_module('other', '')
+    self.write_module('test_plain', test_source)
+    self.write_module('test_util', 'from . import util\n' + test_source)
+    self.write_module('test_dynamic',
+                      '__import__("impact_package." + "other")\n' +
+                      test_source)
+    self.config = copy.copy(config.get_config())
+    self.config.test_package_names = [self.package_name]
+    self.config.test_module_pattern = '^test_[\w]+$'
+    self.config.parallelize_modules = True
+    logic._clear_name_indexes()
+    test = logic.get_requested_object(self.package_name, self.config)
+    self.unit_methods = test.get_unit_methods(self.config)
+
+  def tearDown(self):
+    sys.path.remove(self.temp_dir)
+    shutil.rmtree(self.temp_dir)
+    for name in sys.modules.keys():
+      if logic._is_prefix(self.package_name, name):
+        del sys.modules[name]
+        logic._IMPORTED_MODULE_NAMES.pop(name, None)
+    logic._clear_name_indexes()
+
+  def write_module(self, name, source):
+    f = open(os.path.join(self.temp_dir, self.package_name, name + '.py'), 'w')
+    f.write(source)
+    f.close()
+
+  def get_affected(self, changed_paths):
+    unit_methods = logic.get_affected_unit_methods(self.unit_methods,
+                                                   changed_paths, self.config)
+    return [unit.fullname[len(self.package_name) + 1:]
+            for (unit, _) in unit_methods]
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, logic.get_affected_unit_methods, None, [],
+                      self.config)
+    self.assertRaises(TypeError, logic.get_affected_unit_methods, [], None,
+                      self.config)
+    self.assertRaises(TypeError, logic.get_affected_unit_methods, [], [], None)
+
+  def test_nothing_changed(self):
+    self.assertEqual([], self.get_affected([]))
+
+  def test_not_python(self):
+    self.assertEqual([], self.get_affected(['README', 'impact_package/a.html']))
+
+  def test_test_module(self):
+    self.assertEqual(['test_plain'],
+                     self.get_affected(['impact_package/test_plain.py']))
+
+  def test_compiled(self):
+    self.assertEqual(['test_plain'],
+                     self.get_affected(['impact_package/test_plain.pyc']))
+
+  def test_absolute_path(self):
+    path = os.path.join(self.temp_dir, self.package_name, 'test_plain.py')
+    self.assertEqual(['test_plain'], self.get_affected([path]))
+
+  def test_transitive(self):
+    self.assertEqual(['test_util'],
+                     self.get_affected(['impact_package/models.py']))
+
+  def test_package(self):
+    self.assertEqual(['test_dynamic', 'test_plain', 'test_util'],
+                     self.get_affected(['impact_package/__init__.py']))
+
+  def test_recorded_import(self):
+    self.assertEqual(['test_dynamic'],
+                     self.get_affected(['impact_package/other.py']))
+
+  def test_not_in_app(self):
+    self.assertEqual([], self.get_affected([unittest.__file__]))
+
+
+class PartitionUnitsTest(unittest.TestCase, utils.TestDataMixin):
+  """Tests for the partition_units function."""
+
+  def setUp(self):
+    self.setup_test_data()
+    self.config = copy.copy(config.get_config())
+    self.config.test_package_names = [self.test_package_name]
+    self.config.test_module_pattern = '^test_[\w]+$'
+    self.class_fixture = self.test_package_name + '.test_class_fixture'
+
+  def tearDown(self):
+    self.tear_down_test_data()
+
+  def partition(self, fullname, durations, target_secs):
+    test = logic.get_requested_object(fullname, self.config)
+    errors_out = []
+    unit_methods = logic.partition_units(test, self.config, durations,
+                                         target_secs, errors_out)
+    for unit, methods in unit_methods:
+      self.assertEqual([m.fullname for m in unit.get_methods(self.config)],
+                       [m.fullname for m in methods])
+    return sorted(unit.fullname for (unit, _) in unit_methods)
+
+  def test_invalid_input(self):
+    test = logic.get_requested_object(self.class_fixture, self.config)
+    self.assertRaises(TypeError, logic.partition_units, None, self.config,
+                      {}, 1)
+    self.assertRaises(TypeError, logic.partition_units, test, self.config,
+                      None, 1)
+    self.assertRaises(TypeError, logic.partition_units, test, self.config,
+                      {}, None)
+
+  def test_fits_target(self):
+    self.assertEqual([self.class_fixture],
+                     self.partition(self.class_fixture, {}, 100))
+
+  def test_split_completely(self):
+    self.assertEqual(
+        [self.class_fixture + '.HasClassFixture',
+         self.class_fixture + '.HasNoClassFixture.test_fail',
+         self.class_fixture + '.HasNoClassFixture.test_pass'],
+        self.partition(self.class_fixture, {}, 0))
+
+  def test_same_as_parallel_units(self):
+    self.config.parallelize_modules = True
+    self.config.parallelize_classes = True
+    self.config.parallelize_methods = True
+    units = (logic.get_requested_object(self.test_package_name, self.config)
+             .get_units(self.config))
+    self.assertEqual(sorted(u.fullname for u in units),
+                     self.partition(self.test_package_name, {}, 0))
+
+  def test_durations(self):
+    no_fixture = self.class_fixture + '.HasNoClassFixture'
+    durations = {no_fixture + '.test_pass': 10}
+    self.assertEqual([self.class_fixture + '.HasClassFixture',
+                      no_fixture + '.test_fail',
+                      no_fixture + '.test_pass'],
+                     self.partition(self.class_fixture, durations, 5))
+    self.assertEqual([self.class_fixture + '.HasClassFixture',
+                      no_fixture],
+                     self.partition(self.class_fixture, durations, 12))
+
+  def test_fixture_durations(self):
+    fixture = self.class_fixture + '.HasClassFixture'
+    durations = {fixture: 10}
+    self.assertEqual([self.class_fixture],
+                     self.partition(self.class_fixture, durations, 15))
+    self.assertEqual([fixture, self.class_fixture + '.HasNoClassFixture'],
+                     self.partition(self.class_fixture, durations, 13))
+
+  def test_get_estimated_secs(self):
+    test = logic.get_requested_object(self.class_fixture, self.config)
+    methods = test.get_methods(self.config)
+    fixture = self.class_fixture + '.HasClassFixture'
+    durations = {fixture: 3, fixture + '.test_has_class_value': 0.5}
+    self.assertEqual(3 + 0.5 + 3 * logic._DEFAULT_METHOD_SECS,
+                     logic.get_estimated_secs(methods, durations))
+    self.assertEqual(0, logic.get_estimated_secs([], durations))
+
+
+class StaticDiscoveryTest(unittest.TestCase, utils.TestDataMixin):
+  """Tests for finding tests with conf.static_discovery."""
+
+  def setUp(self):
+    self.setup_test_data()
+    self.config = copy.copy(config.get_config())
+    self.config.test_package_names = [self.test_package_name]
+    self.config.test_module_pattern = '^test_[\w]+$'
+    self.config.parallelize_modules = True
+    self.config.parallelize_classes = True
+    self.config.parallelize_methods = True
+    self.static_config = copy.copy(self.config)
+    self.static_config.static_discovery = True
+
+  def tearDown(self):
+    self.tear_down_test_data()
+
+  def check_same_as_import(self, fullname):
+    """Checks that static discovery finds the same tests as importing."""
+    errors_out = []
+    obj = logic.get_requested_object(fullname, self.config)
+    exp_units = [u.fullname for u in obj.get_units(self.config, errors_out)]
+    exp_methods = [m.fullname for m in obj.get_methods(self.config)]
+    static_obj = logic.get_requested_object(fullname, self.static_config)
+    units = [u.fullname for u in static_obj.get_units(self.static_config)]
+    methods = [m.fullname for m in static_obj.get_methods(self.static_config)]
+    self.assertEqual(sorted(exp_units), sorted(units))
+    self.assertEqual(sorted(exp_methods), sorted(methods))
+    suite = static_obj.get_suite(self.static_config)
+    self.assertEqual(sorted(exp_methods), sorted(t.fullname for t in suite))
+
+  def test_root(self):
+    self.check_same_as_import('')
+
+  def test_package(self):
+    self.check_same_as_import(self.test_package_name + '.subpackage')
+
+  def test_discovery_threads(self):
+    self.static_config.discovery_threads = 4
+    self.check_same_as_import('')
+
+  def test_module(self):
+    self.check_same_as_import(self.test_package_name + '.test_class_fixture')
+
+  def test_module_fixture(self):
+    self.check_same_as_import(self.test_package_name + '.test_module_fixture')
+
+  def test_class(self):
+    self.check_same_as_import(
+        self.test_package_name + '.test_class_fixture.HasNoClassFixture')
+
+  def test_method(self):
+    self.check_same_as_import(
+        self.test_package_name + '.test_one_testcase.SimpleTestCase.test_pass')
+
+  def test_not_imported(self):
+    module_name = self.test_package_name + '.subpackage.test_ham'
+    sys.modules.pop(module_name, None)
+    obj = logic.get_requested_object(module_name, self.static_config)
+    self.assertTrue(isinstance(obj, logic.StaticModule))
+    self.assertEqual([module_name + '.FooTest.test_fail',
+                      module_name + '.FooTest.test_pass'],
+                     [m.fullname for m in obj.get_methods(self.static_config)])
+    self.assertFalse(module_name in sys.modules)
+
+  def test_broken_module(self):
+    fullname = self.test_package_name + '.test_brokenmodule'
+    obj = logic.get_requested_object(fullname, self.static_config)
+    errors_out = []
+    obj.get_suite(self.static_config, errors_out)
+    self.assertEqual([fullname], [err[0] for err in errors_out])
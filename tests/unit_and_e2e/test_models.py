@@ -32,7 +32,6 @@ from google.appengine.ext import testbed
 
 from aeta import config
 from aeta import models
-from aeta import task_deferred as deferred
 from tests import utils
 
 
@@ -45,19 +44,6 @@ class JsonHolderTest(unittest.TestCase, utils.MockAttributeMixin):
     self.testbed.init_all_stubs()
     self.holder = models.JsonHolder()
     self.config = copy.copy(config.get_config())
-    self.cleaned_up = False
-
-    @self.mock(deferred)
-    def defer(func, *args, **kwargs):
-      self.assertEqual(self.config.test_queue, kwargs.pop('_queue'))
-      self.assertTrue(kwargs.pop('_countdown') > 10)
-      self.assertEqual({}, kwargs)
-      self.assertEqual(models._delete_blob_if_done, func)
-      self.assertEqual(3, len(args))
-      self.assertEqual(self.holder.key, args[0])
-      self.assertTrue(isinstance(args[1], blobstore.BlobKey))
-      self.assertEqual(self.config, args[2])
-      self.cleaned_up = True
 
   def tearDown(self):
     self.testbed.deactivate()
@@ -73,7 +59,7 @@ class JsonHolderTest(unittest.TestCase, utils.MockAttributeMixin):
     self.holder.set_json(json, self.config)
     self.holder = self.holder.put().get()
     self.assertEqual(json, self.holder.get_json())
-    self.assertFalse(self.cleaned_up)
+    self.assertEqual([], models.StoredBlob.query().fetch())
 
   def test_set_large(self):
     json = 'a' * 2000000
@@ -82,11 +68,20 @@ class JsonHolderTest(unittest.TestCase, utils.MockAttributeMixin):
     self.holder = self.holder.put().get()
     self.assertEqual(json, self.holder.get_json())
     self.assertTrue(blobstore.BlobInfo.get(self.holder.blob_key))
-    self.assertTrue(self.cleaned_up)
+    # The blob is recorded so that it can be deleted with the holder.
+    stored_key = models.StoredBlob.get_key(self.holder.key,
+                                           self.holder.blob_key)
+    self.assertTrue(stored_key.get())
 
   def test_set_no_key(self):
     self.assertRaises(ValueError, self.holder.set_json, 'json', self.config)
 
+  def test_has_json(self):
+    self.holder.put()
+    self.assertFalse(self.holder.has_json())
+    self.holder.set_json(None, self.config)
+    self.assertTrue(self.holder.has_json())
+
 
 class TestBatchTest(unittest.TestCase, utils.MockAttributeMixin):
   """Tests for the TestBatch class."""
@@ -140,6 +135,77 @@ class TestBatchTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertTrue(self.did_set)
 
 
+class ProgressShardTest(unittest.TestCase):
+  """Tests for ProgressShard, record_unit_summary and get_batch_summary."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'datastore'
+    self.batch_key = ndb.Key(models.TestBatch, 'batchid')
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def summarize(self, index, passes, failures=0):
+    models.record_unit_summary(
+        models.RunTestUnitTask.get_key(self.batch_key, index),
+        {'passes': passes, 'failures': failures, 'errors': 0, 'skips': 1,
+         'load_errors': 0}, self.config)
+
+  def test_get_keys(self):
+    keys = models.ProgressShard.get_keys(self.batch_key)
+    self.assertTrue(len(keys) > 1)
+    self.assertEqual(len(keys), len(set(keys)))
+    for key in keys:
+      self.assertEqual(None, key.parent())
+    self.assertNotEqual(keys, models.ProgressShard.get_keys(
+        ndb.Key(models.TestBatch, 'otherid')))
+    self.assertRaises(TypeError, models.ProgressShard.get_keys, None)
+
+  def test_summary(self):
+    self.assertEqual({'num_done': 0, 'passes': 0, 'failures': 0, 'errors': 0,
+                      'skips': 0, 'load_errors': 0, 'last_progress': None},
+                     models.get_batch_summary(self.batch_key, self.config))
+    num_shards = len(models.ProgressShard.get_keys(self.batch_key))
+    self.summarize(0, 3)
+    self.summarize(1, 2, 1)
+    # This unit is in the same shard as the first one.
+    self.summarize(num_shards, 1)
+    models.BatchProgress(
+        key=models.BatchProgress.get_key(self.batch_key)).put()
+    summary = models.get_batch_summary(self.batch_key, self.config)
+    self.assertTrue(summary.pop('last_progress'))
+    self.assertEqual({'num_done': 3, 'passes': 6, 'failures': 1, 'errors': 0,
+                      'skips': 3, 'load_errors': 0}, summary)
+
+  def test_summarize_again(self):
+    self.summarize(0, 3, 1)
+    self.summarize(0, 4)
+    summary = models.get_batch_summary(self.batch_key, self.config)
+    self.assertEqual(1, summary['num_done'])
+    self.assertEqual(4, summary['passes'])
+    self.assertEqual(0, summary['failures'])
+
+  def test_get_finished_units(self):
+    self.assertEqual(set(), models.get_finished_units(self.batch_key,
+                                                      self.config))
+    num_shards = len(models.ProgressShard.get_keys(self.batch_key))
+    for index in [0, 2, num_shards]:
+      self.summarize(index, 1)
+    self.assertEqual(set([0, 2, num_shards]),
+                     models.get_finished_units(self.batch_key, self.config))
+
+  def test_memcache(self):
+    self.config.storage = 'memcache'
+    self.summarize(0, 3)
+    self.assertEqual(
+        1, models.get_batch_summary(self.batch_key, self.config)['num_done'])
+
+
 class RunTestUnitTaskTest(unittest.TestCase, utils.MockAttributeMixin):
   """Tests for the RunTestUnitTask class."""
 
@@ -170,6 +236,35 @@ class RunTestUnitTaskTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertEqual(k, k_same)
     k2 = models.RunTestUnitTask.get_key(batch.key, 2)
     self.assertNotEqual(k, k2)
+    # Units are not in the entity group of their batch.
+    self.assertEqual(None, k.parent())
+    self.assertNotEqual(k, models.RunTestUnitTask.get_key(
+        ndb.Key(models.TestBatch, 'otherid'), 1))
+
+  def test_get_batch_key_and_index(self):
+    for batch_key in [ndb.Key(models.TestBatch, 'a-b_c'),
+                      ndb.Key(models.TestBatch, 42)]:
+      key = models.RunTestUnitTask.get_key(batch_key, 12)
+      self.assertEqual(batch_key, models.RunTestUnitTask.get_batch_key(key))
+      self.assertEqual(12, models.RunTestUnitTask.get_index(key))
+    self.assertRaises(TypeError, models.RunTestUnitTask.get_batch_key, None)
+    self.assertRaises(TypeError, models.RunTestUnitTask.get_index, None)
+
+  def test_query_unit_keys(self):
+    batch_key = ndb.Key(models.TestBatch, 'batchid')
+    task_keys = [models.RunTestUnitTask.get_key(batch_key, i)
+                 for i in range(3)]
+    ndb.put_multi([models.RunTestUnitTask(key=key) for key in task_keys])
+    checkpoint_key = models.UnitCheckpoint.get_key(task_keys[1])
+    models.UnitCheckpoint(key=checkpoint_key).put()
+    other_keys = [
+        models.RunTestUnitTask.get_key(ndb.Key(models.TestBatch, 'batchi'), 0),
+        models.RunTestUnitTask.get_key(ndb.Key(models.TestBatch, 'batchidd'),
+                                       0)]
+    ndb.put_multi([models.RunTestUnitTask(key=key) for key in other_keys])
+    keys = models.RunTestUnitTask.query_unit_keys(batch_key).fetch(
+        keys_only=True)
+    self.assertEqual(set(task_keys + [checkpoint_key]), set(keys))
 
   def test_set_result(self):
     load_errors = [('tests.badmodule', 'ImportError')]
@@ -208,51 +303,155 @@ class RunTestUnitTaskTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertTrue(self.did_set)
 
 
-class DeleteBlobIfDoneTest(unittest.TestCase, utils.MockAttributeMixin):
-  """Tests for the _delete_blob_if_done function."""
+class BatchStatusTest(unittest.TestCase):
+  """Tests for the BatchStatus class."""
+
+  def test_get_key(self):
+    batch_key = ndb.Key(models.TestBatch, 'batchid')
+    key = models.BatchStatus.get_key(batch_key)
+    self.assertEqual(batch_key, key.parent())
+    self.assertEqual(key, models.BatchStatus.get_key(batch_key))
+    self.assertNotEqual(key, models.BatchStatus.get_key(
+        ndb.Key(models.TestBatch, 'otherid')))
+    self.assertRaises(TypeError, models.BatchStatus.get_key, None)
+
+
+class BatchProgressTest(unittest.TestCase):
+  """Tests for the BatchProgress class."""
+
+  def test_get_key(self):
+    batch_key = ndb.Key(models.TestBatch, 'batchid')
+    key = models.BatchProgress.get_key(batch_key)
+    self.assertEqual(None, key.parent())
+    self.assertNotEqual(key, models.BatchProgress.get_key(
+        ndb.Key(models.TestBatch, 'otherid')))
+    self.assertRaises(TypeError, models.BatchProgress.get_key, None)
+
+  def test_get_batch_key(self):
+    for batch_id in ['batchid', 'batch-id', 123]:
+      batch_key = ndb.Key(models.TestBatch, batch_id)
+      self.assertEqual(batch_key, models.BatchProgress.get_batch_key(
+          models.BatchProgress.get_key(batch_key)))
+    self.assertRaises(TypeError, models.BatchProgress.get_batch_key, None)
+
+
+class UnitCheckpointTest(unittest.TestCase):
+  """Tests for the UnitCheckpoint class."""
+
+  def test_get_key(self):
+    batch_key = ndb.Key(models.TestBatch, 'batchid')
+    task_key = models.RunTestUnitTask.get_key(batch_key, 0)
+    key = models.UnitCheckpoint.get_key(task_key)
+    self.assertEqual(task_key, key.parent())
+    self.assertEqual(key, models.UnitCheckpoint.get_key(task_key))
+    self.assertNotEqual(key, models.UnitCheckpoint.get_key(
+        models.RunTestUnitTask.get_key(batch_key, 1)))
+    self.assertRaises(TypeError, models.UnitCheckpoint.get_key, None)
+
+
+class MethodResultChunkTest(unittest.TestCase):
+  """Tests for the MethodResultChunk class and get_method_result_chunks."""
 
   def setUp(self):
     self.testbed = testbed.Testbed()
     self.testbed.activate()
-    self.testbed.init_all_stubs()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
     self.config = copy.copy(config.get_config())
-    self.did_defer = False
-    self.holder = models.JsonHolder()
-    self.holder.put()
-
-    # Ignore deferral caused by set_json.
-    @self.mock(deferred)
-    def defer(func, *args, **kwargs):
-      pass
-
-    self.holder.set_json('a' * 2000000, self.config)
-
-    @self.mock(deferred)
-    def defer(func, *args, **kwargs):
-      self.assertEqual(self.config.test_queue, kwargs.pop('_queue'))
-      self.assertTrue(kwargs.pop('_countdown') > 10)
-      self.assertEqual({}, kwargs)
-      self.assertEqual(models._delete_blob_if_done, func)
-      self.assertEqual(3, len(args))
-      self.assertEqual(self.holder.key, args[0])
-      self.assertTrue(isinstance(args[1], blobstore.BlobKey))
-      self.assertEqual(self.config, args[2])
-      self.did_defer = True
+    self.config.storage = 'datastore'
+    batch_key = ndb.Key(models.TestBatch, 'batchid')
+    self.task_keys = [models.RunTestUnitTask.get_key(batch_key, i)
+                      for i in range(3)]
 
   def tearDown(self):
     self.testbed.deactivate()
-    self.tear_down_attributes()
 
-  def test_delete(self):
-    self.holder.key.delete()
-    models._delete_blob_if_done(self.holder.key, self.holder.blob_key,
-                                self.config)
-    self.assertEqual(None, blobstore.BlobInfo.get(self.holder.blob_key))
-    self.assertFalse(self.did_defer)
+  def put_chunk(self, task_key, index):
+    chunk = models.MethodResultChunk(
+        key=models.MethodResultChunk.get_key(task_key, index))
+    chunk.set_json([['tests.Case.test%s' % index, 'pass', None]], self.config)
+    chunk.put()
+
+  def test_get_key(self):
+    key = models.MethodResultChunk.get_key(self.task_keys[0], 1)
+    self.assertEqual(self.task_keys[0], key.parent())
+    self.assertEqual(key, models.MethodResultChunk.get_key(self.task_keys[0],
+                                                           1))
+    self.assertNotEqual(key, models.MethodResultChunk.get_key(
+        self.task_keys[1], 1))
+    self.assertRaises(TypeError, models.MethodResultChunk.get_key, None, 1)
+    self.assertRaises(TypeError, models.MethodResultChunk.get_key,
+                      self.task_keys[0], None)
+
+  def test_get_chunks(self):
+    self.put_chunk(self.task_keys[0], 0)
+    self.put_chunk(self.task_keys[0], 1)
+    self.put_chunk(self.task_keys[2], 0)
+    # Chunks after a missing one are not read.
+    self.put_chunk(self.task_keys[1], 1)
+    chunks = models.get_method_result_chunks(self.task_keys, self.config)
+    self.assertEqual([[['tests.Case.test0', 'pass', None]],
+                      [['tests.Case.test1', 'pass', None]]],
+                     [chunk.get_json() for chunk in chunks[0]])
+    self.assertEqual([], chunks[1])
+    self.assertEqual(1, len(chunks[2]))
+
+  def test_no_tasks(self):
+    self.assertEqual([], models.get_method_result_chunks([], self.config))
+
+
+class StoredBlobTest(unittest.TestCase):
+  """Tests for the StoredBlob class."""
+
+  def test_get_key(self):
+    holder_key = ndb.Key(models.TestBatch, 'batchid')
+    key = models.StoredBlob.get_key(holder_key, blobstore.BlobKey('blob'))
+    self.assertEqual(holder_key, key.parent())
+    self.assertEqual('blob', key.id())
+    self.assertRaises(TypeError, models.StoredBlob.get_key, None, 'blob')
+
+
+class TestDurationTest(unittest.TestCase):
+  """Tests for the TestDuration class and the functions using it."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_all_stubs()
 
-  def test_defer(self):
-    models._delete_blob_if_done(self.holder.key, self.holder.blob_key,
-                                self.config)
-    self.assertNotEqual(None, blobstore.BlobInfo.get(self.holder.blob_key))
-    self.assertTrue(self.did_defer)
+  def tearDown(self):
+    self.testbed.deactivate()
 
+  def test_add_duration(self):
+    duration = models.TestDuration(key=models.TestDuration.get_key('t'))
+    for secs in range(1, 11):
+      duration.add_duration(secs)
+    self.assertEqual(10, duration.num_runs)
+    self.assertEqual(5.5, duration.mean_secs)
+    self.assertEqual(9, duration.p90_secs)
+
+  def test_recent_durations_bounded(self):
+    duration = models.TestDuration(key=models.TestDuration.get_key('t'))
+    for _ in range(models._NUM_RECENT_DURATIONS):
+      duration.add_duration(100)
+    for _ in range(models._NUM_RECENT_DURATIONS):
+      duration.add_duration(1)
+    self.assertEqual(2 * models._NUM_RECENT_DURATIONS, duration.num_runs)
+    self.assertEqual(models._NUM_RECENT_DURATIONS,
+                     len(duration.recent_secs))
+    self.assertEqual(1, duration.mean_secs)
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, models.record_test_durations, None)
+    self.assertRaises(TypeError, models.get_test_durations, None)
+
+  def test_record_and_get(self):
+    models.record_test_durations({'tests.module.Case.test_a': 2.0,
+                                  'tests.module.Case': 1.0})
+    models.record_test_durations({'tests.module.Case.test_a': 4.0})
+    self.assertEqual({'tests.module.Case.test_a': 3.0,
+                      'tests.module.Case': 1.0},
+                     models.get_test_durations(['tests.module.Case.test_a',
+                                                'tests.module.Case',
+                                                'tests.module']))
+    self.assertEqual({}, models.get_test_durations([]))
@@ -91,6 +91,62 @@ class GetBatchResultsTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertEqual([{'index': 3}, {'index': 4}], results)
 
 
+class GetPartialResultsTest(unittest.TestCase):
+  """Tests for get_partial_results."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'datastore'
+    self.batch = models.TestBatch(fullname='tests', num_units=4)
+    self.batch.put()
+    self.task_keys = []
+    for i in range(self.batch.num_units):
+      task = models.RunTestUnitTask(fullname='tests.unit%s' % i)
+      task.key = models.RunTestUnitTask.get_key(self.batch.key, i)
+      task.put()
+      self.task_keys.append(task.key)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def put_chunk(self, index, chunk_index, methods):
+    chunk = models.MethodResultChunk(key=models.MethodResultChunk.get_key(
+        self.task_keys[index], chunk_index))
+    chunk.set_json(methods, self.config)
+    chunk.put()
+
+  def test_partial_results(self):
+    self.put_chunk(1, 0, [['tests.unit1.Case.test_a', 'pass', None]])
+    self.put_chunk(1, 1, [['tests.unit1.Case.test_b', 'fail', 'Traceback']])
+    self.put_chunk(3, 0, [['tests.unit3.Case.test_a', 'skip', None]])
+    self.assertEqual(
+        [{'index': 1, 'fullname': 'tests.unit1',
+          'methods': [['tests.unit1.Case.test_a', 'pass', None],
+                      ['tests.unit1.Case.test_b', 'fail', 'Traceback']]},
+         {'index': 3, 'fullname': 'tests.unit3',
+          'methods': [['tests.unit3.Case.test_a', 'skip', None]]}],
+        rest.get_partial_results(self.batch, 0, self.config))
+    self.assertEqual([3], [partial['index'] for partial in
+                           rest.get_partial_results(self.batch, 2,
+                                                    self.config)])
+
+  def test_finished_unit(self):
+    self.put_chunk(0, 0, [['tests.unit0.Case.test_a', 'pass', None]])
+    task = self.task_keys[0].get()
+    task.set_json({'fullname': 'tests.unit0'}, self.config)
+    task.put()
+    self.assertEqual([], rest.get_partial_results(self.batch, 0, self.config))
+
+  def test_unknown_num_units(self):
+    batch = models.TestBatch(fullname='tests')
+    batch.put()
+    self.assertEqual([], rest.get_partial_results(batch, 0, self.config))
+
+
 # self.handler has to be initialized by child class -
 # pylint:disable-msg=E1101
 class HandlerTestBase(unittest.TestCase, utils.HandlerTestMixin,
@@ -137,6 +193,26 @@ class GetMethodsRequestHandlerTest(HandlerTestBase):
                 'load_errors': []}
     self.check_response(resp, exp_resp, is_json=True)
 
+  def test_shard(self):
+    self.config.test_module_pattern = '^test_[\w]+$'
+    self.config.parallelize_modules = True
+    self.config.record_durations = False
+    fullname = 'sample_package'
+    all_methods = json.loads(self.app.get(self.handler_path + fullname,
+                                          status=200).body)['method_names']
+    shard_methods = []
+    for i in range(3):
+      resp = self.app.get('%s%s?shard_index=%s&shard_count=3' %
+                          (self.handler_path, fullname, i), status=200)
+      shard_methods.extend(json.loads(resp.body)['method_names'])
+    self.assertEqual(sorted(all_methods), sorted(shard_methods))
+
+  def test_invalid_shard(self):
+    fullname = 'sample_package.test_one_testcase'
+    resp = self.app.get(self.handler_path + fullname + '?shard_count=x',
+                        status=400)
+    self.check_response_text_not_expected(resp, '')
+
   def test_invalid_name(self):
     fullname = 'does.not.exist'
     resp = self.app.get(self.handler_path + fullname, status=200)
@@ -167,10 +243,20 @@ class StartBatchRequestHandlerTest(HandlerTestBase):
     self.config.storage = 'datastore'
     self.mock(config, 'get_config')(lambda: self.config)
 
+    self.shard = (0, 1)
+    self.changed_paths = None
+    self.fail_fast = False
+    self.max_reruns = 0
+
     @self.mock(runner)
-    def start_batch(fullname, conf):
+    def start_batch(fullname, conf, shard_index=0, shard_count=1,
+                    changed_paths=None, fail_fast=False, max_reruns=0):
       self.assertEqual(self.fullname, fullname)
       self.assertEqual(self.config, conf)
+      self.assertEqual(self.shard, (shard_index, shard_count))
+      self.assertEqual(self.changed_paths, changed_paths)
+      self.assertEqual(self.fail_fast, fail_fast)
+      self.assertEqual(self.max_reruns, max_reruns)
       key = ndb.Key(models.TestBatch, self.batch_id)
       return models.TestBatch(fullname=fullname, key=key)
 
@@ -184,6 +270,62 @@ class StartBatchRequestHandlerTest(HandlerTestBase):
     resp = self.app.post(self.handler_path, status=200)
     self.check_response(resp, {'batch_id': str(self.batch_id)}, is_json=True)
 
+  def test_shard(self):
+    self.fullname = 'sample_package'
+    self.shard = (1, 3)
+    resp = self.app.post(self.handler_path + self.fullname +
+                         '?shard_index=1&shard_count=3', status=200)
+    self.check_response(resp, {'batch_id': str(self.batch_id)}, is_json=True)
+
+  def test_changed_paths(self):
+    self.fullname = 'sample_package'
+    self.changed_paths = ['models.py', 'lib/util.py']
+    resp = self.app.post(self.handler_path + self.fullname,
+                         'changed_path=models.py&changed_path=lib/util.py',
+                         status=200)
+    self.check_response(resp, {'batch_id': str(self.batch_id)}, is_json=True)
+
+  def test_fail_fast(self):
+    self.fullname = 'sample_package'
+    self.fail_fast = True
+    resp = self.app.post(self.handler_path + self.fullname, 'fail_fast=1',
+                         status=200)
+    self.check_response(resp, {'batch_id': str(self.batch_id)}, is_json=True)
+
+  def test_fail_fast_off(self):
+    self.fullname = 'sample_package'
+    for value in ['0', 'false', 'no', '']:
+      resp = self.app.post(self.handler_path + self.fullname,
+                           'fail_fast=' + value, status=200)
+      self.check_response(resp, {'batch_id': str(self.batch_id)},
+                          is_json=True)
+
+  def test_fail_fast_true(self):
+    self.fullname = 'sample_package'
+    self.fail_fast = True
+    resp = self.app.post(self.handler_path + self.fullname, 'fail_fast=True',
+                         status=200)
+    self.check_response(resp, {'batch_id': str(self.batch_id)}, is_json=True)
+
+  def test_max_reruns(self):
+    self.fullname = 'sample_package'
+    self.max_reruns = 2
+    resp = self.app.post(self.handler_path + self.fullname + '?max_reruns=2',
+                         status=200)
+    self.check_response(resp, {'batch_id': str(self.batch_id)}, is_json=True)
+    for query in ['max_reruns=x', 'max_reruns=-1']:
+      resp = self.app.post(self.handler_path + self.fullname + '?' + query,
+                           status=400)
+      self.check_response_text_not_expected(resp, '')
+
+  def test_invalid_shard(self):
+    self.fullname = 'sample_package'
+    for query in ['shard_index=x', 'shard_index=3&shard_count=3',
+                  'shard_index=-1&shard_count=2', 'shard_count=0']:
+      resp = self.app.post(self.handler_path + self.fullname + '?' + query,
+                           status=400)
+      self.check_response_text_not_expected(resp, '')
+
   def test_invalid_name(self):
     self.fullname = 'does.not.exist'
     resp = self.app.post(self.handler_path + self.fullname, status=404)
@@ -202,7 +344,8 @@ class StartBatchRequestHandlerTest(HandlerTestBase):
                          ['sample_package.goodmodule.Class.method']}
 
     @self.mock(runner)
-    def start_batch(fullname, conf):
+    def start_batch(fullname, conf, shard_index=0, shard_count=1,
+                    changed_paths=None, fail_fast=False, max_reruns=0):
       self.assertEqual(self.fullname, fullname)
       self.assertEqual(self.config, conf)
       key = ndb.Key(models.TestBatch, self.batch_id)
@@ -258,7 +401,24 @@ class BatchInfoRequestHandlerTest(HandlerTestBase):
     self.check_response(resp,
                         {'num_units': 1,
                          'test_unit_methods': test_unit_methods,
-                         'load_errors': load_errors},
+                         'load_errors': load_errors,
+                         'aborted': False},
+                        is_json=True)
+
+  def test_aborted(self):
+    batch = models.TestBatch(fullname='tests', num_units=1)
+    batch.key = ndb.Key(models.TestBatch, 'batchid')
+    test_unit_methods = {'tests': ['tests.module.TestCase.method']}
+    batch.set_info([], test_unit_methods, self.config)
+    batch.put()
+    models.BatchStatus(key=models.BatchStatus.get_key(batch.key),
+                       fail_fast=True, aborted=True).put()
+    resp = self.app.get(self.handler_path + 'batchid', status=200)
+    self.check_response(resp,
+                        {'num_units': 1,
+                         'test_unit_methods': test_unit_methods,
+                         'load_errors': [],
+                         'aborted': True},
                         is_json=True)
 
   def test_bad_id(self):
@@ -296,6 +456,26 @@ class BatchResultsRequestHandlerTest(HandlerTestBase):
                         status=200)
     self.check_response(resp, ['result1', 'result2'], is_json=True)
 
+  def test_partial(self):
+    batch = models.TestBatch(fullname='tests', num_units=5)
+    batch.key = ndb.Key(models.TestBatch, 'batchid')
+    batch.put()
+
+    @self.mock(rest)
+    def get_batch_results(bat, start):
+      return ['result1']
+
+    @self.mock(rest)
+    def get_partial_results(bat, start, conf):
+      self.assertEqual(batch, bat)
+      self.assertEqual(3, start)
+      self.assertEqual(self.config, conf)
+      return ['partial1']
+    resp = self.app.get('%s%s?start=3&partial=1' %
+                        (self.handler_path, 'batchid'), status=200)
+    self.check_response(resp, {'results': ['result1'],
+                               'partial_results': ['partial1']}, is_json=True)
+
   def test_bad_id(self):
     resp = self.app.get(self.handler_path + '111?start=3', status=404)
     self.check_response_text_not_expected(resp, '')
@@ -323,3 +503,142 @@ class BatchResultsRequestHandlerTest(HandlerTestBase):
     resp = self.app.get('%s%s?start=5' % (self.handler_path, 'batchid'),
                         status=400)
     self.check_response_text_not_expected(resp, '')
+
+
+class ImportProfileRequestHandlerTest(HandlerTestBase):
+  """Tests for the ImportProfileRequestHandler class."""
+
+  def setUp(self):
+    self.handler = rest.ImportProfileRequestHandler()
+    HandlerTestBase.setUp(self)
+    self.handler_path = self.url_path + 'import_profile/'
+    self.config.storage = 'datastore'
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    HandlerTestBase.tearDown(self)
+
+  def make_profile(self, module, secs):
+    return {'total_secs': secs,
+            'modules': [{'module': module, 'inclusive_secs': secs,
+                         'exclusive_secs': secs, 'inclusive_kb': None,
+                         'exclusive_kb': None}]}
+
+  def test_import_profile(self):
+    batch = models.TestBatch(fullname='tests')
+    batch.key = ndb.Key(models.TestBatch, 'batchid')
+    batch.set_info([], {'tests.a': [], 'tests.b': []}, self.config,
+                   import_profile=self.make_profile('tests.a', 1.0))
+    batch.put()
+    task = models.RunTestUnitTask(
+        key=models.RunTestUnitTask.get_key(batch.key, 0), fullname='tests.a')
+    task.set_json({'import_profile': self.make_profile('tests.a', 2.0)},
+                  self.config)
+    task.put()
+    resp = self.app.get(self.handler_path + 'batchid', status=200)
+    self.check_response(resp,
+                        {'num_profiles': 2,
+                         'total_secs': 3.0,
+                         'modules': [{'module': 'tests.a',
+                                      'inclusive_secs': 3.0,
+                                      'exclusive_secs': 3.0,
+                                      'inclusive_kb': None,
+                                      'exclusive_kb': None}]},
+                        is_json=True)
+
+  def test_not_profiled(self):
+    batch = models.TestBatch(fullname='tests')
+    batch.key = ndb.Key(models.TestBatch, 'batchid')
+    batch.set_info([], {'tests.a': []}, self.config)
+    batch.put()
+    resp = self.app.get(self.handler_path + 'batchid', status=200)
+    self.check_response(resp,
+                        {'num_profiles': 0, 'total_secs': 0.0, 'modules': []},
+                        is_json=True)
+
+  def test_bad_id(self):
+    resp = self.app.get(self.handler_path + '111', status=404)
+    self.check_response_text_not_expected(resp, '')
+
+
+class BatchProgressRequestHandlerTest(HandlerTestBase):
+  """Tests for the BatchProgressRequestHandler class."""
+
+  def setUp(self):
+    self.handler = rest.BatchProgressRequestHandler()
+    HandlerTestBase.setUp(self)
+    self.handler_path = self.url_path + 'batch_progress/'
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'datastore'
+
+    @self.mock(config)
+    def get_config():
+      return self.config
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    HandlerTestBase.tearDown(self)
+
+  def test_progress(self):
+    batch = models.TestBatch(fullname='tests', num_units=3)
+    batch.key = ndb.Key(models.TestBatch, 'batchid')
+    batch.put()
+    models.BatchProgress(key=models.BatchProgress.get_key(batch.key)).put()
+    models.record_unit_summary(
+        models.RunTestUnitTask.get_key(batch.key, 1),
+        {'passes': 2, 'failures': 1, 'errors': 0, 'skips': 0,
+         'load_errors': 0}, self.config)
+    resp = self.app.get(self.handler_path + 'batchid', status=200)
+    progress = json.loads(resp.body)
+    self.assertTrue(progress.pop('last_progress') > 0)
+    self.assertEqual({'num_units': 3, 'num_done': 1, 'passes': 2,
+                      'failures': 1, 'errors': 0, 'skips': 0,
+                      'load_errors': 0}, progress)
+
+  def test_bad_id(self):
+    resp = self.app.get(self.handler_path + '111', status=404)
+    self.check_response_text_not_expected(resp, '')
+
+
+class CancelBatchRequestHandlerTest(HandlerTestBase):
+  """Tests for the CancelBatchRequestHandler class."""
+
+  def setUp(self):
+    self.handler = rest.CancelBatchRequestHandler()
+    HandlerTestBase.setUp(self)
+    self.handler_path = self.url_path + 'cancel_batch/'
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.cancelled = []
+
+    @self.mock(runner)
+    def cancel_batch(batch_key, conf):
+      self.cancelled.append(batch_key)
+      return 3
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    HandlerTestBase.tearDown(self)
+
+  def test_cancel(self):
+    batch = models.TestBatch(fullname='tests', num_units=5)
+    batch.key = ndb.Key(models.TestBatch, 'batchid')
+    batch.put()
+    resp = self.app.post(self.handler_path + 'batchid', status=200)
+    self.check_response(resp, {'num_tasks_deleted': 3}, is_json=True)
+    self.assertEqual([batch.key], self.cancelled)
+
+  def test_bad_id(self):
+    resp = self.app.post(self.handler_path + '111', status=404)
+    self.check_response_text_not_expected(resp, '')
+    self.assertEqual([], self.cancelled)
@@ -18,6 +18,7 @@ __author__ = 'jacobltaylor@google.com (Jacob Taylor)'
 
 import copy
 import os
+import StringIO
 import sys
 import time
 import unittest
@@ -104,6 +105,320 @@ class RunTestAndCaptureOutputTest(unittest.TestCase):
     _, output = runner._run_test_and_capture_output(suite)
     self.assertTrue(expected_output in output)
 
+  def test_limits(self):
+
+    class Test(unittest.TestCase):
+
+      def test_a(self):
+        sys.stdout.write('a' * 10 + 'b' * 100 + 'c' * 10)
+
+      def test_b(self):
+        sys.stdout.write('d' * 5)
+
+    conf = copy.copy(config.get_config())
+    conf.max_method_output_bytes = 20
+    conf.max_output_bytes = 0
+    _, output = runner._run_test_and_capture_output(unittest.makeSuite(Test),
+                                                    conf=conf)
+    self.assertEqual('a' * 10 + '\n[aeta] 100 bytes of output were dropped '
+                     'here.\n' + 'c' * 10 + 'd' * 5, output)
+    conf.max_method_output_bytes = 0
+    conf.max_output_bytes = 10
+    _, output = runner._run_test_and_capture_output(unittest.makeSuite(Test),
+                                                    conf=conf)
+    self.assertEqual('a' * 5 + '\n[aeta] 115 bytes of output were dropped '
+                     'here.\n' + 'd' * 5, output)
+
+
+class OutputBufferTest(unittest.TestCase):
+  """Tests for _OutputBuffer."""
+
+  def test_unlimited(self):
+    output = runner._OutputBuffer(0)
+    output.write('a' * 1000)
+    output.write('b')
+    self.assertEqual('a' * 1000 + 'b', output.getvalue())
+    self.assertEqual(0, output.num_dropped)
+
+  def test_head_and_tail(self):
+    output = runner._OutputBuffer(7)
+    for data in ['ab', 'cde', 'fgh', 'i', 'jklm']:
+      output.write(data)
+    self.assertEqual(6, output.num_dropped)
+    self.assertEqual('abc\n[aeta] 6 bytes of output were dropped here.\n'
+                     'jklm', output.getvalue())
+
+  def test_within_limit(self):
+    output = runner._OutputBuffer(10)
+    output.write('abc')
+    output.write('defg')
+    self.assertEqual('abcdefg', output.getvalue())
+
+
+class TimingTestResultTest(unittest.TestCase):
+  """Tests for _TimingTestResult."""
+
+  def run_suite(self, *classes):
+    suite = unittest.TestSuite([unittest.makeSuite(cls) for cls in classes])
+    testresult, _ = runner._run_test_and_capture_output(suite)
+    self.assertTrue(isinstance(testresult, runner._TimingTestResult))
+    return testresult
+
+  def test_outcomes(self):
+
+    class Test(unittest.TestCase):
+
+      def test_pass(self):
+        pass
+
+      def test_fail(self):
+        self.fail()
+
+      def test_error(self):
+        raise ValueError
+
+      @unittest.skip('skipped')
+      def test_skip(self):
+        pass
+
+    testresult = self.run_suite(Test)
+    outcomes = dict((fullname.split('.')[-1], outcome)
+                    for (fullname, _, _, outcome) in testresult.timings)
+    self.assertEqual({'test_pass': 'pass', 'test_fail': 'fail',
+                      'test_error': 'error', 'test_skip': 'skip'}, outcomes)
+    for (_, start, stop, _) in testresult.timings:
+      self.assertTrue(start <= stop)
+    durations = testresult.get_durations()
+    self.assertFalse(any(name.endswith('test_skip') for name in durations))
+    self.assertEqual(3, len([name for name in durations
+                             if name.split('.')[-1].startswith('test_')]))
+
+  def test_timings_json(self):
+
+    class Test(unittest.TestCase):
+
+      def test_slow(self):
+        time.sleep(0.05)
+
+    timings = self.run_suite(Test).get_timings_json()
+    self.assertEqual(1, len(timings['methods']))
+    fullname, start, duration, outcome = timings['methods'][0]
+    self.assertTrue(fullname.endswith('Test.test_slow'))
+    self.assertEqual(0, start)
+    self.assertTrue(duration >= 50)
+    self.assertEqual('pass', outcome)
+
+  def test_class_fixture(self):
+
+    class First(unittest.TestCase):
+
+      def test_first(self):
+        pass
+
+    class Second(unittest.TestCase):
+
+      @classmethod
+      def setUpClass(cls):
+        time.sleep(0.05)
+
+      def test_second(self):
+        pass
+
+    testresult = self.run_suite(First, Second)
+    second_name = testresult.timings[1][0].rsplit('.', 1)[0]
+    self.assertTrue(testresult.fixture_secs[second_name] >= 0.05)
+    self.assertTrue(testresult.get_durations()[second_name] >= 0.05)
+
+  def test_deadline(self):
+    calls = []
+
+    class Test(unittest.TestCase):
+
+      @classmethod
+      def tearDownClass(cls):
+        calls.append('tearDownClass')
+
+      def test_1(self):
+        calls.append('test_1')
+
+      def test_2(self):
+        calls.append('test_2')
+
+    def make_result(*args, **kwargs):
+      result = runner._TimingTestResult(*args, **kwargs)
+      result.deadline = 0
+      return result
+
+    testresult, _ = runner._run_test_and_capture_output(
+        unittest.makeSuite(Test), resultclass=make_result)
+    self.assertTrue(testresult.shouldStop)
+    self.assertEqual(1, len(testresult.timings))
+    self.assertEqual(['test_1', 'tearDownClass'], calls)
+
+
+class GetRemainingSuiteTest(unittest.TestCase):
+  """Tests for _get_remaining_suite."""
+
+  def setUp(self):
+
+    class Test(unittest.TestCase):
+
+      def test_1(self):
+        pass
+
+      def test_2(self):
+        pass
+
+      def test_3(self):
+        pass
+
+    self.cases = [Test('test_1'), Test('test_2'), Test('test_3')]
+    for case in self.cases:
+      case.fullname = 'tests.Test.' + case._testMethodName
+    self.suite = unittest.TestSuite([
+        unittest.TestSuite(self.cases[:2]), self.cases[2]])
+
+  def test_remaining(self):
+    remaining = runner._get_remaining_suite(self.suite, 'tests.Test.test_1')
+    self.assertEqual(self.cases[1:], list(remaining))
+    remaining = runner._get_remaining_suite(self.suite, 'tests.Test.test_3')
+    self.assertEqual([], list(remaining))
+
+  def test_unknown_method(self):
+    self.assertEqual(None, runner._get_remaining_suite(self.suite,
+                                                       'tests.Test.test_4'))
+
+
+class MergeTestResultJsonTest(unittest.TestCase):
+  """Tests for _merge_test_result_json."""
+
+  def test_merge(self):
+    first = {'fullname': 'tests.Test', 'load_errors': [['tests.a', 'Error']],
+             'errors': [['tests.Test.test_1', 'Error']], 'failures': [],
+             'output': 'first ',
+             'timings': {'start': 10.0, 'methods': [['tests.Test.test_1', 0,
+                                                     500, 'error']],
+                         'fixtures': {'tests.Test': 100}}}
+    second = {'fullname': 'tests.Test', 'load_errors': [], 'errors': [],
+              'failures': [['tests.Test.test_2', 'Failure']],
+              'output': 'second',
+              'timings': {'start': 20.0, 'methods': [['tests.Test.test_2', 0,
+                                                      250, 'fail']],
+                          'fixtures': {'tests.Test': 50, 'tests': 10}},
+              'import_profile': {'total_secs': 1.0}}
+    self.assertEqual(
+        {'fullname': 'tests.Test', 'load_errors': [['tests.a', 'Error']],
+         'errors': [['tests.Test.test_1', 'Error']],
+         'failures': [['tests.Test.test_2', 'Failure']],
+         'output': 'first second',
+         'timings': {'start': 10.0,
+                     'methods': [['tests.Test.test_1', 0, 500, 'error'],
+                                 ['tests.Test.test_2', 10000, 250, 'fail']],
+                     'fixtures': {'tests.Test': 150, 'tests': 10}},
+         'import_profile': {'total_secs': 1.0}},
+        runner._merge_test_result_json(first, second))
+
+  def test_no_methods_before(self):
+    first = {'start': 0, 'methods': [], 'fixtures': {}}
+    second = {'start': 20.0, 'methods': [['tests.Test.test_2', 0, 250, 'fail']],
+              'fixtures': {}}
+    self.assertEqual(second, runner._merge_timings_json(first, second))
+
+
+class StreamingTestResultTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for _StreamingTestResult."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'datastore'
+    self.config.stream_results_methods = 2
+    self.config.stream_results_secs = 0
+    self.task_key = models.RunTestUnitTask.get_key(
+        ndb.Key(models.TestBatch, 1), 0)
+
+    class Test(unittest.TestCase):
+
+      def test_1_pass(self):
+        pass
+
+      def test_2_fail(self):
+        self.fail('failed')
+
+      def test_3_error(self):
+        raise ValueError
+
+    self.suite = unittest.makeSuite(Test)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    self.tear_down_attributes()
+
+  def run_suite(self):
+    resultclass = runner._get_result_class(self.task_key, self.config)
+    testresult, _ = runner._run_test_and_capture_output(
+        self.suite, resultclass=resultclass)
+    return testresult
+
+  def test_stream(self):
+    testresult = self.run_suite()
+    self.assertTrue(isinstance(testresult, runner._StreamingTestResult))
+    # The third outcome is still buffered when the unit finishes.
+    self.assertEqual([models.MethodResultChunk.get_key(self.task_key, 0)],
+                     testresult.chunk_keys)
+    chunks = models.get_method_result_chunks([self.task_key], self.config)[0]
+    self.assertEqual(1, len(chunks))
+    methods = chunks[0].get_json()
+    self.assertEqual(['pass', 'fail'], [outcome for (_, outcome, _) in methods])
+    self.assertTrue(methods[0][0].endswith('Test.test_1_pass'))
+    self.assertEqual(None, methods[0][2])
+    self.assertTrue('failed' in methods[1][2])
+
+  def test_stream_by_time(self):
+    self.config.stream_results_methods = 0
+    self.config.stream_results_secs = 5
+    # Every call to time.time() advances the clock by 2 seconds.
+    times = iter(range(1000, 2000, 2))
+    self.mock(time, 'time')(lambda: float(times.next()))
+    testresult = self.run_suite()
+    # Each method finishes more than 5 seconds after the last write.
+    self.assertEqual(3, len(testresult.chunk_keys))
+
+  def test_disabled(self):
+    self.config.stream_results_methods = 0
+    self.assertEqual(runner._TimingTestResult,
+                     runner._get_result_class(self.task_key, self.config))
+    self.config.stream_results_methods = 2
+    self.config.storage = 'immediate'
+    self.assertEqual(runner._TimingTestResult,
+                     runner._get_result_class(self.task_key, self.config))
+
+
+class ImportProfilerTest(unittest.TestCase):
+  """Tests for _start_import_profiler and _stop_import_profiler."""
+
+  def setUp(self):
+    self.config = copy.copy(config.get_config())
+
+  def test_disabled(self):
+    self.config.profile_imports = False
+    profiler = runner._start_import_profiler(self.config)
+    self.assertEqual(None, profiler)
+    self.assertEqual(None, runner._stop_import_profiler(profiler))
+
+  def test_enabled(self):
+    self.config.profile_imports = True
+    profiler = runner._start_import_profiler(self.config)
+    try:
+      self.assertTrue(profiler)
+    finally:
+      profile = runner._stop_import_profiler(profiler)
+    self.assertEqual(0.0, profile['total_secs'])
+    self.assertEqual([], profile['modules'])
+
 
 class TaskHasFailedTest(unittest.TestCase, utils.MockAttributeMixin):
   """Tests for _this_task_has_failed_before."""
@@ -123,6 +438,30 @@ class TaskHasFailedTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertEqual(True, runner._this_task_has_failed_before())
 
 
+class GetUnitSummaryTest(unittest.TestCase):
+  """Tests for _get_unit_summary."""
+
+  def test_summary(self):
+    data = {'failures': [['a.B.test_fail', 'trace']],
+            'errors': [],
+            'load_errors': [['a.c', 'ImportError']],
+            'timings': {'methods': [['a.B.test_pass', 0, 1, 'pass'],
+                                    ['a.B.test_xfail', 1, 2, 'xfail'],
+                                    ['a.B.test_skip', 2, 3, 'skip'],
+                                    ['a.B.test_fail', 3, 4, 'fail']]},
+            'reruns': {'flaky': ['a.B.test_flaky']}}
+    self.assertEqual({'passes': 3, 'failures': 1, 'errors': 0, 'skips': 1,
+                      'load_errors': 1},
+                     runner._get_unit_summary(data))
+
+  def test_no_timings(self):
+    data = {'failures': [], 'errors': [['a.B.test_error', 'trace']],
+            'load_errors': []}
+    self.assertEqual({'passes': 0, 'failures': 0, 'errors': 1, 'skips': 0,
+                      'load_errors': 0},
+                     runner._get_unit_summary(data))
+
+
 class RunTestUnitTest(unittest.TestCase, utils.MockAttributeMixin):
   """Tests for _run_test_unit."""
 
@@ -154,8 +493,11 @@ class RunTestUnitTest(unittest.TestCase, utils.MockAttributeMixin):
       self.assertEqual(self.test_fullname, name)
       return MockTestObject()
 
+    self.orig_run_test_and_capture_output = (
+        runner._run_test_and_capture_output)
+
     @self.mock(runner)
-    def _run_test_and_capture_output(suite):
+    def _run_test_and_capture_output(suite, resultclass=None, conf=None):
       test_names = [case.id().split('.')[-1] for case in suite]
       self.assertEqual(self.test_method_names, test_names)
       test_result = unittest.TestResult()
@@ -198,6 +540,87 @@ class RunTestUnitTest(unittest.TestCase, utils.MockAttributeMixin):
     self.load_errors = [('badmodule', 'ImportError')]
     self.check_run_test_unit(0)
 
+  def test_timings(self):
+    orig_run = self.orig_run_test_and_capture_output
+
+    @self.mock(runner)
+    def _run_test_and_capture_output(suite, resultclass=None, conf=None):
+      result, _ = orig_run(unittest.TestSuite())
+      result.timings = [['something.RunTestUnitTest.test_one_unit', 10.0,
+                         10.5, 'pass']]
+      result.fixture_secs = {'something.RunTestUnitTest': 0.25}
+      return result, 'some output'
+
+    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    self.batch.put()
+    self.test_fullname = 'something.RunTestUnitTest.test_one_unit'
+    self.test_method_names = ['test_one_unit']
+    self.check_run_test_unit(0)
+    json = models.RunTestUnitTask.get_key(self.batch.key, 0).get().get_json()
+    self.assertEqual(
+        {'start': 10.0,
+         'methods': [['something.RunTestUnitTest.test_one_unit', 0, 500,
+                      'pass']],
+         'fixtures': {'something.RunTestUnitTest': 250}},
+        json['timings'])
+    self.assertEqual(
+        {'something.RunTestUnitTest.test_one_unit': 0.5,
+         'something.RunTestUnitTest': 0.25},
+        models.get_test_durations(['something.RunTestUnitTest.test_one_unit',
+                                   'something.RunTestUnitTest',
+                                   'something']))
+    summary = models.get_batch_summary(self.batch.key, self.config)
+    self.assertEqual(1, summary['num_done'])
+    self.assertEqual(1, summary['passes'])
+
+  def test_progress_error(self):
+
+    @self.mock(models)
+    def record_unit_summary(task_key, summary, conf):
+      raise ValueError('The progress could not be recorded.')
+
+    @self.mock(models.BatchProgress)
+    def put(progress, **ctx_options):
+      raise ValueError('The progress could not be recorded.')
+
+    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    self.batch.put()
+    self.test_fullname = 'something.RunTestUnitTest'
+    self.test_method_names = ['test_one_unit', 'test_two_units']
+    self.check_run_test_unit(0)
+
+  def test_streamed_results_deleted(self):
+    self.config.storage = 'datastore'
+    self.config.stream_results_secs = 10
+
+    @self.mock(runner)
+    def _run_test_and_capture_output(suite, resultclass=None, conf=None):
+      result = resultclass(StringIO.StringIO(), True, 2)
+      self.assertTrue(isinstance(result, runner._StreamingTestResult))
+      result._pending = [['something.RunTestUnitTest.test_one_unit', 'pass',
+                          None]]
+      result._write_pending()
+      self.assertEqual(1, len(result.chunk_keys))
+      return result, 'some output'
+
+    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    self.batch.put()
+    self.test_fullname = 'something.RunTestUnitTest.test_one_unit'
+    self.test_method_names = ['test_one_unit']
+    self.check_run_test_unit(0)
+    task_key = models.RunTestUnitTask.get_key(self.batch.key, 0)
+    self.assertEqual([[]],
+                     models.get_method_result_chunks([task_key], self.config))
+
+  def test_durations_not_recorded(self):
+    self.config.record_durations = False
+    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    self.batch.put()
+    self.test_fullname = 'something.RunTestUnitTest.test_one_unit'
+    self.test_method_names = ['test_one_unit']
+    self.check_run_test_unit(0)
+    self.assertEqual({}, models.get_test_durations([self.test_fullname]))
+
   def test_retried(self):
     self.mock(runner, '_this_task_has_failed_before')(lambda: True)
     self.batch = models.TestBatch(fullname='tests', num_units=1)
@@ -210,9 +633,92 @@ class RunTestUnitTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertTrue(isinstance(json, dict))
     self.assertEqual(1, len(json['load_errors']))
 
+  def test_fail_fast(self):
+    self.batch = models.TestBatch(fullname='tests', num_units=2)
+    self.batch.put()
+    status_key = models.BatchStatus.get_key(self.batch.key)
+    models.BatchStatus(key=status_key, fail_fast=True).put()
+    self.test_fullname = 'something.RunTestUnitTest.test_one_unit'
+    self.test_method_names = ['test_one_unit']
+    self.check_run_test_unit(0)
+    # The unit passed, so the batch goes on.
+    self.assertFalse(status_key.get().aborted)
 
-class DeleteBatchTest(unittest.TestCase, utils.MockAttributeMixin):
-  """Tests for _delete_batch."""
+    @self.mock(runner)
+    def _run_test_and_capture_output(suite, resultclass=None, conf=None):
+      case = RunTestUnitTest('test_two_units')
+      case.fullname = self.test_fullname
+      test_result = unittest.TestResult()
+      test_result.failures.append((case, 'AssertionError'))
+      return test_result, 'some output'
+
+    self.test_fullname = 'something.RunTestUnitTest.test_two_units'
+    self.test_method_names = ['test_two_units']
+    self.check_run_test_unit(1)
+    self.assertTrue(status_key.get().aborted)
+
+  def test_cancelled(self):
+    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    self.batch.put()
+    models.BatchStatus(key=models.BatchStatus.get_key(self.batch.key),
+                       cancelled=True).put()
+
+    @self.mock(logic)
+    def get_requested_object(name, conf):
+      self.fail('Tests of a cancelled batch should not be loaded.')
+
+    task_key = models.RunTestUnitTask.get_key(self.batch.key, 0)
+    self.assertTrue(runner._run_test_unit('something.RunTestUnitTest',
+                                          task_key, self.config))
+    self.assertEqual(None, task_key.get())
+
+  def test_cancelled_while_running(self):
+    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    self.batch.put()
+    status_key = models.BatchStatus.get_key(self.batch.key)
+    task_key = models.RunTestUnitTask.get_key(self.batch.key, 0)
+    self.config.storage = 'datastore'
+    self.config.stream_results_secs = 10
+
+    @self.mock(runner)
+    def _run_test_and_capture_output(suite, resultclass=None, conf=None):
+      result = resultclass(StringIO.StringIO(), True, 2)
+      result._pending = [['something.RunTestUnitTest.test_one_unit', 'pass',
+                          None]]
+      result._write_pending()
+      models.BatchStatus(key=status_key, cancelled=True).put()
+      return result, 'some output'
+
+    self.test_fullname = 'something.RunTestUnitTest.test_one_unit'
+    self.test_method_names = ['test_one_unit']
+    self.assertTrue(runner._run_test_unit(self.test_fullname, task_key,
+                                          self.config))
+    # Neither the result nor the streamed outcomes are stored.
+    self.assertEqual(None, task_key.get())
+    self.assertEqual([[]],
+                     models.get_method_result_chunks([task_key], self.config))
+
+  def test_aborted(self):
+    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    self.batch.put()
+    models.BatchStatus(key=models.BatchStatus.get_key(self.batch.key),
+                       fail_fast=True, aborted=True).put()
+
+    @self.mock(logic)
+    def get_requested_object(name, conf):
+      self.fail('Skipped tests should not be loaded.')
+
+    task_key = models.RunTestUnitTask.get_key(self.batch.key, 0)
+    self.assertTrue(runner._run_test_unit('something.RunTestUnitTest',
+                                          task_key, self.config))
+    json = task_key.get().get_json()
+    self.assertTrue(json['skipped'])
+    self.assertEqual(([], [], []),
+                     (json['load_errors'], json['errors'], json['failures']))
+
+
+class ContinueTestUnitTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for continuing a test unit in another task."""
 
   def setUp(self):
     self.testbed = testbed.Testbed()
@@ -220,57 +726,389 @@ class DeleteBatchTest(unittest.TestCase, utils.MockAttributeMixin):
     self.testbed.init_memcache_stub()
     self.testbed.init_datastore_v3_stub()
     self.config = copy.copy(config.get_config())
-    self.count_deferred = 0
-    self.batch = None
-    self.exp_num_done = None
+    self.config.storage = 'datastore'
+    self.config.stream_results_methods = self.config.stream_results_secs = 0
+    self.config.task_deadline_secs = 0
+    self.config.record_durations = False
+    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    self.batch.put()
+    self.task_key = models.RunTestUnitTask.get_key(self.batch.key, 0)
+    self.calls = []
+    self.deferred = []
+    calls = self.calls
+
+    class Test(unittest.TestCase):
+
+      @classmethod
+      def setUpClass(cls):
+        calls.append('setUpClass')
+
+      @classmethod
+      def tearDownClass(cls):
+        calls.append('tearDownClass')
+
+      def test_1(self):
+        calls.append('test_1')
+
+      def test_2(self):
+        calls.append('test_2')
+        self.fail('failed')
+
+      def test_3(self):
+        calls.append('test_3')
+
+    class MockTestObject(object):
+
+      def get_suite(test_self, conf, errors_out=None):
+        cases = unittest.makeSuite(Test)
+        for case in cases:
+          case.fullname = 'tests.Test.' + case._testMethodName
+        return cases
+
+    @self.mock(logic)
+    def get_requested_object(name, conf):
+      self.assertEqual('tests.Test', name)
+      return MockTestObject()
 
     @self.mock(deferred)
-    def defer(func, batch_key, num_done, config, _queue, _countdown):
-      self.assertEqual(runner._delete_batch, func)
-      self.assertEqual(self.batch.key, batch_key)
-      self.assertEqual(self.exp_num_done, num_done)
-      self.assertEqual(self.config, config)
-      self.assertEqual(self.config.test_queue, _queue)
-      self.assertEqual(runner._DELETE_TIME_SECS, _countdown)
-      self.count_deferred += 1
+    def defer(func, *args, **kwargs):
+      self.assertEqual(self.config.test_queue, kwargs.pop('_queue'))
+      self.deferred.append((func, args, kwargs))
 
   def tearDown(self):
     self.testbed.deactivate()
     self.tear_down_attributes()
 
-  def test_already_done(self):
-    self.batch = models.TestBatch(fullname='tests', num_units=1)
-    self.batch.put()
-    task = models.RunTestUnitTask(fullname='tests.unit')
-    task.key = models.RunTestUnitTask.get_key(self.batch.key, 0)
-    task.put()
-    self.exp_num_done = 1
-    # This shouldn't delete anything yet.
-    runner._delete_batch(self.batch.key, 0, self.config)
-    self.assertEqual(self.batch, self.batch.key.get())
-    self.assertEqual(task, task.key.get())
-    self.assertEqual(1, self.count_deferred)
-    runner._delete_batch(self.batch.key, 1, self.config)
-    # Now everything should be deleted.
-    self.assertEqual(None, self.batch.key.get())
-    self.assertEqual(None, task.key.get())
-    self.assertEqual(1, self.count_deferred)
+  def test_continue(self):
+    # Stop after the first method.
+    self.assertFalse(runner._run_test_unit('tests.Test', self.task_key,
+                                           self.config, False, deadline=0))
+    self.assertEqual(['setUpClass', 'test_1', 'tearDownClass'], self.calls)
+    self.assertEqual(None, self.task_key.get())
+    checkpoint = models.UnitCheckpoint.get_key(self.task_key).get().get_json()
+    self.assertEqual('tests.Test.test_1', checkpoint['last_method'])
+    self.assertEqual([(runner._run_test_unit,
+                       ('tests.Test', self.task_key, self.config),
+                       {'continued': True})], self.deferred)
+    # Storing the checkpoint counts as progress of the batch.
+    self.assertTrue(models.BatchProgress.get_key(self.batch.key).get())
+    # Continue with the remaining methods.
+    self.assertTrue(runner._run_test_unit('tests.Test', self.task_key,
+                                          self.config, False, continued=True))
+    self.assertEqual(['setUpClass', 'test_1', 'tearDownClass', 'setUpClass',
+                      'test_2', 'test_3', 'tearDownClass'], self.calls)
+    result = self.task_key.get().get_json()
+    self.assertEqual(['tests.Test.test_2'],
+                     [name for (name, _) in result['failures']])
+    self.assertEqual(['tests.Test.test_1', 'tests.Test.test_2',
+                      'tests.Test.test_3'],
+                     [method[0] for method in result['timings']['methods']])
+    self.assertEqual(None, models.UnitCheckpoint.get_key(self.task_key).get())
+
+  def test_retried_continuation(self):
+    runner._run_test_unit('tests.Test', self.task_key, self.config, False,
+                          deadline=0)
+    runner._run_test_unit('tests.Test', self.task_key, self.config, False,
+                          deadline=0, continued=True)
+    self.assertTrue(runner._run_test_unit('tests.Test', self.task_key,
+                                          self.config, True, continued=True))
+    result = self.task_key.get().get_json()
+    # The results of the first two parts are kept.
+    self.assertEqual(['tests.Test.test_2'],
+                     [name for (name, _) in result['failures']])
+    self.assertEqual(1, len(result['load_errors']))
+
+  def test_lost_checkpoint(self):
+    self.assertTrue(runner._run_test_unit('tests.Test', self.task_key,
+                                          self.config, False, continued=True))
+    self.assertEqual([], self.calls)
+    self.assertEqual(1, len(self.task_key.get().get_json()['load_errors']))
+
+
+class RerunTestMethodsTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for running failed test methods again."""
 
-  def test_no_progress(self):
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'datastore'
+    self.config.stream_results_methods = self.config.stream_results_secs = 0
+    self.config.task_deadline_secs = 0
+    self.config.record_durations = False
     self.batch = models.TestBatch(fullname='tests', num_units=1)
     self.batch.put()
-    self.exp_num_done = 0
-    runner._delete_batch(self.batch.key, 0, self.config)
-    # Now everything should be deleted.
-    self.assertEqual(None, self.batch.key.get())
-    self.assertEqual(0, self.count_deferred)
+    self.status = models.BatchStatus(
+        key=models.BatchStatus.get_key(self.batch.key), max_reruns=2)
+    self.status.put()
+    self.task_key = models.RunTestUnitTask.get_key(self.batch.key, 0)
+    self.calls = []
+    self.deferred = []
+    # How many times test_flaky fails before it passes.
+    self.flakes = [1]
+    calls = self.calls
+    flakes = self.flakes
 
-  def test_already_deleted(self):
-    self.batch = models.TestBatch(fullname='tests', num_units=1)
+    class Test(unittest.TestCase):
+
+      def test_pass(self):
+        calls.append('test_pass')
+
+      def test_flaky(self):
+        calls.append('test_flaky')
+        if flakes[0]:
+          flakes[0] -= 1
+          raise ValueError('flaked')
+
+      def test_fail(self):
+        calls.append('test_fail')
+        self.fail('failed')
+
+    class MockTestObject(object):
+
+      def get_suite(test_self, conf, errors_out=None):
+        cases = unittest.makeSuite(Test)
+        for case in cases:
+          case.fullname = 'tests.Test.' + case._testMethodName
+        return cases
+
+    @self.mock(logic)
+    def get_requested_object(name, conf):
+      self.assertEqual('tests.Test', name)
+      return MockTestObject()
+
+    @self.mock(deferred)
+    def defer(func, *args, **kwargs):
+      self.assertEqual(self.config.test_queue, kwargs.pop('_queue'))
+      self.deferred.append((func, args, kwargs))
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    self.tear_down_attributes()
+
+  def run_deferred(self):
+    while self.deferred:
+      (func, args, kwargs) = self.deferred.pop(0)
+      self.assertEqual(runner._rerun_test_methods, func)
+      func(*args, **kwargs)
+
+  def test_get_methods_suite(self):
+    suite = logic.get_requested_object('tests.Test', self.config).get_suite(
+        self.config)
+    methods_suite = runner._get_methods_suite(
+        suite, ['tests.Test.test_pass', 'tests.Test.test_fail', 'unknown'])
+    self.assertEqual(['test_fail', 'test_pass'],
+                     [case._testMethodName for case in methods_suite])
+
+  def test_rerun(self):
+    self.assertTrue(runner._run_test_unit('tests.Test', self.task_key,
+                                          self.config, False))
+    # The result is only stored after the reruns.
+    self.assertEqual(None, self.task_key.get())
+    self.assertEqual([(runner._rerun_test_methods,
+                       ('tests.Test', self.task_key, self.config), {})],
+                     self.deferred)
+    self.run_deferred()
+    # Only failed methods are run again, until they pass or ran 3 times.
+    self.assertEqual(['test_fail', 'test_flaky', 'test_pass', 'test_fail',
+                      'test_flaky', 'test_fail'], self.calls)
+    result = self.task_key.get().get_json()
+    self.assertEqual({'attempts': {'tests.Test.test_flaky': ['error', 'pass'],
+                                   'tests.Test.test_fail': ['fail', 'fail',
+                                                            'fail']},
+                      'flaky': ['tests.Test.test_flaky'],
+                      'failing': ['tests.Test.test_fail']},
+                     result['reruns'])
+    self.assertEqual([], result['errors'])
+    self.assertEqual(['tests.Test.test_fail'],
+                     [name for (name, _) in result['failures']])
+    self.assertEqual(None, models.UnitCheckpoint.get_key(self.task_key).get())
+
+  def test_fail_fast(self):
+    self.status.fail_fast = True
+    self.status.put()
+    runner._run_test_unit('tests.Test', self.task_key, self.config, False)
+    # The batch is only aborted if the failures are confirmed.
+    self.assertFalse(self.status.key.get().aborted)
+    self.run_deferred()
+    self.assertTrue(self.status.key.get().aborted)
+
+  def test_no_reruns(self):
+    self.status.max_reruns = 0
+    self.status.put()
+    runner._run_test_unit('tests.Test', self.task_key, self.config, False)
+    self.assertEqual([], self.deferred)
+    result = self.task_key.get().get_json()
+    self.assertFalse('reruns' in result)
+    self.assertEqual(1, len(result['errors']))
+
+  def test_cancelled(self):
+    runner._run_test_unit('tests.Test', self.task_key, self.config, False)
+    self.status.cancelled = True
+    self.status.put()
+    self.run_deferred()
+    self.assertEqual(['test_fail', 'test_flaky', 'test_pass'], self.calls)
+    self.assertEqual(None, self.task_key.get())
+
+  def test_retried(self):
+    runner._run_test_unit('tests.Test', self.task_key, self.config, False)
+    self.mock(runner, '_this_task_has_failed_before')(lambda: True)
+    self.run_deferred()
+    result = self.task_key.get().get_json()
+    self.assertEqual(1, len(result['load_errors']))
+    self.assertEqual(['tests.Test.test_fail', 'tests.Test.test_flaky'],
+                     result['reruns']['failing'])
+
+
+class RunTestUnitsTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for _run_test_units."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'datastore'
+    self.batch = models.TestBatch(fullname='tests', num_units=3)
     self.batch.put()
-    self.batch.key.delete()
-    # This should do nothing.
-    runner._delete_batch(self.batch.key, 1, self.config)
+    self.fullnames = ['tests.a', 'tests.b', 'tests.c']
+    self.task_keys = []
+    for (i, fullname) in enumerate(self.fullnames):
+      task = models.RunTestUnitTask(
+          key=models.RunTestUnitTask.get_key(self.batch.key, i),
+          fullname=fullname)
+      task.put()
+      self.task_keys.append(task.key)
+    self.runs = []
+
+    self.continued = []
+    self.deferred = []
+
+    @self.mock(runner)
+    def _run_test_unit(fullname, task_key, conf, has_failed_before=None,
+                       deadline=None):
+      self.assertEqual(self.config, conf)
+      self.runs.append((fullname, task_key, has_failed_before))
+      return fullname not in self.continued
+
+    @self.mock(deferred)
+    def defer(func, *args, **kwargs):
+      self.assertEqual(self.config.test_queue, kwargs.pop('_queue'))
+      self.deferred.append((func, args, kwargs))
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    self.tear_down_attributes()
+
+  def test_run_all(self):
+    runner._run_test_units(self.fullnames, self.task_keys, self.config)
+    self.assertEqual(zip(self.fullnames, self.task_keys, [False] * 3),
+                     self.runs)
+
+  def test_retried(self):
+    self.mock(runner, '_this_task_has_failed_before')(lambda: True)
+    task = self.task_keys[0].get()
+    task.set_json({'fullname': 'tests.a'}, self.config)
+    task.put()
+    runner._run_test_units(self.fullnames, self.task_keys, self.config)
+    # tests.a finished before, tests.b was running when the task failed.
+    self.assertEqual([('tests.b', self.task_keys[1], True),
+                      ('tests.c', self.task_keys[2], False)], self.runs)
+
+  def test_unit_continued(self):
+    self.continued = ['tests.b']
+    runner._run_test_units(self.fullnames, self.task_keys, self.config)
+    self.assertEqual(['tests.a', 'tests.b'],
+                     [fullname for (fullname, _, _) in self.runs])
+    self.assertEqual([(runner._run_test_units,
+                       (['tests.c'], self.task_keys[2:], self.config), {})],
+                     self.deferred)
+
+  def test_deadline_passed(self):
+    self.mock(runner, '_get_deadline')(lambda conf: 0)
+    runner._run_test_units(self.fullnames, self.task_keys, self.config)
+    # At least one unit is run by every task.
+    self.assertEqual(['tests.a'], [fullname for (fullname, _, _) in self.runs])
+    self.assertEqual([(runner._run_test_units,
+                       (['tests.b', 'tests.c'], self.task_keys[1:],
+                        self.config), {})],
+                     self.deferred)
+
+
+class PackUnitsTest(unittest.TestCase):
+  """Tests for _pack_units."""
+
+  def make_unit_methods(self, num_methods):
+    unit_methods = []
+    for (i, num) in enumerate(num_methods):
+      methods = [logic.Method('tests.m%s.Case.test%s' % (i, j),
+                              unittest.TestCase, 'test%s' % j)
+                 for j in range(num)]
+      unit_methods.append((logic.TestObject('tests.m%s' % i), methods))
+    return unit_methods
+
+  def test_static_counts(self):
+    unit_methods = self.make_unit_methods([1, 1, 2, 5, 1, 1])
+    self.assertEqual([[0, 1, 2], [3], [4, 5]],
+                     runner._pack_units(unit_methods, {}, 4))
+
+  def test_durations(self):
+    unit_methods = self.make_unit_methods([1, 1, 1])
+    durations = {'tests.m0.Case.test0': 0.1, 'tests.m1.Case.test0': 3.0,
+                 'tests.m2.Case.test0': 0.1}
+    self.assertEqual([[0, 1], [2]],
+                     runner._pack_units(unit_methods, durations, 3.15))
+
+  def test_empty(self):
+    self.assertEqual([], runner._pack_units([], {}, 10))
+
+
+class RecordProgressTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for _record_progress."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.config = copy.copy(config.get_config())
+    self.batch_key = ndb.Key(models.TestBatch, 'batchid')
+    self.progress_key = models.BatchProgress.get_key(self.batch_key)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    self.tear_down_attributes()
+
+  def test_record(self):
+    runner._record_progress(self.batch_key, self.config)
+    self.assertTrue(self.progress_key.get().last_progress)
+
+  def test_recent(self):
+    runner._record_progress(self.batch_key, self.config)
+    last_progress = self.progress_key.get().last_progress
+    time.sleep(0.01)
+    runner._record_progress(self.batch_key, self.config)
+    self.assertEqual(last_progress, self.progress_key.get().last_progress)
+
+  def test_old(self):
+    runner._record_progress(self.batch_key, self.config)
+    last_progress = self.progress_key.get().last_progress
+    self.mock(runner, '_PROGRESS_INTERVAL_SECS')(-60)
+    time.sleep(0.01)
+    runner._record_progress(self.batch_key, self.config)
+    self.assertTrue(self.progress_key.get().last_progress > last_progress)
+
+  def test_error(self):
+
+    @self.mock(models.BatchProgress)
+    def put(progress, **ctx_options):
+      raise ValueError('The progress could not be recorded.')
+
+    runner._record_progress(self.batch_key, self.config)
+    self.assertEqual(None, self.progress_key.get())
 
 
 class InitializeBatchTest(unittest.TestCase, utils.TestDataMixin,
@@ -308,13 +1146,21 @@ class InitializeBatchTest(unittest.TestCase, utils.TestDataMixin,
         self.assertEqual(self.fullname, test_self.fullname)
         return [MockTestObject(unit) for unit in self.test_unit_methods]
 
+      def get_unit_methods(test_self, conf, errors_out=None):
+        return [(unit, unit.get_methods(conf))
+                for unit in test_self.get_units(conf, errors_out)]
+
       def get_suite(test_self, conf, errors_out=None):
         # This would normally return a TestSuite but we return a dictionary
         # instead.
         return {'methods': self.test_unit_methods[test_self.fullname]}
 
       def get_methods(test_self, conf, errors_out=None):
-        methods = self.test_unit_methods[test_self.fullname]
+        if test_self.fullname in self.test_unit_methods:
+          methods = self.test_unit_methods[test_self.fullname]
+        else:
+          # The object being initialized contains all units.
+          methods = sum(self.test_unit_methods.values(), [])
         return [MockTestObject(method) for method in methods]
 
     @self.mock(logic)
@@ -326,27 +1172,26 @@ class InitializeBatchTest(unittest.TestCase, utils.TestDataMixin,
     self.testbed.deactivate()
     self.tear_down_attributes()
 
-  def check_initialize_batch(self):
+  def check_initialize_batch(self, shard_index=0, shard_count=1):
     batch = models.TestBatch(fullname=self.fullname)
     batch.put()
-    runner._initialize_batch(batch.fullname, batch.key, self.config)
+    runner._initialize_batch(batch.fullname, batch.key, self.config,
+                             shard_index, shard_count)
     batch = batch.key.get()
     self.assertEqual(self.fullname, batch.fullname)
     self.assertEqual(len(self.test_unit_methods), batch.num_units)
     json = batch.get_json()
     self.assertTrue(isinstance(json, dict))
     self.assertEqual(self.test_unit_methods, json['test_unit_methods'])
-    self.assertEqual(len(self.test_unit_methods) + 1, len(self.deferred))
-    for name, call in zip(self.test_unit_methods, self.deferred):
+    self.assertEqual(len(self.test_unit_methods), len(self.deferred))
+    for (i, (name, call)) in enumerate(zip(self.test_unit_methods,
+                                           self.deferred)):
       self.assertEqual({}, call.kwargs)
       self.assertEqual(runner._run_test_unit, call.func)
       self.assertEqual(name, call.args[0])
       self.assertTrue(isinstance(call.args[1], ndb.Key))
       self.assertEqual(self.config, call.args[2])
-    last_call = self.deferred[-1]
-    self.assertEqual(runner._delete_batch, last_call.func)
-    self.assertEqual((batch.key, 0, self.config), last_call.args)
-    self.assertTrue(last_call.countdown > 0)
+      self.assertEqual('aeta-%s-%s' % (batch.key.id(), i), call.name)
 
   def test_normal(self):
     self.fullname = 'test.package'
@@ -358,6 +1203,197 @@ class InitializeBatchTest(unittest.TestCase, utils.TestDataMixin,
     }
     self.check_initialize_batch()
 
+  def test_cancelled(self):
+    self.fullname = 'test.package'
+    self.test_unit_methods = {
+        'test.package.module1': ['test.package.module1.TestCase.method1']}
+    batch = models.TestBatch(fullname=self.fullname)
+    batch.put()
+    models.BatchStatus(key=models.BatchStatus.get_key(batch.key),
+                       cancelled=True).put()
+    batch.key.delete()
+    runner._initialize_batch(batch.fullname, batch.key, self.config)
+    # Nothing of the cancelled batch is stored or run.
+    self.assertEqual(None, batch.key.get())
+    self.assertEqual(None, models.RunTestUnitTask.get_key(batch.key, 0).get())
+    self.assertEqual([], self.deferred)
+
+  def test_unit_target_secs(self):
+    self.config.unit_target_secs = 30
+    method_durations = {'tests.module.Case.method': 2.0}
+
+    @self.mock(models)
+    def get_test_durations(fullnames):
+      self.assertEqual(['tests', 'tests.module', 'tests.module.Case',
+                        'tests.module.Case.method'], fullnames)
+      return method_durations
+
+    @self.mock(logic)
+    def partition_units(test, conf, durations, target_secs, errors_out=None):
+      self.assertEqual(self.fullname, test.fullname)
+      self.assertEqual(self.config, conf)
+      self.assertEqual(method_durations, durations)
+      self.assertEqual(30, target_secs)
+      return test.get_unit_methods(conf, errors_out)
+
+    self.fullname = 'tests'
+    self.test_unit_methods = {'tests.module': ['tests.module.Case.method']}
+    self.check_initialize_batch()
+
+  def test_shard(self):
+    durations = {}
+
+    @self.mock(models)
+    def get_test_durations(fullnames):
+      return durations
+
+    @self.mock(logic)
+    def get_shard(unit_methods, shard_index, shard_count, durations=None):
+      self.assertEqual(1, shard_index)
+      self.assertEqual(2, shard_count)
+      # Without recorded durations, units are sharded by name.
+      self.assertEqual(None, durations)
+      return [(unit, methods) for (unit, methods) in unit_methods
+              if unit.fullname == 'tests.module2']
+
+    self.fullname = 'tests'
+    all_unit_methods = {'tests.module1': ['tests.module1.Case.method'],
+                        'tests.module2': ['tests.module2.Case.method']}
+    self.test_unit_methods = all_unit_methods
+    batch = models.TestBatch(fullname=self.fullname)
+    batch.put()
+    runner._initialize_batch(batch.fullname, batch.key, self.config, 1, 2)
+    json = batch.key.get().get_json()
+    self.assertEqual({'tests.module2': ['tests.module2.Case.method']},
+                     json['test_unit_methods'])
+
+  def test_changed_paths(self):
+
+    @self.mock(logic)
+    def get_affected_unit_methods(unit_methods, changed_paths, conf):
+      self.assertEqual(['models.py'], changed_paths)
+      self.assertEqual(self.config, conf)
+      return [(unit, methods) for (unit, methods) in unit_methods
+              if unit.fullname == 'tests.module1']
+
+    self.fullname = 'tests'
+    self.test_unit_methods = {'tests.module1': ['tests.module1.Case.method'],
+                              'tests.module2': ['tests.module2.Case.method']}
+    batch = models.TestBatch(fullname=self.fullname)
+    batch.put()
+    runner._initialize_batch(batch.fullname, batch.key, self.config, 0, 1,
+                             ['models.py'])
+    json = batch.key.get().get_json()
+    self.assertEqual({'tests.module1': ['tests.module1.Case.method']},
+                     json['test_unit_methods'])
+
+  def test_shard_ignores_recorded_durations(self):
+    self.config.unit_target_secs = 10.0
+
+    @self.mock(models)
+    def get_test_durations(fullnames):
+      return {'tests.module1.Case.method': 20.0}
+
+    partition_durations = []
+    shard_durations = []
+
+    @self.mock(logic)
+    def partition_units(test, conf, durations, target_secs, errors_out=None):
+      partition_durations.append(durations)
+      return test.get_unit_methods(conf, errors_out)
+
+    @self.mock(logic)
+    def get_shard(unit_methods, shard_index, shard_count, durations=None):
+      shard_durations.append(durations)
+      return unit_methods
+
+    self.fullname = 'tests'
+    self.test_unit_methods = {'tests.module1': ['tests.module1.Case.method']}
+    self.check_initialize_batch(0, 2)
+    # Executors that start later may see other durations, so they are not
+    # used to split or shard the tests.
+    self.assertEqual([{}], partition_durations)
+    self.assertEqual([None], shard_durations)
+
+  def test_shard_by_duration(self):
+    durations = {'tests.module1.Case.method': 2.0}
+    shard_durations = []
+
+    @self.mock(logic)
+    def get_shard(unit_methods, shard_index, shard_count, durations=None):
+      shard_durations.append(durations)
+      return unit_methods
+
+    self.fullname = 'tests'
+    self.test_unit_methods = {'tests.module1': ['tests.module1.Case.method']}
+    batch = models.TestBatch(fullname=self.fullname)
+    batch.put()
+    runner._initialize_batch(batch.fullname, batch.key, self.config, 0, 2,
+                             None, durations)
+    self.assertEqual([durations], shard_durations)
+
+  def test_longest_first(self):
+
+    @self.mock(models)
+    def get_test_durations(fullnames):
+      return {'tests.module3.Case.method': 10.0}
+
+    self.fullname = 'tests'
+    self.test_unit_methods = {
+        'tests.module1': ['tests.module1.Case.method'],
+        'tests.module2': ['tests.module2.Case.method1',
+                          'tests.module2.Case.method2'],
+        'tests.module3': ['tests.module3.Case.method'],
+        'tests.module4': ['tests.module4.Case.method'],
+    }
+    batch = models.TestBatch(fullname=self.fullname)
+    batch.put()
+    runner._initialize_batch(batch.fullname, batch.key, self.config)
+    # Units without durations are estimated by their number of methods.
+    names = [call.args[0] for call in self.deferred]
+    self.assertEqual(['tests.module3', 'tests.module2'], names[:2])
+    self.assertEqual(set(['tests.module1', 'tests.module4']), set(names[2:]))
+    for call in self.deferred:
+      # The tasks are still named after the index of their unit.
+      index = models.RunTestUnitTask.get_index(call.args[1])
+      self.assertEqual('aeta-%s-%s' % (batch.key.id(), index), call.name)
+
+  def test_task_target_secs(self):
+    self.config.task_target_secs = 3
+
+    @self.mock(models)
+    def get_test_durations(fullnames):
+      return {'tests.module2.Case.method': 5.0}
+
+    self.fullname = 'tests'
+    self.test_unit_methods = {
+        'tests.module1': ['tests.module1.Case.method1',
+                          'tests.module1.Case.method2'],
+        'tests.module2': ['tests.module2.Case.method'],
+        'tests.module3': ['tests.module3.Case.method'],
+    }
+    batch = models.TestBatch(fullname=self.fullname)
+    batch.put()
+    runner._initialize_batch(batch.fullname, batch.key, self.config)
+    batch = batch.key.get()
+    self.assertEqual(3, batch.num_units)
+    self.assertEqual(self.test_unit_methods,
+                     batch.get_json()['test_unit_methods'])
+    calls = self.deferred
+    # Every unit is run by exactly one call.
+    names = []
+    for call in calls:
+      if call.func == runner._run_test_units:
+        self.assertTrue(len(call.args[0]) > 1)
+        names.extend(call.args[0])
+      else:
+        self.assertEqual(runner._run_test_unit, call.func)
+        names.append(call.args[0])
+    self.assertEqual(sorted(self.test_unit_methods), sorted(names))
+    # The slow unit runs in a task of its own.
+    self.assertTrue('tests.module2' in [call.args[0] for call in calls
+                                        if call.func == runner._run_test_unit])
+
   def test_different_queue(self):
     self.config.test_queue = 'some_other_queue'
     self.fullname = 'tests'
@@ -400,8 +1436,191 @@ class StartBatchTest(unittest.TestCase, utils.MockAttributeMixin):
     self.assertEqual('tests.module', batch.fullname)
     self.assertEqual(1, len(self.deferred))
     self.assertEqual(runner._initialize_batch, self.deferred[0].func)
-    self.assertEqual(('tests.module', batch.key, self.config),
-                     self.deferred[0].args)
+    self.assertEqual(('tests.module', batch.key, self.config, 0, 1, None,
+                      None), self.deferred[0].args)
+    self.assertEqual('aeta-%s-init' % batch.key.id(), self.deferred[0].name)
+    self.assertTrue(models.BatchProgress.get_key(batch.key).get())
+
+  def test_shard(self):
+    batch = runner.start_batch('tests.module', self.config, shard_index=2,
+                               shard_count=3)
+    self.assertEqual(('tests.module', batch.key, self.config, 2, 3, None,
+                      None), self.deferred[0].args)
+
+  def test_shard_durations(self):
+    durations = {'tests.module.Case.method': 2.0}
+    batch = runner.start_batch('tests.module', self.config, shard_index=0,
+                               shard_count=2, shard_durations=durations)
+    self.assertEqual(durations, self.deferred[0].args[-1])
+    self.assertRaises(TypeError, runner.start_batch, 'tests', self.config,
+                      shard_durations=[])
+
+  def test_changed_paths(self):
+    batch = runner.start_batch('tests', self.config,
+                               changed_paths=['models.py'])
+    self.assertEqual(('tests', batch.key, self.config, 0, 1, ['models.py'],
+                      None), self.deferred[0].args)
+    self.assertRaises(TypeError, runner.start_batch, 'tests', self.config,
+                      changed_paths='models.py')
+
+  def test_fail_fast(self):
+    batch = runner.start_batch('tests', self.config)
+    self.assertEqual(None, models.BatchStatus.get_key(batch.key).get())
+    batch = runner.start_batch('tests', self.config, fail_fast=True)
+    status = models.BatchStatus.get_key(batch.key).get()
+    self.assertTrue(status.fail_fast)
+    self.assertFalse(status.aborted)
+    self.assertRaises(TypeError, runner.start_batch, 'tests', self.config,
+                      fail_fast=1)
+
+  def test_max_reruns(self):
+    batch = runner.start_batch('tests', self.config, max_reruns=2)
+    status = models.BatchStatus.get_key(batch.key).get()
+    self.assertEqual(2, status.max_reruns)
+    self.assertFalse(status.fail_fast)
+    self.assertRaises(ValueError, runner.start_batch, 'tests', self.config,
+                      max_reruns=-1)
+
+  def test_invalid_shard(self):
+    self.assertRaises(TypeError, runner.start_batch, 'tests', self.config,
+                      shard_index=None)
+    self.assertRaises(ValueError, runner.start_batch, 'tests', self.config,
+                      shard_index=3, shard_count=3)
+    self.assertEqual([], self.deferred)
+
+
+class CancelBatchTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for cancel_batch."""
+
+  def setUp(self):
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'datastore'
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.deleted_names = []
+
+    @self.mock(deferred)
+    def delete_tasks(names, queue='default'):
+      self.assertEqual(self.config.test_queue, queue)
+      self.deleted_names.extend(names)
+      return 1
+
+    self.batch = models.TestBatch(fullname='tests')
+    self.batch.key = ndb.Key(models.TestBatch, 'batchid')
+    self.batch.set_info([], {'tests.a': [], 'tests.b': []}, self.config)
+    self.batch.put()
+    self.task = models.RunTestUnitTask(
+        key=models.RunTestUnitTask.get_key(self.batch.key, 0),
+        fullname='tests.a')
+    self.task.set_json({}, self.config)
+    self.task.put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+    self.tear_down_attributes()
+
+  def test_cancel(self):
+    running_key = models.RunTestUnitTask.get_key(self.batch.key, 1)
+    models.RunTestUnitTask(key=running_key, fullname='tests.b').put()
+    checkpoint_key = models.UnitCheckpoint.get_key(running_key)
+    models.UnitCheckpoint(key=checkpoint_key).put()
+    models.record_unit_summary(self.task.key, {'passes': 1}, self.config)
+    shard_key = models.ProgressShard.get_keys(self.batch.key)[0]
+    self.assertEqual(1, runner.cancel_batch(self.batch.key, self.config))
+    self.assertEqual(['aeta-batchid-init', 'aeta-batchid-0',
+                      'aeta-batchid-1'], self.deleted_names)
+    for key in [self.batch.key, self.task.key, running_key, checkpoint_key,
+                shard_key]:
+      self.assertEqual(None, key.get())
+    # The status is kept so running tasks stop, and deleted later.
+    status = models.BatchStatus.get_key(self.batch.key).get()
+    self.assertTrue(status.cancelled)
+
+  def test_results_not_loaded(self):
+
+    @self.mock(models.TestBatch)
+    def get_tasks(batch_self, conf):
+      self.fail('The results of the batch were loaded.')
+
+    @self.mock(models.RunTestUnitTask)
+    def get_json(task_self):
+      self.fail('A result was loaded.')
+
+    checkpoint_key = models.UnitCheckpoint.get_key(
+        models.RunTestUnitTask.get_key(self.batch.key, 1))
+    models.UnitCheckpoint(key=checkpoint_key).put()
+    models.record_unit_summary(self.task.key, {'passes': 1}, self.config)
+    runner.cancel_batch(self.batch.key, self.config)
+    self.assertEqual(None, self.task.key.get())
+    # The unfinished unit's checkpoint is deleted too.
+    self.assertEqual(None, checkpoint_key.get())
+
+  def test_keep_fail_fast(self):
+    status_key = models.BatchStatus.get_key(self.batch.key)
+    models.BatchStatus(key=status_key, fail_fast=True).put()
+    runner.cancel_batch(self.batch.key, self.config)
+    self.assertTrue(status_key.get().fail_fast)
+    self.assertTrue(status_key.get().cancelled)
+
+  def test_delete_tasks_fails(self):
+
+    @self.mock(deferred)
+    def delete_tasks(names, queue='default'):
+      raise ValueError()
+
+    self.assertEqual(0, runner.cancel_batch(self.batch.key, self.config))
+    self.assertEqual(None, self.batch.key.get())
+
+
+class RunInThreadsTest(unittest.TestCase):
+  """Tests for _run_in_threads."""
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_datastore_v3_stub()
+    self.config = copy.copy(config.get_config())
+    self.config.storage = 'immediate_parallel'
+    self.config.max_workers = 3
+    self.batch_key = ndb.Key(models.TestBatch, 'batchid')
+    self.ctx_options = models.get_ctx_options(self.config)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def run_unit(self, task_key):
+    status = models.BatchStatus.get_key(self.batch_key).get(
+        **self.ctx_options)
+    index = models.RunTestUnitTask.get_index(task_key)
+    test = unittest.FunctionTestCase(lambda: sys.stdout.write(str(index)))
+    _, output = runner._run_test_and_capture_output(test)
+    task = models.RunTestUnitTask(key=task_key)
+    task.set_json({'output': output, 'fail_fast': status.fail_fast},
+                  self.config)
+    task.put(**self.ctx_options)
+
+  def test_run(self):
+    models.BatchStatus(key=models.BatchStatus.get_key(self.batch_key),
+                       fail_fast=True).put(**self.ctx_options)
+    task_keys = [[models.RunTestUnitTask.get_key(self.batch_key, i)]
+                 for i in range(5)]
+    calls = [deferred.DeferredCall(self.run_unit, keys[0])
+             for keys in task_keys]
+    original_stdout = sys.stdout
+    runner._run_in_threads(calls, task_keys, self.config)
+    self.assertEqual(original_stdout, sys.stdout)
+    # Every unit captured its own output and saw the status of the batch.
+    for (i, keys) in enumerate(task_keys):
+      self.assertEqual({'output': str(i), 'fail_fast': True},
+                       keys[0].get(**self.ctx_options).get_json())
+    self.assertEqual(
+        5, models.get_batch_summary(self.batch_key, self.config)['num_done'])
+
+  def test_no_calls(self):
+    runner._run_in_threads([], [], self.config)
 
 
 class RunnerE2ETest(unittest.TestCase, utils.TestDataMixin,
@@ -433,9 +1652,9 @@ class RunnerE2ETest(unittest.TestCase, utils.TestDataMixin,
     self.testbed.deactivate()
     self.tear_down_attributes()
 
-  def run_tests(self, fullname):
+  def run_tests(self, fullname, storage='immediate'):
     """Runs tests and returns results."""
-    self.config.storage = 'immediate'
+    self.config.storage = storage
     batch = runner.start_batch(fullname, self.config)
     self.assertTrue(isinstance(batch.get_json(), dict))
     return [task.get_json() for task in batch.get_tasks(self.config)]
@@ -482,6 +1701,41 @@ class RunnerE2ETest(unittest.TestCase, utils.TestDataMixin,
     results = self.run_tests(self.test_class_name)
     self.check_test_results(results)
 
+  def test_rerun(self):
+    self.config.parallelize_classes = True
+    self.config.parallelize_methods = True
+    module = __import__(self.module_name, fromlist=['SimpleTestCase'])
+    attempts = []
+
+    @self.mock(module.SimpleTestCase)
+    def test_fail(case_self):
+      attempts.append(True)
+      case_self.assertTrue(len(attempts) > 1)
+
+    @self.mock(deferred)
+    def defer(*args, **kwargs):
+      raise Exception('should not defer when storage = "immediate"')
+
+    self.config.storage = 'immediate'
+    batch = runner.start_batch(self.test_class_name, self.config,
+                               max_reruns=2)
+    results = dict((task.get_json()['fullname'], task.get_json())
+                   for task in batch.get_tasks(self.config))
+    fail_name = self.test_class_name + '.test_fail'
+    result = results[fail_name]
+    self.assertEqual(2, len(attempts))
+    self.assertEqual([], result['failures'])
+    self.assertEqual([fail_name], result['reruns']['flaky'])
+    self.assertEqual([], results[self.test_class_name + '.test_pass'][
+        'failures'])
+
+  def test_parallel(self):
+    self.config.parallelize_classes = True
+    self.config.parallelize_methods = True
+    self.config.max_workers = 2
+    results = self.run_tests(self.test_class_name, 'immediate_parallel')
+    self.check_test_results(results)
+
   def test_test_method(self):
     fullname = self.test_method_name
     results = self.run_tests(fullname)
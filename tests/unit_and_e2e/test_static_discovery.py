@@ -0,0 +1,280 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the static_discovery module of aeta."""
+
+__author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
+
+# Disable checking; pylint:disable-msg=C0111,W0212,R0904,C0103
+# - docstrings
+# - access to protected members
+# - too many public methods
+# - setUp() and tearDown() method names
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from aeta import static_discovery
+from tests import utils
+
+
+class LocateModuleTest(unittest.TestCase, utils.TestDataMixin):
+  """Tests for the locate_module function."""
+
+  def setUp(self):
+    self.setup_test_data()
+
+  def tearDown(self):
+    self.tear_down_test_data()
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, static_discovery.locate_module, None)
+
+  def test_empty_name(self):
+    self.assertEqual(None, static_discovery.locate_module(''))
+
+  def test_does_not_exist(self):
+    self.assertEqual(None, static_discovery.locate_module('does_not.exist'))
+
+  def test_package(self):
+    name, path, is_package, rest = static_discovery.locate_module(
+        self.test_package_name)
+    self.assertEqual(self.test_package_name, name)
+    self.assertTrue(os.path.isdir(path))
+    self.assertTrue(is_package)
+    self.assertEqual([], rest)
+
+  def test_method(self):
+    module = self.test_package_name + '.subpackage.test_ham'
+    name, path, is_package, rest = static_discovery.locate_module(
+        module + '.FooTest.test_pass')
+    self.assertEqual(module, name)
+    self.assertTrue(path.endswith('test_ham.py'))
+    self.assertFalse(is_package)
+    self.assertEqual(['FooTest', 'test_pass'], rest)
+
+
+class GetModuleInfoTest(unittest.TestCase, utils.TestDataMixin):
+  """Tests for the get_module_info function."""
+
+  def setUp(self):
+    self.setup_test_data()
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.tear_down_test_data()
+    shutil.rmtree(self.temp_dir)
+
+  def get_info(self, module_name, include_test_functions=True):
+    fullname = '%s.%s' % (self.test_package_name, module_name)
+    _, path, _, _ = static_discovery.locate_module(fullname)
+    return static_discovery.get_module_info(fullname, path,
+                                            include_test_functions)
+
+  def get_source_info(self, source):
+    path = os.path.join(self.temp_dir, 'test_source.py')
+    f = open(path, 'w')
+    f.write(source)
+    f.close()
+    static_discovery._MODULE_INFO_CACHE.clear()
+    return static_discovery.get_module_info('test_source', path)
+
+  def check_classes(self, exp_classes, info):
+    self.assertFalse(info.is_dynamic, info.dynamic_reason)
+    classes = dict((name, info.classes[name].method_names)
+                   for name in info.classes)
+    self.assertEqual(exp_classes, classes)
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, static_discovery.get_module_info, None, '')
+    self.assertRaises(TypeError, static_discovery.get_module_info, '', None)
+    self.assertRaises(TypeError, static_discovery.get_module_info, '', '',
+                      include_test_functions=None)
+
+  def test_one_testcase(self):
+    info = self.get_info('test_one_testcase')
+    self.check_classes({'SimpleTestCase': ['test_fail', 'test_pass']}, info)
+    self.assertFalse(info.has_module_fixture)
+    self.assertFalse(info.classes['SimpleTestCase'].has_class_fixture)
+
+  def test_class_fixture(self):
+    info = self.get_info('test_class_fixture')
+    self.check_classes(
+        {'HasClassFixture': ['test_has_bad_class_value',
+                             'test_has_class_value'],
+         'HasNoClassFixture': ['test_fail', 'test_pass']}, info)
+    self.assertTrue(info.classes['HasClassFixture'].has_class_fixture)
+    self.assertFalse(info.classes['HasNoClassFixture'].has_class_fixture)
+
+  def test_module_fixture(self):
+    info = self.get_info('test_module_fixture')
+    self.check_classes(
+        {'ModuleFixtureTestCase': ['test_pass', 'test_setup_module_called']},
+        info)
+    self.assertTrue(info.has_module_fixture)
+
+  def test_test_functions(self):
+    info = self.get_info('test_test_functions')
+    self.check_classes(
+        {'TestTestFunctionsWrappedTestFunctions': ['test_fail', 'test_pass']},
+        info)
+
+  def test_no_test_functions(self):
+    info = self.get_info('test_test_functions', include_test_functions=False)
+    self.check_classes({}, info)
+
+  def test_bad_names(self):
+    info = self.get_info('test_badnames')
+    self.check_classes(
+        {'ClassWithDifferentModule': ['test_method'],
+         'ClassWithDifferentName1': ['test_method'],
+         'ClassWithDifferentName2': ['test_method'],
+         'ClassWithDifferentMethodNames': ['test_method1', 'test_method2']},
+        info)
+
+  def test_local_base_classes(self):
+    info = self.get_source_info(
+        'import unittest as ut\n'
+        'class Mixin(object):\n'
+        '  def test_mixed(self): pass\n'
+        'class Base(ut.TestCase):\n'
+        '  @classmethod\n'
+        '  def setUpClass(cls): pass\n'
+        'class Derived(Mixin, Base):\n'
+        '  def test_derived(self): pass\n')
+    self.check_classes({'Base': [],
+                        'Derived': ['test_derived', 'test_mixed']}, info)
+    self.assertTrue(info.classes['Derived'].has_class_fixture)
+
+  def test_conditional_imports(self):
+    info = self.get_source_info(
+        'try:\n'
+        '  import unittest2 as unittest\n'
+        'except ImportError:\n'
+        '  import unittest\n'
+        'class Foo(unittest.TestCase):\n'
+        '  def test_foo(self): pass\n')
+    self.check_classes({'Foo': ['test_foo']}, info)
+
+  def check_dynamic(self, source):
+    info = self.get_source_info(source)
+    self.assertTrue(info.is_dynamic)
+    self.assertEqual({}, info.classes)
+
+  def test_syntax_error(self):
+    self.check_dynamic('class Foo(\n')
+
+  def test_foreign_base_class(self):
+    self.check_dynamic('from base import Base\n'
+                       'class Foo(Base):\n'
+                       '  def test_foo(self): pass\n')
+
+  def test_metaclass(self):
+    self.check_dynamic('import unittest\n'
+                       'class Foo(unittest.TestCase):\n'
+                       '  __metaclass__ = Meta\n')
+
+  def test_load_tests(self):
+    self.check_dynamic('def load_tests(loader, tests, pattern):\n'
+                       '  return tests\n')
+
+  def test_star_import(self):
+    self.check_dynamic('from other_test import *\n')
+
+  def test_imported_test_case(self):
+    self.check_dynamic('from other_test import OtherTest\n')
+
+  def test_conditional_class(self):
+    self.check_dynamic('import unittest\n'
+                       'if True:\n'
+                       '  class Foo(unittest.TestCase):\n'
+                       '    def test_foo(self): pass\n')
+
+  def test_added_method(self):
+    self.check_dynamic('import unittest\n'
+                       'class Foo(unittest.TestCase):\n'
+                       '  pass\n'
+                       'Foo.test_foo = lambda self: None\n')
+
+  def test_setattr(self):
+    self.check_dynamic('import unittest\n'
+                       'class Foo(unittest.TestCase):\n'
+                       '  pass\n'
+                       'setattr(Foo, "test_" + "foo", lambda self: None)\n')
+
+  def test_cached(self):
+    info = self.get_info('test_one_testcase')
+    self.assertTrue(info is self.get_info('test_one_testcase'))
+
+
+class GetImportedModuleNamesTest(unittest.TestCase):
+  """Tests for the get_imported_module_names function."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def get_names(self, fullname, source, file_name='test_source.py'):
+    path = os.path.join(self.temp_dir, file_name)
+    f = open(path, 'w')
+    f.write(source)
+    f.close()
+    return static_discovery.get_imported_module_names(fullname, path)
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, static_discovery.get_imported_module_names,
+                      None, '')
+    self.assertRaises(TypeError, static_discovery.get_imported_module_names,
+                      '', None)
+
+  def test_import(self):
+    self.assertEqual(set(['os.path', 'pkg.os.path', 'sys', 'pkg.sys']),
+                     self.get_names('pkg.test_source',
+                                    'import os.path\nimport sys as system\n'))
+
+  def test_import_from(self):
+    self.assertEqual(set(['a', 'a.b', 'pkg.a', 'pkg.a.b']),
+                     self.get_names('pkg.test_source', 'from a import b\n'))
+
+  def test_relative_import(self):
+    self.assertEqual(set(['pkg.sub', 'pkg.sub.helper']),
+                     self.get_names('pkg.sub.test_source',
+                                    'from . import helper\n'))
+    self.assertEqual(set(['pkg.util', 'pkg.util.f']),
+                     self.get_names('pkg.sub.test_source',
+                                    'from ..util import f\n'))
+
+  def test_package(self):
+    self.assertEqual(set(['pkg.helper', 'pkg.helper.f']),
+                     self.get_names('pkg', 'from .helper import f\n',
+                                    '__init__.py'))
+
+  def test_top_level(self):
+    self.assertEqual(set(['os']), self.get_names('test_source', 'import os\n'))
+
+  def test_syntax_error(self):
+    self.assertEqual(set(), self.get_names('pkg.test_source', 'import\n'))
+
+
+class GetWrappedClassNameTest(unittest.TestCase):
+  """Tests for the get_wrapped_class_name function."""
+
+  def test_get_wrapped_class_name(self):
+    self.assertEqual('TestUnicodeWrappedTestFunctions',
+                     static_discovery.get_wrapped_class_name(
+                         'package.test_unicode'))
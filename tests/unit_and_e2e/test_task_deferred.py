@@ -49,6 +49,7 @@ class DeferredTest(unittest.TestCase, utils.MockAttributeMixin):
 
   def setUp(self):
     self.payloads = []
+    self.names = []
     self.expected_queue_name = 'default'
     self.expected_countdown = 0
     self.url = config.get_config().url_path_deferred
@@ -66,6 +67,7 @@ class DeferredTest(unittest.TestCase, utils.MockAttributeMixin):
         countdown_diff = tsk.eta_posix - time.time()
         self.assertTrue(abs(self.expected_countdown - countdown_diff) < 10)
         self.payloads.append(tsk.payload)
+        self.names.append(tsk.name)
 
       if isinstance(task, list):
         self.assertTrue(len(task) <= taskqueue.MAX_TASKS_PER_ADD)
@@ -98,6 +100,39 @@ class DeferredTest(unittest.TestCase, utils.MockAttributeMixin):
     deferred.defer(_add_deferred_args, x=5, y=6, _countdown=1000)
     self.check_execute_task(get_args(x=5, y=6))
 
+  def test_set_name(self):
+    deferred.defer_multi([
+        deferred.DeferredCall(_add_deferred_args, 1, _name='task-1'),
+        deferred.DeferredCall(_add_deferred_args, 2)])
+    self.assertEqual(['task-1', None], self.names)
+    self.check_execute_task(get_args(1), get_args(2))
+
+  def test_already_exists(self):
+
+    @self.mock(taskqueue.Queue)
+    def add(queue_self, task):
+      raise taskqueue.TaskAlreadyExistsError()
+
+    # Deferring the same named task again is not an error.
+    deferred.defer(_add_deferred_args, _name='task-1')
+
+  def test_delete_tasks(self):
+    queued = set(['task-%s' % i for i in range(0, 250, 2)])
+
+    class DeletedTask(object):
+
+      def __init__(task_self, name):
+        task_self.was_deleted = name in queued
+
+    @self.mock(taskqueue.Queue)
+    def delete_tasks_by_name(queue_self, names):
+      self.assertEqual('myqueue', queue_self.name)
+      self.assertTrue(len(names) <= taskqueue.MAX_TASKS_PER_ADD)
+      return [DeletedTask(name) for name in names]
+
+    names = ['task-%s' % i for i in range(250)]
+    self.assertEqual(125, deferred.delete_tasks(names, queue='myqueue'))
+
   def test_multi_small(self):
     deferred.defer_multi([
       deferred.DeferredCall(_add_deferred_args, 5, 6),
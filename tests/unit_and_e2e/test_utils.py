@@ -17,6 +17,8 @@
 import base64
 import os
 import re
+import threading
+import time
 import unittest
 
 from aeta import utils
@@ -86,3 +88,67 @@ class RandUniqueIdTest(unittest.TestCase, tests_utils.MockAttributeMixin):
       self.assertEqual(self.rand_bytes, base64.urlsafe_b64decode(idstr))
 
 
+
+
+class MapInThreadsTest(unittest.TestCase):
+  """Tests for the map_in_threads function."""
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, utils.map_in_threads, str, None, 2)
+    self.assertRaises(TypeError, utils.map_in_threads, str, [], None)
+
+  def test_empty(self):
+    self.assertEqual([], utils.map_in_threads(str, [], 4))
+
+  def test_single_thread(self):
+    thread_names = []
+
+    def func(item):
+      thread_names.append(threading.currentThread().getName())
+      return item * 2
+
+    self.assertEqual([2, 4, 6], utils.map_in_threads(func, [1, 2, 3], 1))
+    self.assertEqual([threading.currentThread().getName()],
+                     list(set(thread_names)))
+
+  def test_order_preserved(self):
+
+    def func(item):
+      # Make earlier items finish later.
+      time.sleep(0.001 * (10 - item))
+      return item * 2
+
+    items = range(10)
+    self.assertEqual([item * 2 for item in items],
+                     utils.map_in_threads(func, items, 4))
+
+  def test_bounded(self):
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def func(item):
+      lock.acquire()
+      running[0] += 1
+      max_running[0] = max(max_running[0], running[0])
+      lock.release()
+      time.sleep(0.005)
+      lock.acquire()
+      running[0] -= 1
+      lock.release()
+      return item
+
+    self.assertEqual(range(20), utils.map_in_threads(func, range(20), 3))
+    self.assertTrue(max_running[0] <= 3)
+
+  def test_first_exception_raised(self):
+
+    def func(item):
+      if item == 1:
+        time.sleep(0.01)
+        raise ValueError(item)
+      if item == 3:
+        raise KeyError(item)
+      return item
+
+    self.assertRaises(ValueError, utils.map_in_threads, func, range(5), 4)
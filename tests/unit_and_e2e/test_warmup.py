@@ -0,0 +1,107 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the warmup module of aeta."""
+
+__author__ = 'jacobltaylor@gmail.com (Jacob Taylor)'
+
+# Disable checking; pylint:disable-msg=C0111,W0212,R0904,C0103
+# - docstrings
+# - access to protected members
+# - too many public methods
+# - setUp() and tearDown() method names
+
+import copy
+import sys
+import unittest
+
+import webtest
+
+from aeta import config
+from aeta import logic
+from aeta import warmup
+from tests import utils
+
+
+class WarmUpTest(unittest.TestCase, utils.TestDataMixin,
+                 utils.MockAttributeMixin):
+  """Tests for the warm_up function."""
+
+  def setUp(self):
+    self.setup_test_data()
+    self.config = copy.copy(config.get_config())
+    self.config.test_package_names = [self.test_package_name]
+    self.config.test_module_pattern = '^test_[\w]+$'
+    self.module_name = self.test_package_name + '.test_one_testcase'
+    sys.modules.pop(self.module_name, None)
+    logic._clear_name_indexes()
+
+    @self.mock(config)
+    def get_config():
+      return self.config
+
+  def tearDown(self):
+    self.tear_down_test_data()
+    self.tear_down_attributes()
+    logic._clear_name_indexes()
+
+  def test_invalid_input(self):
+    self.assertRaises(TypeError, warmup.warm_up, 'conf')
+
+  def test_warm_up(self):
+    module_names = logic.get_module_names_in_package(
+        self.test_package_name, self.config.test_module_pattern)
+    stats = warmup.warm_up(self.config)
+    self.assertEqual(len(module_names), stats['num_modules'])
+    self.assertEqual(0, stats['num_skipped'])
+    self.assertTrue(self.module_name in sys.modules)
+    index = logic._get_name_index(self.config)
+    self.assertEqual('method',
+                     index.get(self.module_name + '.SimpleTestCase.test_pass')
+                     .kind)
+
+  def test_static_discovery(self):
+    self.config.static_discovery = True
+    stats = warmup.warm_up(self.config)
+    self.assertEqual(0, stats['num_skipped'])
+    self.assertTrue(self.module_name in sys.modules)
+    index = logic._get_name_index(self.config)
+    self.assertEqual('class',
+                     index.get(self.module_name + '.SimpleTestCase').kind)
+
+  def test_loads_config(self):
+    self.assertTrue(warmup.warm_up()['num_modules'] > 0)
+
+  def test_budget(self):
+    self.config.warmup_budget_secs = 0
+    stats = warmup.warm_up(self.config)
+    self.assertEqual(0, stats['num_modules'])
+    self.assertTrue(stats['num_skipped'] > 0)
+    self.assertFalse(self.module_name in sys.modules)
+
+
+class WarmupRequestHandlerTest(unittest.TestCase, utils.MockAttributeMixin):
+  """Tests for the WarmupRequestHandler class."""
+
+  def setUp(self):
+    self.calls = []
+    self.mock(warmup, 'warm_up')(lambda: self.calls.append(True))
+    self.app = webtest.TestApp(warmup.APP)
+
+  def tearDown(self):
+    self.tear_down_attributes()
+
+  def test_warmup(self):
+    self.app.get('/_ah/warmup', status=200)
+    self.assertEqual([True], self.calls)